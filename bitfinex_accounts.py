@@ -0,0 +1,225 @@
+"""
+Several Bitfinex accounts in one process.
+
+The [bitfinex] account is the root. Further accounts are listed in its "accounts" option, each with
+its own section of credentials:
+
+    [bitfinex]
+    accounts: sub1, sub2
+
+    [bitfinex_sub1]
+    key: pubkey
+    secret: secret
+    userpubkey: 1addressgoeshere
+
+Every account gets its own plugin instance with its own credentials, nonce, database session and
+manager_user. The instances share the root's config, logger, database engine and redis client,
+and the module wide HTTP connection pool. Account state in redis (balances, sync activity...) is
+kept under per-account keys, while market data stays shared and is only polled and subscribed to by
+the root. One scheduler thread polls the syncs of every account.
+
+Positions are not per account. They are computed from the trades in the database, which do not record
+the account that made them, so every account applies its trades to the one shared checkpoint of the
+combined book.
+
+    bitfinexa
+"""
+import threading
+
+from bitfinex_backfill import DONE_KEY
+from bitfinex_balances import CACHE_KEY
+from bitfinex_lease import LEASE_PREFIX, NODES_KEY
+from bitfinex_retry import METRICS_KEY as RETRY_METRICS_KEY
+from bitfinex_scheduler import ACTIVITY_PREFIX, METRICS_KEY
+
+# redis keys holding the state of one account; CACHE_KEY also covers the balance live and checked keys.
+# The positions checkpoint and its lock are left shared, see above.
+ACCOUNT_KEYS = (CACHE_KEY, ACTIVITY_PREFIX, METRICS_KEY, LEASE_PREFIX, NODES_KEY, DONE_KEY, RETRY_METRICS_KEY,
+                'bitfinex_movement_currencies')
+CREDENTIALS = ('key', 'secret', 'userpubkey')
+
+
+def read_accounts(cfg, section='bitfinex'):
+    """
+    :return: a list of (name, credentials dict) for the accounts listed in the section's "accounts" option
+    """
+    if not cfg.has_option(section, 'accounts'):
+        return []
+    accounts = []
+    for name in cfg.get(section, 'accounts').split(','):
+        name = name.strip()
+        if name:
+            accounts.append((name, dict((option, cfg.get('%s_%s' % (section, name), option))
+                                        for option in CREDENTIALS)))
+    return accounts
+
+
+class AccountConfig(object):
+    """
+    The shared config, with one account's credentials in place of the root's.
+    """
+
+    def __init__(self, cfg, credentials, section='bitfinex'):
+        self.cfg = cfg
+        self.credentials = credentials
+        self.section = section
+
+    def get(self, section, option, *args, **kwargs):
+        if section == self.section and option in self.credentials:
+            return self.credentials[option]
+        return self.cfg.get(section, option, *args, **kwargs)
+
+    def has_option(self, section, option):
+        return section == self.section and option in self.credentials or self.cfg.has_option(section, option)
+
+    def __getattr__(self, name):
+        return getattr(self.cfg, name)
+
+
+class AccountRedis(object):
+    """
+    The shared redis client, keeping the ACCOUNT_KEYS of one account under its own keys.
+    Other keys (tickers, books, traces) are left as they are.
+    """
+
+    def __init__(self, red, account):
+        self.red = red
+        self.account = account
+
+    def key(self, key):
+        return '%s|%s' % (key, self.account) if key.startswith(ACCOUNT_KEYS) else key
+
+    def get(self, key):
+        return self.red.get(self.key(key))
+
+    def set(self, key, value, *args, **kwargs):
+        return self.red.set(self.key(key), value, *args, **kwargs)
+
+    def delete(self, *keys):
+        return self.red.delete(*[self.key(k) for k in keys])
+
+    def mget(self, keys):
+        return self.red.mget([self.key(k) for k in keys])
+
+    def hgetall(self, key):
+        return self.red.hgetall(self.key(key))
+
+    def hmset(self, key, mapping):
+        return self.red.hmset(self.key(key), mapping)
+
+    def hset(self, key, field, value):
+        return self.red.hset(self.key(key), field, value)
+
+    def sadd(self, key, *values):
+        return self.red.sadd(self.key(key), *values)
+
+    def sismember(self, key, value):
+        return self.red.sismember(self.key(key), value)
+
+    def zadd(self, key, *args, **kwargs):
+        return self.red.zadd(self.key(key), *args, **kwargs)
+
+    def zcard(self, key):
+        return self.red.zcard(self.key(key))
+
+    def zrem(self, key, *values):
+        return self.red.zrem(self.key(key), *values)
+
+    def zremrangebyscore(self, key, low, high):
+        return self.red.zremrangebyscore(self.key(key), low, high)
+
+    def register_script(self, script):
+        run = self.red.register_script(script)
+        return lambda keys=(), args=(): run(keys=[self.key(k) for k in keys], args=args)
+
+    def __getattr__(self, name):
+        return getattr(self.red, name)
+
+
+class AccountPool(object):
+    """
+    The root plugin and an account context for every configured account.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.accounts = [root.account_context(name, credentials) for name, credentials in read_accounts(root.cfg)]
+
+    @property
+    def plugins(self):
+        return [self.root] + self.accounts
+
+    def sync_orders(self):
+        """
+        Close the open orders in the database which no account has open on the exchange any more.
+        Orders are not tied to an account in the database, so this has to look at every account at once.
+
+        :return: the number of orders closed
+        """
+        if not self.root.owns('orders'):
+            return
+        listed = set()
+        for plugin in self.plugins:
+            listed.update(o.order_id for o in plugin.get_open_orders())
+        from trade_manager.plugin import get_orders
+        closed = 0
+        for dbo in get_orders(exchange='bitfinex', state='open', session=self.root.session):
+            if dbo.order_id not in listed:
+                dbo.state = 'closed'
+                closed += 1
+        self.root.session.commit()
+        return closed
+
+    def build_scheduler(self):
+        """
+        :return: one Scheduler polling the syncs of every account, and the root's market data
+        """
+        scheduler = self.root.build_scheduler(orders=False)
+        for plugin in self.accounts:
+            plugin.build_scheduler(scheduler, public=False, orders=False)
+        scheduler.add('orders', self.sync_orders, 5, 300,
+                      activity=tuple(plugin.account_task('orders') for plugin in self.plugins))
+        return scheduler
+
+    def release_leases(self):
+        for plugin in self.plugins:
+            if plugin._leases is not None:
+                plugin.leases.release_all()
+
+
+def main():
+    """
+    Run the listener of every account, and the scheduled syncs if "schedule" is enabled.
+    The exchange authenticates one account per websocket, so each account has its own socket,
+    but only the root's subscribes to market data.
+    """
+    import bitfinex_listener
+    import websocket
+    from bitfinex_manager import Bitfinex
+    root = bitfinex_listener.setup_plugin()
+    bitfinex_listener.setup_connections()
+    bitfinex_listener.wait_for_connections()
+    listeners = AccountPool(root)
+    root.logger.info("bitfinex accounts %s" % ", ".join(p.account for p in listeners.accounts))
+    pollers = None
+    stop = threading.Event()
+    if root.cfg.has_option('bitfinex', 'schedule') and root.cfg.getboolean('bitfinex', 'schedule'):
+        # the scheduler thread gets its own sessions, like bitfinex_manager.start_scheduler
+        poller = Bitfinex()
+        poller.setup_connections()
+        pollers = AccountPool(poller)
+        thread = threading.Thread(target=pollers.build_scheduler().run_forever, args=(stop,))
+        thread.daemon = True
+        thread.start()
+    for plugin in listeners.accounts:
+        ws = bitfinex_listener.attach(websocket.WebSocketApp(bitfinex_listener.WS_URL), plugin)
+        thread = threading.Thread(target=ws.run_forever)
+        thread.daemon = True
+        thread.start()
+    try:
+        bitfinex_listener.main()
+    finally:
+        stop.set()
+        for pool in (listeners, pollers):
+            if pool is not None:
+                pool.release_leases()
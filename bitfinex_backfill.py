@@ -0,0 +1,240 @@
+"""
+Deep history backfill for a Bitfinex account.
+
+The requested date range is split into independent time windows for each market (mytrades)
+and currency (history/movements). Windows are fetched concurrently, merged into the database
+without duplicates, and checkpointed in redis as they complete, so an interrupted backfill
+resumes with the windows which are still missing, even when its end is a later now.
+
+    bitfinexb --begin 2014-01-01 --window-days 30 --workers 4
+"""
+import argparse
+import calendar
+import datetime
+import sys
+import threading
+import time
+from Queue import Queue
+
+DONE_KEY = 'bitfinex_backfill_done'
+PAGE_LIMIT = 500
+RETRIES = 5
+
+
+class Window(object):
+    """
+    A [begin, end] time range of one kind of history ('trades' or 'movements') for one market or currency.
+    """
+    __slots__ = ('kind', 'key', 'begin', 'end')
+
+    def __init__(self, kind, key, begin, end):
+        self.kind = kind
+        self.key = key
+        self.begin = begin
+        self.end = end
+
+    @property
+    def name(self):
+        return "%s|%s|%d|%d" % (self.kind, self.key, self.begin, self.end)
+
+    def __repr__(self):
+        return "<Window %s>" % self.name
+
+
+def split_windows(kind, keys, begin, end, size):
+    """
+    Windows are cut on a grid of size seconds from the epoch, so a later run with the same begin but a later
+    end (i.e. now) has the same names for the windows it shares, and skips those which are done.
+
+    :return: Windows of at most size seconds covering begin to end for every key, newest first.
+    """
+    windows = []
+    for key in keys:
+        wend = end
+        while wend > begin:
+            wbegin = max(begin, (wend - 1) // size * size)
+            windows.append(Window(kind, key, wbegin, wend))
+            wend = wbegin
+    return windows
+
+
+def fetch_pages(fetch, window, emit, limit=PAGE_LIMIT, retries=RETRIES, sleep=time.sleep):
+    """
+    Page backwards through one window, passing each page of rows to emit.
+
+    :param fetch: fetch(key, begin, end) returning a list of rows, or an error dict or None
+    """
+    until = window.end
+    while True:
+        rows = None
+        for attempt in range(retries):
+            rows = fetch(window.key, window.begin, until)
+            if isinstance(rows, list):
+                break
+            sleep(0.1 * 2 ** attempt)  # i.e. "Nonce is too small." from concurrent requests, or a timeout
+        if not isinstance(rows, list):
+            raise IOError("unable to fetch %s until %s: %s" % (window, until, rows))
+        rows = [r for r in rows if 'timestamp' in r]
+        if len(rows) == 0:
+            return
+        emit(rows)
+        oldest = min(float(r['timestamp']) for r in rows)
+        if len(rows) < limit or oldest <= window.begin or oldest >= until:
+            return
+        until = oldest
+
+
+def _worker(jobs, results, fetchers):
+    while True:
+        window = jobs.get()
+        if window is None:
+            return
+        try:
+            fetch_pages(fetchers[window.kind], window, lambda rows: results.put(('rows', window, rows)))
+            results.put(('done', window, None))
+        except Exception as e:
+            results.put(('error', window, e))
+
+
+class Backfill(object):
+    """
+    Backfill trades and movements for a connected Bitfinex plugin between begin and end (epoch seconds).
+    """
+
+    def __init__(self, bitfinex, begin, end=None, window_size=30 * 86400, workers=4, out=sys.stdout):
+        self.bitfinex = bitfinex
+        self.begin = int(begin)
+        self.end = int(end if end is not None else time.time())
+        self.window_size = int(window_size)
+        self.workers = workers
+        self.out = out
+        self.inserted = 0
+        self.trades_inserted = False
+
+    def windows(self):
+        return split_windows('trades', self.bitfinex.trade_markets(), self.begin, self.end, self.window_size) + \
+            split_windows('movements', sorted(self.bitfinex.movement_currencies()), self.begin, self.end,
+                          self.window_size)
+
+    def fetchers(self):
+        bitfinex = self.bitfinex
+        return {
+            'trades': lambda market, begin, end: bitfinex.get_trades_history(begin=begin, end=end, market=market,
+                                                                            limit=PAGE_LIMIT),
+            'movements': lambda currency, begin, end: bitfinex.get_dw_history(currency, begin=begin, end=end)
+        }
+
+    def is_done(self, window):
+        return self.bitfinex.red.sismember(DONE_KEY, window.name)
+
+    def mark_done(self, window):
+        self.bitfinex.red.sadd(DONE_KEY, window.name)
+
+    def merge(self, window, rows):
+        """
+        Insert the rows of one page which are not in the database yet.
+        """
+        from trade_manager import em
+        session = self.bitfinex.session
+        if window.kind == 'trades':
+            ids = set('bitfinex|%s' % r['tid'] for r in rows)
+            known = set(t[0] for t in session.query(em.Trade.trade_id).filter(em.Trade.trade_id.in_(ids)))
+            for row in rows:
+                if 'bitfinex|%s' % row['tid'] not in known:
+                    known.add('bitfinex|%s' % row['tid'])
+                    session.add(self.bitfinex.trade_from_row(row, window.key))
+                    self.inserted += 1
+                    self.trades_inserted = True
+        else:
+            rows = [r for r in rows if r['status'] == 'COMPLETED']
+            known = self.bitfinex.known_movements(['bitfinex|%s' % r['id'] for r in rows])
+            for row in rows:
+                if 'bitfinex|%s' % row['id'] not in known:
+                    movement = self.bitfinex.movement_from_row(row)
+                    if movement is not None:
+                        known.add('bitfinex|%s' % row['id'])
+                        session.add(movement)
+                        self.inserted += 1
+
+    def report(self, done, total, started):
+        elapsed = time.time() - started
+        eta = elapsed / done * (total - done) if done > 0 else 0
+        self.out.write("\r%d/%d windows, %d rows inserted, %ds elapsed, eta %ds " %
+                       (done, total, self.inserted, elapsed, eta))
+        self.out.flush()
+
+    def run(self):
+        """
+        :return: the number of windows which failed and need another run.
+        """
+        windows = self.windows()
+        pending = [w for w in windows if not self.is_done(w)]
+        total = len(pending)
+        self.bitfinex.logger.info("backfill %d of %d windows from %s to %s" %
+                                  (total, len(windows), self.begin, self.end))
+        jobs = Queue()
+        results = Queue()
+        for window in pending:
+            jobs.put(window)
+        threads = []
+        for i in range(min(self.workers, total)):
+            jobs.put(None)
+            thread = threading.Thread(target=_worker, args=(jobs, results, self.fetchers()))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        started = time.time()
+        done = failed = 0
+        self.report(done, total, started)
+        while done + failed < total:
+            event, window, data = results.get()
+            if event == 'rows':
+                self.merge(window, data)
+                continue
+            try:
+                self.bitfinex.session.commit()
+            except Exception as e:
+                self.bitfinex.logger.exception(e)
+                self.bitfinex.session.rollback()
+                data = data or e
+            self.bitfinex.begin_unit()
+            if event == 'done' and not isinstance(data, Exception):
+                self.mark_done(window)
+                done += 1
+            else:
+                self.bitfinex.logger.error("backfill %s failed: %s" % (window, data))
+                failed += 1
+            self.report(done + failed, total, started)
+        self.out.write("\n")
+        if self.trades_inserted:
+            self.bitfinex.rebuild_positions()
+        return failed
+
+
+def parse_time(value):
+    """
+    Epoch seconds or a YYYY-MM-DD UTC date.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return calendar.timegm(datetime.datetime.strptime(value, '%Y-%m-%d').timetuple())
+
+
+def main():
+    from bitfinex_manager import Bitfinex
+    parser = argparse.ArgumentParser(description='Backfill Bitfinex trade and movement history.')
+    parser.add_argument('--begin', required=True, help='epoch seconds or YYYY-MM-DD')
+    parser.add_argument('--end', default=None, help='epoch seconds or YYYY-MM-DD, default now')
+    parser.add_argument('--window-days', type=float, default=30)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--restart', action='store_true', help='forget completed windows and start over')
+    args = parser.parse_args()
+    bitfinex = Bitfinex()
+    bitfinex.setup_connections()
+    if args.restart:
+        bitfinex.red.delete(DONE_KEY)
+    backfill = Backfill(bitfinex, parse_time(args.begin), parse_time(args.end) if args.end else None,
+                        args.window_days * 86400, args.workers)
+    if backfill.run() > 0:
+        raise SystemExit(1)
@@ -0,0 +1,106 @@
+"""
+In-memory exchange wallet balances, driven by the listener's 'ws' and 'wu' account events.
+
+Changes are published to redis at once for fast reads by other processes, while database writes
+are debounced so a burst of wallet updates costs one write per currency. While the listener is
+live, REST balance polling is only needed as a periodic consistency check.
+"""
+import json
+import time
+
+CACHE_KEY = 'bitfinex_balances'
+LIVE_KEY = 'bitfinex_balances_live'  # set while a listener keeps the cache current
+CHECKED_KEY = 'bitfinex_balances_checked'  # time of the last REST consistency check
+LIVE_TTL = 30  # seconds, several websocket heartbeats
+DEBOUNCE = 1.0  # seconds
+
+
+def read_balances(red):
+    """
+    :return: a dict of currency to (total, available), available may be None
+    """
+    balances = {}
+    for currency, data in red.hgetall(CACHE_KEY).items():
+        data = json.loads(data)
+        balances[currency] = (data['total'], data['available'])
+    return balances
+
+
+def publish_balances(red, balances, now=None):
+    """
+    :param balances: a dict of currency to (total, available)
+    """
+    now = now if now is not None else time.time()
+    if len(balances) == 0:
+        return
+    red.hmset(CACHE_KEY, dict((currency, json.dumps({'total': total, 'available': available, 'time': now}))
+                              for currency, (total, available) in balances.items()))
+
+
+def listener_live(red):
+    return red.get(LIVE_KEY) is not None
+
+
+def rest_check_due(red, interval, now=None):
+    """
+    :return: True if REST balances should be polled, i.e. no listener is live or the last check is too old
+    """
+    if not listener_live(red):
+        return True
+    checked = red.get(CHECKED_KEY)
+    now = now if now is not None else time.time()
+    return checked is None or now - float(checked) >= interval
+
+
+def mark_rest_checked(red, now=None):
+    red.set(CHECKED_KEY, now if now is not None else time.time())
+
+
+class BalanceCache(object):
+    def __init__(self, red, debounce=DEBOUNCE):
+        self.red = red
+        self.debounce = debounce
+        self.balances = {}
+        self.dirty = set()
+        self.dirty_since = None
+
+    def update(self, currency, total, available=None, now=None):
+        """
+        Apply a wallet event. Unchanged balances are ignored.
+
+        :return: True if the balance changed
+        """
+        now = now if now is not None else time.time()
+        old = self.balances.get(currency)
+        if available is None and old is not None:
+            available = old[1]  # v1 wallet events may not carry available, keep the last known
+        new = (float(total), float(available) if available is not None else None)
+        if new == old:
+            return False
+        self.balances[currency] = new
+        self.dirty.add(currency)
+        if self.dirty_since is None:
+            self.dirty_since = now
+        publish_balances(self.red, {currency: new}, now)
+        return True
+
+    def alive(self):
+        """
+        Mark the cache as being kept current. Call on every websocket heartbeat.
+        """
+        self.red.set(LIVE_KEY, time.time(), ex=LIVE_TTL)
+
+    def due(self, now=None):
+        if len(self.dirty) == 0:
+            return False
+        now = now if now is not None else time.time()
+        return now - self.dirty_since >= self.debounce
+
+    def drain(self):
+        """
+        :return: the changed balances as (currency, total, available) tuples, and forget they changed
+        """
+        changed = [(currency,) + self.balances[currency] for currency in sorted(self.dirty)]
+        self.dirty = set()
+        self.dirty_since = None
+        return changed
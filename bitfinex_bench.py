@@ -0,0 +1,486 @@
+"""
+Offline microbenchmarks of the plugin's hot paths, with stored baselines and a regression check.
+
+Every case runs in process against an in-memory sqlite database, an in-memory redis and a stub of
+the REST session which answers from canned data, so results only depend on this code and the
+machine. Each case is timed several times and the best run is kept, in seconds per operation.
+
+    bitfinexbench                                  # run and print
+    bitfinexbench --save bench_baseline.json       # store the results as the baseline
+    bitfinexbench --check bench_baseline.json      # exit 1 if a case got slower than the threshold
+
+The baseline is json. A case is a regression when it is more than --threshold percent slower than
+its baseline; a "thresholds" object in the baseline file overrides that per case, i.e.
+{"thresholds": {"sync_trades 2000": 40}}. Baselines are only comparable on the machine they were
+recorded on.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import timeit
+from base64 import b64decode
+from ConfigParser import RawConfigParser
+from contextlib import contextmanager
+
+DEFAULT_THRESHOLD = 25  # percent
+REPEAT = 5
+ORDERS = 2000
+TRADES = 2000
+MARKETS = ['BTC_USD', 'ETH_USD', 'ETH_BTC', 'LTC_USD', 'LTC_BTC', 'DASH_USD', 'DASH_BTC']
+CURRENCIES = ['btc', 'usd', 'eth', 'ltc', 'drk']
+START = 1462104000  # timestamp of the first generated trade
+
+
+class Case(object):
+    """
+    :param setup: setup(number) prepares the state, untimed, and returns the operation to time
+    :param number: operations per timed run
+    """
+
+    def __init__(self, name, setup, number=1):
+        self.name = name
+        self.setup = setup
+        self.number = number
+
+
+def time_case(case, repeat=REPEAT, timer=timeit.default_timer):
+    """
+    :return: a dict of the best and median seconds per operation over repeat runs
+    """
+    runs = []
+    for i in range(repeat):
+        op = case.setup(case.number)
+        started = timer()
+        for j in xrange(case.number):
+            op()
+        runs.append((timer() - started) / case.number)
+    runs.sort()
+    return {'seconds': runs[0], 'median': runs[len(runs) // 2], 'number': case.number, 'repeat': repeat}
+
+
+def run_cases(cases, repeat=REPEAT, only=None, out=None):
+    """
+    :param only: time only the cases whose name contains this
+    :return: a dict of case name to time_case results
+    """
+    results = {}
+    for case in cases:
+        if only is not None and only not in case.name:
+            continue
+        results[case.name] = time_case(case, repeat)
+        if out is not None:
+            out.write("%-28s %12.2f us\n" % (case.name, results[case.name]['seconds'] * 1e6))
+    return results
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results, thresholds=None):
+    baseline = {'created': time.time(), 'python': platform.python_version(), 'machine': platform.platform(),
+                'cases': results, 'thresholds': thresholds or {}}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    return baseline
+
+
+def compare(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """
+    :return: a list of (name, baseline seconds, seconds, percent change, regressed), sorted by name.
+             Cases missing from either side are left out.
+    """
+    thresholds = baseline.get('thresholds', {})
+    rows = []
+    for name in sorted(results):
+        if name not in baseline['cases']:
+            continue
+        base = baseline['cases'][name]['seconds']
+        now = results[name]['seconds']
+        change = (now - base) / base * 100 if base > 0 else 0.0
+        rows.append((name, base, now, change, change > thresholds.get(name, threshold)))
+    return rows
+
+
+class MemoryRedis(object):
+    """
+    The subset of a redis client the plugin and the listener use, in memory. Expiry is ignored.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, str) else str(value)
+        return True
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def delete(self, *keys):
+        return len([self.data.pop(k) for k in keys if k in self.data])
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field, value):
+        field = str(field)
+        new = field not in self.data.setdefault(key, {})
+        self.data[key][field] = str(value)
+        return int(new)
+
+    def hsetnx(self, key, field, value):
+        if str(field) in self.data.get(key, {}):
+            return 0
+        return self.hset(key, field, value)
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update((str(f), str(v)) for f, v in mapping.items())
+        return True
+
+    def hincrby(self, key, field, amount=1):
+        field = str(field)
+        value = int(self.data.setdefault(key, {}).get(field, 0)) + amount
+        self.data[key][field] = str(value)
+        return value
+
+    def sadd(self, key, *values):
+        members = self.data.setdefault(key, set())
+        added = len(set(str(v) for v in values) - members)
+        members.update(str(v) for v in values)
+        return added
+
+    def sismember(self, key, value):
+        return str(value) in self.data.get(key, set())
+
+    def zadd(self, key, **members):
+        self.data.setdefault(key, {}).update((m, float(score)) for m, score in members.items())
+        return len(members)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.data.get(key, {})
+        gone = [m for m, score in zset.items() if float(low) <= score <= float(high)]
+        for member in gone:
+            del zset[member]
+        return len(gone)
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zrem(self, key, *members):
+        return len([self.data.get(key, {}).pop(m) for m in members if m in self.data.get(key, {})])
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline(object):
+    def __init__(self, red):
+        self.red = red
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.red, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [method(*args, **kwargs) for method, args, kwargs in self.calls]
+        self.calls = []
+        return results
+
+
+class StubResponse(object):
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.text = json.dumps(data)
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __contains__(self, item):
+        return item in self.text
+
+
+class StubHTTP(object):
+    """
+    Stands in for bitfinex_manager.http. Answers signed v1 requests from handlers by endpoint name.
+
+    :param handlers: a dict of endpoint name, i.e. 'orders', to handler(params) returning the json data
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.requests = 0
+
+    def post(self, url, headers=None, timeout=None, **kwargs):
+        self.requests += 1
+        params = json.loads(b64decode(headers['X-BFX-PAYLOAD']))
+        return StubResponse(self.handlers[url.split('/v1/')[-1]](params))
+
+
+def open_orders(count=ORDERS, symbol='btcusd'):
+    return [{'id': 1000000 + i, 'symbol': symbol, 'side': 'sell' if i % 2 else 'buy',
+             'price': "%.2f" % (400 + (i % 50) * 0.1), 'avg_execution_price': '0.0', 'type': 'exchange limit',
+             'timestamp': str(START + i), 'is_live': True, 'is_cancelled': False, 'was_forced': False,
+             'original_amount': '0.5', 'remaining_amount': '0.5', 'executed_amount': '0.0'}
+            for i in xrange(count)]
+
+
+def trade_history(count=TRADES):
+    """
+    :return: mytrades rows, newest first
+    """
+    return [{'tid': 5000000 + i, 'order_id': 1000000 + i, 'timestamp': str(START + i), 'price': '400.0',
+             'amount': '0.1', 'fee_amount': '-0.08', 'fee_currency': 'USD', 'type': 'Buy' if i % 2 else 'Sell'}
+            for i in reversed(xrange(count))]
+
+
+def mytrades(history, symbol='btcusd'):
+    """
+    :return: a mytrades handler paging through history like the exchange, by "until" and "limit_trades"
+    """
+    def handler(params):
+        if params['symbol'] != symbol:
+            return []
+        until = float(params.get('until', 'inf'))
+        return [row for row in history if float(row['timestamp']) < until][:int(params.get('limit_trades', 500))]
+    return handler
+
+
+def wallet_balances():
+    return [{'type': 'exchange', 'currency': c, 'amount': "%.8f" % (10 + i), 'available': "%.8f" % (5 + i)}
+            for i, c in enumerate(CURRENCIES)]
+
+
+class BenchUser(object):
+    """
+    Stands in for the manager user, which would otherwise be looked up in the user tables.
+    """
+    id = 1
+
+
+def bench_config():
+    cfg = RawConfigParser()
+    cfg.add_section('bitfinex')
+    cfg.set('bitfinex', 'live_pairs', '["BTC_USD"]')
+    cfg.set('bitfinex', 'session_recycle_units', '0')
+    cfg.set('bitfinex', 'binary_market_data', 'true')
+    return cfg
+
+
+def bench_plugin():
+    """
+    A Bitfinex plugin instance on an in-memory sqlite database and redis.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from trade_manager import em, wm
+    from bitfinex_sim import bare_plugin
+    plugin = bare_plugin('benchkey', 'benchsecret')
+    engine = create_engine('sqlite://')
+    for model in (em.Trade, em.LimitOrder, wm.Balance):
+        model.metadata.create_all(engine)
+    plugin.cfg = bench_config()
+    plugin.red = MemoryRedis()
+    plugin.session = sessionmaker(bind=engine)()
+    plugin._user = BenchUser()
+    # set by the constructor, which bare_plugin skips
+    plugin.active_currencies = [plugin.format_commodity(c) for c in CURRENCIES]
+    return plugin
+
+
+@contextmanager
+def stub_http(handlers):
+    """
+    Route the plugin's REST requests to a StubHTTP of handlers inside the with block.
+    """
+    import bitfinex_manager
+    http = bitfinex_manager.http
+    bitfinex_manager.http = StubHTTP(handlers)
+    try:
+        yield bitfinex_manager.http
+    finally:
+        bitfinex_manager.http = http
+
+
+def stubbed(handlers, call):
+    """
+    :return: call, sending the plugin's REST requests to a StubHTTP of handlers while it runs
+    """
+    def run():
+        with stub_http(handlers):
+            return call()
+    return run
+
+
+def setup_format_market(number):
+    from bitfinex_manager import Bitfinex
+    symbols = [Bitfinex.unformat_market(m) for m in MARKETS]
+    return lambda: [Bitfinex.format_market(s) for s in symbols]
+
+
+def setup_unformat_market(number):
+    from bitfinex_manager import Bitfinex
+    return lambda: [Bitfinex.unformat_market(m) for m in MARKETS]
+
+
+def setup_encode(number):
+    from bitfinex_sim import bare_plugin
+    plugin = bare_plugin('benchkey', 'benchsecret')
+    return lambda: plugin.bitfinex_encode({'request': '/v1/order/new', 'symbol': 'btcusd', 'amount': '0.5',
+                                           'price': '400.0', 'exchange': 'bitfinex', 'side': 'buy',
+                                           'type': 'exchange limit'})
+
+
+def setup_open_orders(insert):
+    """
+    :param insert: time the first reconciliation, which inserts every order, instead of a later one
+    """
+    def setup(number):
+        orders = open_orders()
+        handlers = {'orders': lambda params: orders}
+        plugin = bench_plugin()
+        if not insert:
+            stubbed(handlers, plugin.get_open_orders)()
+        return stubbed(handlers, plugin.get_open_orders)
+    return setup
+
+
+def setup_sync_trades(number):
+    return stubbed({'mytrades': mytrades(trade_history())}, bench_plugin().sync_trades)
+
+
+def setup_sync_balances(number):
+    plugin = bench_plugin()
+    sync = stubbed({'balances': lambda params: wallet_balances()}, lambda: plugin.sync_balances(force=True))
+    sync()  # time the updates, not the first inserts
+    return sync
+
+
+class BenchSocket(object):
+    pass
+
+
+def setup_listener(frame):
+    """
+    :param frame: frame(i) returns the i-th message of the kind to time
+    """
+    def setup(number):
+        import bitfinex_listener
+        from bitfinex_balances import BalanceCache
+        plugin = bench_plugin()
+        # the messages go through the root connection, as for the [bitfinex] account
+        bitfinex_listener.root.plugin = plugin
+        bitfinex_listener.root.red = plugin.red
+        bitfinex_listener.root.balance_cache = BalanceCache(plugin.red)
+        bitfinex_listener.root.channels = {}
+        bitfinex_listener.ready.set()
+        ws = BenchSocket()
+        for event in ({'event': 'subscribed', 'channel': 'ticker', 'chanId': 1, 'pair': 'BTCUSD'},
+                      {'event': 'subscribed', 'channel': 'trades', 'chanId': 2, 'pair': 'BTCUSD'},
+                      {'event': 'auth', 'status': 'OK', 'chanId': 0, 'userId': 1}):
+            bitfinex_listener.on_message(ws, json.dumps(event))
+        messages = iter([json.dumps(frame(i)) for i in xrange(number)])
+        return lambda: bitfinex_listener.on_message(ws, next(messages))
+    return setup
+
+
+def wallet(i):
+    return ['exchange', CURRENCIES[i % len(CURRENCIES)].upper(), 10 + i * 0.001, 0, 5 + i * 0.001]
+
+
+def account_trade(i):
+    """
+    :return: a "ts" row, a "tu" row has a SEQ in front of it
+    """
+    return [7000000 + i, 'BTCUSD', START + i, 1000000 + i, 0.1 if i % 2 else -0.1, 400.0, 'exchange limit',
+            400.0, -0.08, 'USD']
+
+
+def account_order(i, status='ACTIVE', amount=0.5):
+    return [1000000 + i, 'BTCUSD', amount, 0.5, 'EXCHANGE LIMIT', status, 400.0 + (i % 50) * 0.1, 0.0,
+            '2016-05-01T12:00:00Z', 0, 0, 0]
+
+
+FRAMES = [
+    ('hb', lambda i: [0, 'hb']),
+    ('ticker', lambda i: [1, 430.1 + i * 0.01, 5.0, 430.2, 6.0, 0.5, 0.001, 430.15, 12345.6, 441.0, 422.3]),
+    ('trades te', lambda i: [2, 'te', '%d-BTCUSD' % i, START + i, 430.15, 0.25]),
+    ('trades snapshot', lambda i: [2, [['%d-BTCUSD' % j, START + j, 430.15, 0.25] for j in range(i, i + 30)]]),
+    ('ws', lambda i: [0, 'ws', [wallet(i * 5 + j) for j in range(5)]]),
+    ('wu', lambda i: [0, 'wu', wallet(i)]),
+    ('ts', lambda i: [0, 'ts', [account_trade(i * 10 + j) for j in range(10)]]),
+    ('tu', lambda i: [0, 'tu', ['%d-BTCUSD' % (7000000 + i)] + account_trade(i)]),
+    ('os', lambda i: [0, 'os', [account_order(i * 10 + j) for j in range(10)]]),
+    ('on', lambda i: [0, 'on', account_order(i)]),
+    ('ou', lambda i: [0, 'ou', account_order(i, 'PARTIALLY FILLED at 400.0(0.25)', 0.25)]),
+    ('oc', lambda i: [0, 'oc', account_order(i, 'EXECUTED @ 400.0(0.5)', 0)]),
+]
+
+
+def cases():
+    """
+    :return: the benchmark cases, in the order they are run and reported
+    """
+    return [Case('format_market', setup_format_market, 2000),
+            Case('unformat_market', setup_unformat_market, 2000),
+            Case('bitfinex_encode', setup_encode, 2000),
+            Case('get_open_orders insert %d' % ORDERS, setup_open_orders(True)),
+            Case('get_open_orders %d' % ORDERS, setup_open_orders(False), 3),
+            Case('sync_trades %d' % TRADES, setup_sync_trades),
+            Case('sync_balances', setup_sync_balances, 50)] + \
+        [Case('on_message %s' % kind, setup_listener(frame), 20 if kind in ('ws', 'ts', 'os') else 200)
+         for kind, frame in FRAMES]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the plugin offline and check for regressions.')
+    parser.add_argument('--save', metavar='PATH', help='store the results as a json baseline')
+    parser.add_argument('--check', metavar='PATH', help='compare with a baseline and exit 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='percent slower than the baseline which counts as a regression')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='timed runs per case, the best is kept')
+    parser.add_argument('--only', help='run only the cases whose name contains this')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    results = run_cases(cases(), args.repeat, args.only, out=sys.stdout)
+    if args.save:
+        thresholds = None
+        try:
+            thresholds = load_baseline(args.save).get('thresholds')  # keep hand-tuned thresholds
+        except (IOError, ValueError):
+            pass
+        save_baseline(args.save, results, thresholds)
+        print "saved %d cases to %s" % (len(results), args.save)
+    if args.check:
+        rows = compare(load_baseline(args.check), results, args.threshold)
+        print "%-28s %12s %12s %8s" % ('', 'baseline us', 'us', 'change')
+        for name, base, now, change, regressed in rows:
+            print "%-28s %12.2f %12.2f %+7.1f%%%s" % (name, base * 1e6, now * 1e6, change,
+                                                    ' REGRESSION' if regressed else '')
+        regressions = [row[0] for row in rows if row[4]]
+        if regressions:
+            print "%d of %d cases regressed: %s" % (len(regressions), len(rows), ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
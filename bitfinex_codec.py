@@ -0,0 +1,176 @@
+"""
+Compact, versioned binary encoding of the market data published to redis.
+
+Tickers and book snapshots are fixed-layout little-endian structs. Prices and amounts are
+integers scaled by 1e8, and times are integer microseconds since the epoch.
+
+    header  <2sBB8sQ   magic 'BF', version, message type, market (i.e. 'BTC_USD', NUL padded, at most
+                       8 bytes), time
+    ticker  <6q        bid, ask, last, high, low, volume
+    book    <HH        bid levels, ask levels, followed by that many <2q (price, amount) levels,
+                       bids best first, then asks best first
+
+The JSON keys stay as they are; when enabled the binary form is published next to them under
+the same key with a '.bin' suffix. Consumers only need this module to decode.
+"""
+import json
+import struct
+import time
+import timeit
+
+MAGIC = 'BF'
+VERSION = 1
+TICKER = 1
+BOOK = 2
+SCALE = 100000000
+
+HEADER = struct.Struct('<2sBB8sQ')
+TICKER_BODY = struct.Struct('<6q')
+BOOK_COUNTS = struct.Struct('<HH')
+LEVEL = struct.Struct('<2q')
+MARKET_SIZE = 8
+
+
+class CodecError(ValueError):
+    pass
+
+
+def scale(value):
+    return int(round(float(value) * SCALE))
+
+
+def unscale(value):
+    return float(value) / SCALE
+
+
+def binary_key(key):
+    return key + '.bin'
+
+
+def _header(kind, market, when):
+    try:
+        market = str(market)  # market names from json are unicode, struct only packs str
+    except UnicodeError:
+        raise CodecError("market %r is not ascii" % market)
+    if len(market) > MARKET_SIZE:
+        # struct would silently cut it to a different market
+        raise CodecError("market %s is longer than %d bytes" % (market, MARKET_SIZE))
+    when = when if when is not None else time.time()
+    return HEADER.pack(MAGIC, VERSION, kind, market, int(when * 1e6))
+
+
+def encode_ticker(market, bid, ask, last, high, low, volume, when=None):
+    return _header(TICKER, market, when) + TICKER_BODY.pack(scale(bid), scale(ask), scale(last), scale(high),
+                                                            scale(low), scale(volume))
+
+
+def encode_book(market, bids, asks, when=None):
+    """
+    :param bids: (price, amount) pairs, best first
+    :param asks: (price, amount) pairs, best first
+    """
+    parts = [_header(BOOK, market, when), BOOK_COUNTS.pack(len(bids), len(asks))]
+    for price, amount in bids:
+        parts.append(LEVEL.pack(scale(price), scale(amount)))
+    for price, amount in asks:
+        parts.append(LEVEL.pack(scale(price), scale(amount)))
+    return ''.join(parts)
+
+
+def encode_rest_book(market, book, when=None):
+    """
+    Encode a v1 REST book response, {'bids': [{'price', 'amount', ...}], 'asks': [...]}.
+    """
+    return encode_book(market, [(l['price'], l['amount']) for l in book['bids']],
+                       [(l['price'], l['amount']) for l in book['asks']], when)
+
+
+def decode_header(data):
+    if len(data) < HEADER.size:
+        raise CodecError("message too short")
+    magic, version, kind, market, micros = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise CodecError("not a bitfinex market data message")
+    if version != VERSION:
+        raise CodecError("unsupported version %s" % version)
+    return kind, market.rstrip('\0'), micros / 1e6
+
+
+def decode_ticker(data):
+    kind, market, when = decode_header(data)
+    if kind != TICKER:
+        raise CodecError("not a ticker")
+    if len(data) < HEADER.size + TICKER_BODY.size:
+        raise CodecError("ticker truncated")
+    bid, ask, last, high, low, volume = TICKER_BODY.unpack_from(data, HEADER.size)
+    return {'market': market, 'exchange': 'bitfinex', 'time': when, 'bid': unscale(bid), 'ask': unscale(ask),
+            'last': unscale(last), 'high': unscale(high), 'low': unscale(low), 'volume': unscale(volume)}
+
+
+def decode_book(data):
+    kind, market, when = decode_header(data)
+    if kind != BOOK:
+        raise CodecError("not a book")
+    nbids, nasks = BOOK_COUNTS.unpack_from(data, HEADER.size)
+    offset = HEADER.size + BOOK_COUNTS.size
+    if len(data) < offset + (nbids + nasks) * LEVEL.size:
+        raise CodecError("book truncated")
+    levels = []
+    for i in xrange(nbids + nasks):
+        price, amount = LEVEL.unpack_from(data, offset + i * LEVEL.size)
+        levels.append((unscale(price), unscale(amount)))
+    return {'market': market, 'exchange': 'bitfinex', 'time': when, 'bids': levels[:nbids], 'asks': levels[nbids:]}
+
+
+def decode(data):
+    """
+    Decode any message by its type.
+    """
+    kind = decode_header(data)[0]
+    if kind == TICKER:
+        return decode_ticker(data)
+    elif kind == BOOK:
+        return decode_book(data)
+    raise CodecError("unknown message type %s" % kind)
+
+
+def benchmark(n=20000, levels=25):
+    """
+    Compare encode and decode cost and size of the JSON and binary forms.
+
+    :return: a dict of (seconds per message, bytes per message) for each form and operation
+    """
+    tick = {'bid': 430.12, 'ask': 430.25, 'last': 430.2, 'high': 441.0, 'low': 422.31, 'volume': 12345.6789,
+            'market': 'BTC_USD', 'exchange': 'bitfinex', 'time': '2016-05-01T12:00:00.000000Z'}
+    book = {'bids': [{'price': "%.2f" % (430 - i * 0.1), 'amount': "1.5", 'timestamp': "1462104000.0"}
+                     for i in range(levels)],
+            'asks': [{'price': "%.2f" % (430.2 + i * 0.1), 'amount': "2.25", 'timestamp': "1462104000.0"}
+                     for i in range(levels)]}
+    jtick = json.dumps(tick)
+    btick = encode_ticker('BTC_USD', tick['bid'], tick['ask'], tick['last'], tick['high'], tick['low'],
+                          tick['volume'])
+    jbook = json.dumps(book)
+    bbook = encode_rest_book('BTC_USD', book)
+
+    def per(func, count):
+        return timeit.timeit(func, number=count) / count
+    return {
+        'ticker json encode': (per(lambda: json.dumps(tick), n), len(jtick)),
+        'ticker json decode': (per(lambda: json.loads(jtick), n), len(jtick)),
+        'ticker binary encode': (per(lambda: encode_ticker('BTC_USD', tick['bid'], tick['ask'], tick['last'],
+                                                           tick['high'], tick['low'], tick['volume']), n),
+                                 len(btick)),
+        'ticker binary decode': (per(lambda: decode_ticker(btick), n), len(btick)),
+        'book json encode': (per(lambda: json.dumps(book), n // 10), len(jbook)),
+        'book json decode': (per(lambda: json.loads(jbook), n // 10), len(jbook)),
+        'book binary encode': (per(lambda: encode_rest_book('BTC_USD', book), n // 10), len(bbook)),
+        'book binary decode': (per(lambda: decode_book(bbook), n // 10), len(bbook)),
+    }
+
+
+def main():
+    results = benchmark()
+    print "%-22s %12s %8s" % ('', 'us/message', 'bytes')
+    for name in sorted(results):
+        cost, size = results[name]
+        print "%-22s %12.2f %8d" % (name, cost * 1e6, size)
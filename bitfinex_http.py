@@ -0,0 +1,263 @@
+"""
+Adaptive timeouts, hedged requests and circuit breaking for the Bitfinex REST endpoints.
+
+Latency is tracked per endpoint over a window of recent successful requests. Once enough samples
+are seen, the timeout of an endpoint follows its observed p99 instead of the fixed REQ_TIMEOUT.
+Idempotent public GETs (pubticker, book) are hedged: if the first request has not answered after
+the endpoint's p95, a second one is sent and whichever answers first wins.
+
+Requests which place orders keep the fixed timeout and are never hedged. An order request cut short
+on our side may still be placed by the exchange, and submitting it again would place it twice.
+
+A breaker per endpoint opens after consecutive failures and fails fast with CircuitOpen until a
+cool down has passed, then lets a single trial request through to probe the exchange again.
+"""
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+
+DEFAULT_TIMEOUT = 10  # seconds, used until an endpoint has MIN_SAMPLES
+MIN_TIMEOUT = 1.0
+MIN_SAMPLES = 20
+WINDOW = 200
+TIMEOUT_FACTOR = 3  # timeout = p99 * TIMEOUT_FACTOR
+HEDGE_PERCENTILE = 95
+FAILURE_THRESHOLD = 5
+RESET_AFTER = 30  # seconds an open breaker fails fast
+PLACES_ORDERS = frozenset(['/v1/order/new', '/v1/order/new/multi', '/v1/order/cancel/replace'])
+
+
+class CircuitOpen(IOError):
+    pass
+
+
+class LatencyWindow(object):
+    """
+    The latencies of the last size successful requests of an endpoint.
+    """
+
+    def __init__(self, size=WINDOW):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, pct):
+        with self.lock:
+            values = sorted(self.samples)
+        if len(values) == 0:
+            return None
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class CircuitBreaker(object):
+    """
+    closed -> open after threshold consecutive failures, open -> half-open after reset_after seconds,
+    half-open -> closed on a successful trial or back to open on a failed one.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_after=RESET_AFTER, clock=time.time):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if self.clock() - self.opened >= self.reset_after else 'open'
+
+    def allow(self):
+        """
+        :return: True if a request may be sent now
+        """
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = self.clock()
+            self.trial = False
+
+
+class Endpoint(object):
+    def __init__(self, name, breaker):
+        self.name = name
+        self.latency = LatencyWindow()
+        self.breaker = breaker
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+        self.rejected = 0
+
+
+class AdaptiveClient(object):
+    """
+    Sends requests through caller supplied functions of one argument, the timeout in seconds,
+    which return a response or raise on connection errors and timeouts.
+    """
+
+    def __init__(self, default_timeout=DEFAULT_TIMEOUT, min_timeout=MIN_TIMEOUT, clock=time.time,
+                 fixed=PLACES_ORDERS):
+        """
+        :param fixed: the endpoints which always get the default timeout and are never hedged
+        """
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.fixed = fixed
+        self.clock = clock
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def endpoint(self, name):
+        with self.lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = Endpoint(name, CircuitBreaker(clock=self.clock))
+            return self.endpoints[name]
+
+    def timeout(self, name):
+        endpoint = self.endpoint(name)
+        if name in self.fixed or len(endpoint.latency) < MIN_SAMPLES:
+            return self.default_timeout
+        return max(self.min_timeout, min(self.default_timeout, endpoint.latency.percentile(99) * TIMEOUT_FACTOR))
+
+    def hedge_delay(self, name):
+        """
+        :return: seconds to wait before hedging a request, or None while there are too few samples
+        """
+        endpoint = self.endpoint(name)
+        if name in self.fixed or len(endpoint.latency) < MIN_SAMPLES:
+            return None
+        return endpoint.latency.percentile(HEDGE_PERCENTILE)
+
+    def _send(self, endpoint, send, timeout, record=True):
+        """
+        :param record: whether to record the outcome in the latency window and breaker; hedged requests
+                       record only the outcome seen by the caller, so a losing slow copy does not count
+        """
+        started = time.time()
+        try:
+            response = send(timeout)
+        except Exception:
+            endpoint.failures += 1
+            if record:
+                endpoint.breaker.failure()
+            raise
+        if getattr(response, 'status_code', 200) >= 500:
+            endpoint.failures += 1
+            if record:
+                endpoint.breaker.failure()
+        elif record:
+            endpoint.latency.add(time.time() - started)
+            endpoint.breaker.success()
+        return response
+
+    def _admit(self, endpoint):
+        if not endpoint.breaker.allow():
+            endpoint.rejected += 1
+            raise CircuitOpen("bitfinex %s is failing, not sending requests for up to %ss" %
+                              (endpoint.name, endpoint.breaker.reset_after))
+        endpoint.requests += 1
+
+    def request(self, name, send):
+        """
+        Send one request with the endpoint's adaptive timeout.
+
+        :raises CircuitOpen: while the endpoint's breaker is open
+        """
+        endpoint = self.endpoint(name)
+        self._admit(endpoint)
+        return self._send(endpoint, send, self.timeout(name))
+
+    def hedged(self, name, send):
+        """
+        Send an idempotent request, and a second copy if the first has not answered after the p95 delay.
+
+        :return: the first response, or raises the last error if every copy failed
+        """
+        delay = self.hedge_delay(name)
+        if delay is None:
+            return self.request(name, send)
+        endpoint = self.endpoint(name)
+        self._admit(endpoint)
+        timeout = self.timeout(name)
+        results = Queue()
+        started = time.time()
+
+        def attempt(copy):
+            try:
+                results.put((copy, True, self._send(endpoint, send, timeout, record=False)))
+            except Exception as e:
+                results.put((copy, False, e))
+
+        def start(copy):
+            thread = threading.Thread(target=attempt, args=(copy,))
+            thread.daemon = True
+            thread.start()
+
+        start(0)
+        sent = 1
+        try:
+            result = results.get(timeout=delay)
+        except Empty:
+            result = None
+            if endpoint.breaker.allow():
+                endpoint.hedges += 1
+                start(1)
+                sent = 2
+        error = None
+        for i in range(sent):
+            if result is None:
+                try:
+                    result = results.get(timeout=timeout + delay)
+                except Empty:
+                    break
+            copy, ok, value = result
+            if ok:
+                if getattr(value, 'status_code', 200) >= 500:
+                    endpoint.breaker.failure()
+                else:
+                    endpoint.latency.add(time.time() - started)
+                    endpoint.breaker.success()
+                if copy == 1:
+                    endpoint.hedge_wins += 1
+                return value
+            error = value
+            result = None
+        endpoint.breaker.failure()
+        raise error if error is not None else IOError("bitfinex %s timed out after %ss" % (name, timeout))
+
+    def stats(self):
+        """
+        :return: a dict of per-endpoint latency percentiles, timeouts and counters
+        """
+        return dict((name, {'p50': e.latency.percentile(50), 'p95': e.latency.percentile(95),
+                            'p99': e.latency.percentile(99), 'timeout': self.timeout(name),
+                            'requests': e.requests, 'hedges': e.hedges, 'hedge_wins': e.hedge_wins,
+                            'failures': e.failures, 'rejected': e.rejected, 'breaker': e.breaker.state})
+                    for name, e in self.endpoints.items())
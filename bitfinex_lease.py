@@ -0,0 +1,141 @@
+"""
+Redis lease coordination between several Bitfinex manager instances.
+
+Each instance registers itself as a live node and claims sync tasks (i.e. 'trades|BTC_USD',
+'movements|BTC', 'balances', 'orders') with expiring leases. An instance only claims up to its fair
+share of the tasks, so sync load spreads across the live nodes, and a task fails over to another
+node once the lease of a dead owner expires. Order submission is guarded by a lease per order,
+so an order is never submitted by two instances.
+"""
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_PREFIX = 'bitfinex_lease|'
+NODES_KEY = 'bitfinex_nodes'
+DEFAULT_TTL = 120  # seconds, must exceed the longest sync run
+ORDER_TTL = 86400
+
+# only touch the lease if this node still holds it
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def node_id():
+    return "%s:%s:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaseManager(object):
+    """
+    Leases held by one node.
+
+    :param tasks: the number of shardable tasks, used to work out this node's fair share
+    """
+
+    def __init__(self, red, node=None, ttl=DEFAULT_TTL, tasks=0):
+        self.red = red
+        self.node = node or node_id()
+        self.ttl = ttl
+        self.tasks = tasks
+        self.held = set()
+        self.stopped = threading.Event()
+        self._renew = red.register_script(RENEW_SCRIPT)
+        self._release = red.register_script(RELEASE_SCRIPT)
+
+    def heartbeat(self):
+        """
+        Register this node as live and drop nodes which have missed a whole lease period.
+
+        :return: the number of live nodes
+        """
+        now = time.time()
+        self.red.zadd(NODES_KEY, **{self.node: now})
+        self.red.zremrangebyscore(NODES_KEY, '-inf', now - self.ttl)
+        return max(1, self.red.zcard(NODES_KEY))
+
+    def run_heartbeat(self, interval=None):
+        """
+        Keep this node registered as live, however long the intervals between its claims are.
+        """
+        interval = interval if interval is not None else self.ttl / 3.0
+        while not self.stopped.wait(interval):
+            try:
+                self.heartbeat()
+            except Exception:
+                pass  # redis is unreachable, the next claim reports it
+
+    def start_heartbeat(self, interval=None):
+        thread = threading.Thread(target=self.run_heartbeat, args=(interval,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def share(self, nodes):
+        return int(math.ceil(float(self.tasks) / nodes)) if self.tasks > 0 else 1
+
+    def acquire(self, task, ttl=None):
+        key = LEASE_PREFIX + task
+        if self.red.set(key, self.node, nx=True, px=int((ttl or self.ttl) * 1000)) or self.red.get(key) == self.node:
+            self.held.add(task)
+            return True
+        return False
+
+    def renew(self, task, ttl=None):
+        if self._renew(keys=[LEASE_PREFIX + task], args=[self.node, int((ttl or self.ttl) * 1000)]):
+            return True
+        self.held.discard(task)
+        return False
+
+    def release(self, task):
+        self._release(keys=[LEASE_PREFIX + task], args=[self.node])
+        self.held.discard(task)
+
+    def release_all(self):
+        self.stopped.set()
+        for task in list(self.held):
+            self.release(task)
+        self.red.zrem(NODES_KEY, self.node)
+
+    def claim_order(self, oid):
+        """
+        Claim the submission of one order. The lease is never released, it only expires long after submission.
+
+        :return: True if this node may submit the order
+        """
+        key = LEASE_PREFIX + 'order|%s' % oid
+        return bool(self.red.set(key, self.node, nx=True, ex=ORDER_TTL)) or self.red.get(key) == self.node
+
+    def claim(self, task):
+        """
+        Renew a lease this node holds, or acquire a free one if this node is under its fair share.
+        A held lease which expired since the last claim, as it does when the task runs less often than the ttl,
+        is acquired again if it is still free.
+
+        :return: True if this node owns the task and should run it now
+        """
+        nodes = self.heartbeat()
+        if task in self.held:
+            if self.renew(task):
+                if len(self.held) <= self.share(nodes):
+                    return True
+                # more nodes joined since, hand this task over
+                self.release(task)
+                return False
+            # renew dropped the expired lease from held
+        if len(self.held) >= self.share(nodes):
+            return False
+        return self.acquire(task)
@@ -1,6 +1,8 @@
 import json
 import datetime
 import isodate
+import logging
+import threading
 import websocket
 import thread
 import time
@@ -9,19 +11,129 @@ from alchemyjsonschema.dictify import datetime_rfc3339
 from tapp_config import setup_redis, get_config, setup_logging
 from trade_manager.plugin import get_active_markets
 # from sqlalchemy_models import wallet as wm
+from bitfinex_balances import BalanceCache
+from bitfinex_codec import CodecError, binary_key, encode_ticker
 from bitfinex_manager import bitfinex_sign, Bitfinex
+from bitfinex_scheduler import mark_activity
+from bitfinex_tape import TradeTapes
 
-red = setup_redis()
+WS_URL = "wss://api2.bitfinex.com:3000/ws"
 
-channels = {}
-bitfinex = Bitfinex()
-logger = setup_logging('bitfinex_listener', prefix="trademanager", cfg=bitfinex.cfg)
-bitfinex.setup_connections()
-bitfinex.setup_logger()  # will be actually use the logger above
+tapes = TradeTapes()
+
+
+class Connection(object):
+    """
+    The account behind one websocket: its plugin, redis, balance cache and subscribed channels.
+    """
+
+    def __init__(self, plugin=None, red=None, public=True):
+        self.plugin = plugin
+        self.red = red
+        self.balance_cache = BalanceCache(red) if red is not None else None
+        self.channels = {}
+        self.public = public  # whether to subscribe to the ticker and trades channels
+
+
+# the [bitfinex] account, set up lazily by main, so importing this module has no side effects
+root = Connection()
+connections = {}  # websocket to Connection, for the further accounts of a multi-account process
+logger = logging.getLogger('bitfinex_listener')
+ready = threading.Event()  # set once redis and the database are connected, or failed to
+failed = threading.Event()  # set when connecting to redis or the database failed
+
+
+def connection(ws):
+    return connections.get(ws, root)
+
+
+def setup_plugin():
+    """
+    Load the plugin's config and credentials, which are needed before authenticating.
+    """
+    global logger
+    if root.plugin is None:
+        root.plugin = Bitfinex()
+        logger = setup_logging('bitfinex_listener', prefix="trademanager", cfg=root.plugin.cfg)
+    return root.plugin
+
+
+def setup_connections():
+    """
+    Connect to redis and the database. This is the slow part of startup.
+    """
+    try:
+        setup_plugin()
+        root.red = setup_redis()
+        root.balance_cache = BalanceCache(root.red)
+        root.plugin.setup_connections()
+        root.plugin.setup_logger()  # will be actually use the logger above
+    except Exception as e:
+        logger.exception(e)
+        failed.set()
+    finally:
+        ready.set()
+
+
+def start_connections():
+    """
+    Warm up the redis and database connections in the background, while the websocket connects and subscribes.
+    """
+    connector = threading.Thread(target=setup_connections)
+    connector.daemon = True
+    connector.start()
+    return connector
+
+
+def wait_for_connections():
+    ready.wait()
+    if failed.is_set() or root.red is None or getattr(root.plugin, 'session', None) is None:
+        raise RuntimeError("bitfinex listener connections failed to start")
+
+
+def close_if_failed(ws):
+    """
+    Close the websocket once the connections failed to start, so the listener exits instead of failing on
+    every frame.
+
+    :return: True if it was closed
+    """
+    if not failed.is_set():
+        return False
+    logger.error("bitfinex listener connections failed to start, closing the websocket")
+    ws.close()
+    return True
+
+
+def flush_balances(conn):
+    """
+    Write debounced wallet changes of a connection's account to the database.
+    """
+    if not conn.balance_cache.due():
+        return
+    for currency, total, available in conn.balance_cache.drain():
+        conn.plugin.update_balance(currency, total, available, "")
+    try:
+        conn.plugin.session.commit()
+    except Exception as e:
+        logger.exception(e)
+        conn.plugin.session.rollback()
+        conn.plugin.session.flush()
 
 
 def on_message(ws, message):
+    if close_if_failed(ws):
+        return
+    conn = connection(ws)
+    channels = conn.channels
     if '"hb"' in message:
+        if ready.is_set() and conn.balance_cache is not None:
+            # only the account channel, once authenticated, says the wallet events are still arriving
+            if channels.get(str(json.loads(message)[0]), {}).get("channel") == "account":
+                conn.balance_cache.alive()
+            if conn.balance_cache.due():
+                conn.plugin.begin_unit()
+                flush_balances(conn)
         return
     mess = json.loads(message)
     if isinstance(mess, dict) and "event" in mess:
@@ -30,6 +142,10 @@ def on_message(ws, message):
                 market = ("%s_%s" % (mess["pair"][:3], mess["pair"][3:])).replace("DRK", "DASH")
                 channels[str(mess["chanId"])] = {"channel": mess["channel"], "market": market}
                 logger.info("subscribed to %s channel %s" % (mess["channel"], mess["chanId"]))
+            elif mess["channel"] == "trades":
+                market = ("%s_%s" % (mess["pair"][:3], mess["pair"][3:])).replace("DRK", "DASH")
+                channels[str(mess["chanId"])] = {"channel": mess["channel"], "market": market}
+                logger.info("subscribed to %s channel %s" % (mess["channel"], mess["chanId"]))
         elif mess["event"] == "auth":
             if mess["status"] == "FAIL":
                 logger.exception("ERROR: auth failed")
@@ -39,6 +155,10 @@ def on_message(ws, message):
     elif isinstance(mess, list) and len(mess) > 0:
         mchan = str(mess[0])
         if mchan in channels:
+            ready.wait()
+            if close_if_failed(ws):
+                return
+            red, bitfinex, balance_cache = conn.red, conn.plugin, conn.balance_cache
             if channels[mchan]["channel"] == "ticker":
                 bid = mess[1]
                 # bid_size = mess[2]
@@ -54,28 +174,46 @@ def on_message(ws, message):
                          'market': channels[mchan]['market'], 'exchange': 'bitfinex',
                          'time': datetime_rfc3339(datetime.datetime.utcnow())}
                 red.set('bitfinex_%s_ticker' % channels[mchan]["market"], json.dumps(jtick))
+                if bitfinex.binary_market_data:
+                    try:
+                        red.set(binary_key('bitfinex_%s_ticker' % channels[mchan]["market"]),
+                                encode_ticker(channels[mchan]["market"], bid, ask, last, high, low, volume))
+                    except CodecError as e:
+                        logger.warning("not publishing the binary %s ticker: %s" % (channels[mchan]['market'], e))
                 logger.debug("set bitfinex %s ticker %s" % (channels[mchan]['market'], jtick))
+            elif channels[mchan]["channel"] == "trades":
+                if isinstance(mess[1], list):  # snapshot of [seq, timestamp, price, amount]
+                    tapes.on_snapshot(channels[mchan]['market'], mess[1])
+                elif mess[1] == "te":  # [chanId, 'te', seq, timestamp, price, amount]
+                    tapes.on_execution(channels[mchan]['market'], mess[3], mess[4], mess[5])
+                # 'tu' repeats a 'te' print with the trade id added, so it is skipped
             elif channels[mchan]["channel"] == "account":
+                bitfinex.begin_unit()
+                balance_cache.alive()
                 subchan = mess[1]
                 logger.info("subchan %s" % subchan)
                 changed = False
-                if subchan == "ws":  # wallet update
-                    for wallet in mess[2]:
+                if subchan in ("ws", "wu"):  # wallet snapshot or update
+                    for wallet in (mess[2] if subchan == "ws" else [mess[2]]):
                         wname = wallet[0]
-                        wcomm = wallet[1]
+                        wcomm = bitfinex.format_commodity(wallet[1])
                         wbal = wallet[2]
                         # w_interest_unsettled = wallet[3]
-                        # available = '?'
+                        wavailable = wallet[4] if len(wallet) > 4 else None
                         if wname == 'exchange':
-                            changed = True
-                            bitfinex.update_balance(wcomm, wbal, None, "")
-                elif subchan == "ts":  # trade update
-                    for trade in mess[2]:
+                            if balance_cache.update(wcomm, wbal, wavailable):
+                                mark_activity(red, 'wallet')
+                    flush_balances(conn)
+                elif subchan in ("ts", "tu"):  # trade snapshot or update
+                    mark_activity(red, 'trades')
+                    # a "ts" row is [ID, PAIR, MTS, ORD_ID, AMOUNT, PRICE, ORD_TYPE, ORD_PRICE, FEE, FEE_CURRENCY],
+                    # a "tu" row has the same fields after a leading SEQ
+                    for trade in (mess[2] if subchan == "ts" else [mess[2][1:]]):
                         logger.debug("trade details {0}".format(trade))
                         tid = str(trade[0])
                         tpair = "%s_%s" % (trade[1][:3], trade[1][3:])
                         ttime = datetime.datetime.fromtimestamp(float(trade[2]))
-                        # tord_id = str(trade[3])
+                        tord_id = str(trade[3])
                         tamtexec = float(trade[4])
                         tside = 'buy' if tamtexec > 0 else 'sell'
                         # tpriceexec = trade[5]
@@ -91,9 +229,12 @@ def on_message(ws, message):
                                                    amount=abs(tamtexec), fee=abs(tfee), fee_side=fee_side, dtime=ttime)
                         if trade is not None:
                             changed = True
-                elif "os" in subchan:  # order update
+                        if subchan == "tu":  # snapshot rows are history, not fills seen live
+                            bitfinex.tracer.stamp(tord_id, 'fill', tpair.replace("DRK", "DASH"))
+                elif subchan in ("os", "on", "ou", "oc"):  # order snapshot or update
+                    mark_activity(red, 'orders')
                     # logger.debug("order update %s" % message)
-                    for order in mess[2]:
+                    for order in (mess[2] if subchan == "os" else [mess[2]]):
                         logger.debug("order details %s" % mess[2])
                         oid = str(order[0])
                         opair = ("%s_%s" % (order[1][:3], order[1][3:])).replace("DRK", "DASH")
@@ -106,6 +247,8 @@ def on_message(ws, message):
                         ostate = 'closed' if ostatus == 'CANCELED' or \
                                  'EXECUTED' in ostatus and oamount == 0 else 'open'
                         oprice = order[6]
+                        if subchan != "os":
+                            bitfinex.tracer.stamp(oid, 'listed', opair)
                         # oprice_avg = order[7]
                         ocreated = isodate.parse_datetime(order[8])
                         # onotify = order[9]
@@ -119,10 +262,12 @@ def on_message(ws, message):
                 if changed:
                     try:
                         logger.info("commit %s" % bitfinex.session.commit())
+                        bitfinex.checkpoint_positions()
                     except Exception as e:
                         logger.exception(e)
                         bitfinex.session.rollback()
                         bitfinex.session.flush()
+                        bitfinex.reset_positions()
 
 
 def on_error(ws, error):
@@ -134,31 +279,54 @@ def on_close(ws):
 
 
 def on_open(ws):
+    conn = connection(ws)
+
     def run(*args):
-        # subscribe to tickers
-        markets = get_active_markets('bitfinex')
-        for market in markets:
-            ws.send(json.dumps({"event": "subscribe", "channel": "ticker", "pair": market.replace("_", "")}))
+        if conn.public:
+            # subscribe to tickers and public trades
+            markets = get_active_markets('bitfinex')
+            for market in markets:
+                ws.send(json.dumps({"event": "subscribe", "channel": "ticker", "pair": market.replace("_", "")}))
+                ws.send(json.dumps({"event": "subscribe", "channel": "trades", "pair": market.replace("_", "")}))
         # subscribe to balances
         payload = "AUTH"+str(time.time())
-        headers = bitfinex_sign(key=bitfinex.key, secret=bitfinex.secret, msg=payload)
-        ws.send(json.dumps({"event": "auth", "apiKey": bitfinex.key, "authSig": headers['X-BFX-SIGNATURE'],
+        headers = bitfinex_sign(key=conn.plugin.key, secret=conn.plugin.secret, msg=payload)
+        ws.send(json.dumps({"event": "auth", "apiKey": conn.plugin.key, "authSig": headers['X-BFX-SIGNATURE'],
                             "authPayload": payload}))
-        while True:
-            time.sleep(0.1)
-        # time.sleep(1)
-        # ws.close()
-        # print "thread terminating..."
+        # the thread ends once subscribed, rather than idling for the life of every account's socket
     thread.start_new_thread(run, ())
 
 
-def main():
-    ws = websocket.WebSocketApp("wss://api2.bitfinex.com:3000/ws",
-                                on_message=on_message,
-                                on_error=on_error,
-                                on_close=on_close)
+def attach(ws, plugin=None):
+    """
+    Set the listener's callbacks on a websocket.
+
+    :param plugin: the account context of another account to listen for, instead of the root account.
+                   Only the root account subscribes to market data.
+    """
+    if plugin is not None:
+        connections[ws] = Connection(plugin, plugin.red, public=False)
+    ws.on_message = on_message
+    ws.on_error = on_error
+    ws.on_close = on_close
     ws.on_open = on_open
-    ws.run_forever()
+    return ws
+
+
+def main(ws=None):
+    """
+    Run the listener. The websocket connects and subscribes while redis and the database warm up.
+
+    :param ws: a websocket.WebSocketApp-like object to use instead of connecting to WS_URL
+    """
+    setup_plugin()
+    if not ready.is_set():
+        start_connections()
+    if ws is None:
+        ws = websocket.WebSocketApp(WS_URL)
+    attach(ws).run_forever()
+    if failed.is_set():
+        raise SystemExit("bitfinex listener connections failed to start")
 
 
 if __name__ == "__main__":
@@ -2,16 +2,31 @@
 Plugin for managing a Bitfinex account.
 This module can be imported by trade_manager and used like a plugin.
 """
+import copy
 import datetime
+import functools
 import hmac
 import json
 import requests
+import threading
 import time
 from base64 import b64encode
 from hashlib import sha384
+from bitfinex_accounts import AccountConfig, AccountRedis
+from bitfinex_codec import CodecError, binary_key, encode_rest_book, encode_ticker
+from bitfinex_http import AdaptiveClient, CircuitOpen
+from bitfinex_balances import mark_rest_checked, publish_balances, read_balances, rest_check_due
+from bitfinex_lease import LeaseManager
+from bitfinex_positions import LockTimeout, PositionTracker, record, update_checkpoint
+from bitfinex_retry import RetryQueue
+from bitfinex_schema import audit_schema
+from bitfinex_session import RECYCLE_UNITS, SessionLifecycle, unit_of_work
+from bitfinex_scheduler import Scheduler
+from bitfinex_trace import Tracer
 from ledger import Amount, Balance
 from requests.exceptions import Timeout, ConnectionError
 from sqlalchemy import update
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy_models import jsonify2
 from trade_manager import em, wm
 from trade_manager.plugin import ExchangePluginBase, get_order_by_order_id, submit_order, get_orders
@@ -20,6 +35,18 @@ NAME = 'bitfinex'
 
 BASE_URL = "https://api.bitfinex.com"
 REQ_TIMEOUT = 10  # seconds
+HTTP_POOL_SIZE = 20  # keep-alive connections per host, shared by every instance and account in the process
+
+MOVEMENTS_COALESCE = 10  # seconds a sync_movements result is reused
+EMPTY_MOVEMENTS_RECHECK = 86400  # seconds before a currency without movements is checked again
+MOVEMENT_FLAGS_KEY = 'bitfinex_movement_currencies'
+
+_nonce_lock = threading.Lock()
+_schema_audited = threading.Event()  # the schema is audited once per process, not by every instance
+rest_client = AdaptiveClient(REQ_TIMEOUT)  # latency, timeouts and breakers per endpoint, shared by all instances
+http = requests.Session()
+for _scheme in ('https://', 'http://'):
+    http.mount(_scheme, requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE))
 
 
 def bitfinex_sign(key, secret, msg):
@@ -34,13 +61,38 @@ def bitfinex_sign(key, secret, msg):
 class Bitfinex(ExchangePluginBase):
     NAME = 'bitfinex'
     _user = None
+    _positions = None
+    _pending_trades = None  # TradeRecords of trades inserted since the last checkpoint
+    _last_nonce = 0
+    _leases = None
+    _tracer = None
+    _last_ticks = None
+    _movements_synced = None  # (time, result) of the last sync_movements
+    _sessions = None
+    _retries = None
+    _lifecycle = None
+    _unit_depth = 0
+    account = None  # the name of a further account in a multi-account process, None for the [bitfinex] account
+
+    def next_nonce(self):
+        """
+        A strictly increasing nonce, even when several threads sign requests in the same microsecond.
+        """
+        with _nonce_lock:
+            nonce = max(int(time.time() * 1e6), self._last_nonce + 1)
+            self._last_nonce = nonce
+        return nonce
 
     def bitfinex_encode(self, msg):
-        msg['nonce'] = str(int(time.time() * 1e6))
+        msg['nonce'] = str(self.next_nonce())
         msg = b64encode(json.dumps(msg))
         return bitfinex_sign(self.key, self.secret, msg)
 
     def bitfinex_request(self, endpoint, params=None):
+        """
+        :return: the response, or None on a connection error or timeout
+        :raises CircuitOpen: while the endpoint is failing, without sending the request
+        """
         if "/v1/" not in endpoint:
             endpoint = "/v1/%s" % endpoint
         params = params or {}
@@ -48,17 +100,129 @@ class Bitfinex(ExchangePluginBase):
         headers = self.bitfinex_encode(params)
         response = None
         try:
-            response = requests.post(url=BASE_URL + params['request'],
-                                     headers=headers,
-                                     timeout=REQ_TIMEOUT)
+            response = rest_client.request(endpoint, lambda timeout: http.post(url=BASE_URL + params['request'],
+                                                                                   headers=headers,
+                                                                                   timeout=timeout))
             if "Nonce is too small." in response:
                 response = None
         except (ConnectionError, Timeout) as e:
             self.logger.exception(
                 '%s %s while sending %r to bitfinex %s, response %s' % (type(e), e, params, endpoint, response))
             return
+        except CircuitOpen as e:
+            self.logger.warning('not sending %s to bitfinex: %s' % (endpoint, e))
+            raise
         return response
 
+    def setup_connections(self):
+        """
+        Connect to redis and the database, and audit the database indexes the plugin relies on once per process,
+        unless disabled with "schema_audit: false" in the bitfinex config section.
+        """
+        super(Bitfinex, self).setup_connections()
+        enabled = not self.cfg.has_option('bitfinex', 'schema_audit') or self.cfg.getboolean('bitfinex', 'schema_audit')
+        if enabled and not _schema_audited.is_set():
+            _schema_audited.set()
+            audit_schema(self.session, self.logger)
+
+    @property
+    def coordinated(self):
+        """
+        Whether sync tasks and order submission are coordinated with other instances through redis leases.
+        Enable with "coordinate: true" in the bitfinex config section.
+        """
+        return self.cfg.has_option('bitfinex', 'coordinate') and self.cfg.getboolean('bitfinex', 'coordinate')
+
+    @property
+    def leases(self):
+        if self._leases is None:
+            ttl = self.cfg.getint('bitfinex', 'lease_ttl') if self.cfg.has_option('bitfinex', 'lease_ttl') else 120
+            tasks = len(self.trade_markets()) + len(self.movement_currencies()) + 2  # balances and orders
+            self._leases = LeaseManager(self.red, ttl=ttl, tasks=tasks).start_heartbeat()
+        return self._leases
+
+    @property
+    def retries(self):
+        """
+        The delayed retries of orders which are not visible in the database yet.
+        """
+        if self._retries is None:
+            self._retries = RetryQueue(lambda oid, expire: submit_order('bitfinex', oid, expire=expire),
+                                       red=self.red, logger=self.logger).start()
+        return self._retries
+
+    @property
+    def tracer(self):
+        if self._tracer is None:
+            self._tracer = Tracer(self.red)
+        return self._tracer
+
+    @property
+    def lifecycle(self):
+        """
+        The session lifecycle, or None if disabled with "session_recycle_units: 0" in the bitfinex config section.
+        """
+        if self._lifecycle is None:
+            every = self.cfg.getint('bitfinex', 'session_recycle_units') \
+                if self.cfg.has_option('bitfinex', 'session_recycle_units') else RECYCLE_UNITS
+            if every <= 0:
+                return None
+            max_rss = self.cfg.getint('bitfinex', 'session_max_rss_mb') * 1048576 \
+                if self.cfg.has_option('bitfinex', 'session_max_rss_mb') else None
+            self._lifecycle = SessionLifecycle(every, max_rss)
+        return self._lifecycle
+
+    def begin_unit(self):
+        """
+        Start a unit of work: a command, a scheduled sync or a listener message.
+        The objects loaded by the previous unit are dropped from the session, which is closed when due,
+        so the identity map stays bounded however long the process runs.
+        """
+        if self._unit_depth > 0 or getattr(self, 'session', None) is None or self.lifecycle is None:
+            return
+        if self.lifecycle.start_unit(self.session):
+            self._user = None  # detached now, manager_user loads it again
+
+    def account_context(self, name, credentials):
+        """
+        A plugin instance for another account, with its own credentials, nonce, session and manager_user,
+        sharing this instance's config, logger, database engine and redis client.
+
+        The public attributes this instance got from the constructor and setup_connections (active_currencies...)
+        are copied, containers included, so a context has them without reading the config again and cannot
+        change this instance's. The underscored caches (positions, leases, nonce...) start out empty.
+
+        :param credentials: a dict of the account's key, secret and userpubkey
+        """
+        if self._sessions is None:
+            self._sessions = sessionmaker(bind=self.session.get_bind())
+        context = self.__class__.__new__(self.__class__)
+        for attr, value in self.__dict__.items():
+            if not attr.startswith('_'):
+                setattr(context, attr, copy.copy(value) if isinstance(value, (list, dict, set)) else value)
+        context.account = name
+        context.cfg = AccountConfig(self.cfg, credentials)
+        context.key = credentials['key']
+        context.secret = credentials['secret']
+        context.logger = self.logger
+        context.red = AccountRedis(self.red, name)
+        context.session = self._sessions()
+        return context
+
+    def account_task(self, task):
+        """
+        :return: the name of a sync task or listener activity kind, qualified with the account if there is one
+        """
+        return task if self.account is None else '%s|%s' % (task, self.account)
+
+    def owns(self, task):
+        """
+        :return: True if this instance should run the sync task now.
+        """
+        if not self.coordinated:
+            return True
+        return self.leases.claim(task)
+
     @classmethod
     def format_market(cls, market):
         """
@@ -119,16 +283,38 @@ class Bitfinex(ExchangePluginBase):
         """
         return c.lower().replace('dash', 'drk')
 
+    @property
+    def binary_market_data(self):
+        """
+        Whether tickers and books are also published to redis in the compact binary encoding of bitfinex_codec.
+        Enable with "binary_market_data: true" in the bitfinex config section.
+        """
+        return self.cfg.has_option('bitfinex', 'binary_market_data') and \
+            self.cfg.getboolean('bitfinex', 'binary_market_data')
+
     @classmethod
     def sync_book(cls, market=None):
         exch_pair = cls.unformat_market(market)
-        return requests.get('%s/v1/book/%s' % (BASE_URL, exch_pair), timeout=REQ_TIMEOUT).json()
+        url = '%s/v1/book/%s' % (BASE_URL, exch_pair)
+        return rest_client.hedged('book', lambda timeout: http.get(url, timeout=timeout)).json()
+
+    def publish_book(self, market='BTC_USD'):
+        """
+        Fetch a book snapshot and publish it to redis in the binary encoding.
+        """
+        book = self.sync_book(market)
+        try:
+            self.red.set(binary_key('bitfinex_%s_book' % market), encode_rest_book(market, book))
+        except CodecError as e:
+            self.logger.warning('not publishing the %s book: %s' % (market, e))
+        return book
 
     def sync_ticker(self, market='BTC_USD'):
         exch_pair = self.unformat_market(market)
         try:
-            rawtick = requests.get(BASE_URL + '/v1/pubticker/%s' % exch_pair, timeout=REQ_TIMEOUT).json()
-        except (ConnectionError, Timeout, ValueError) as e:
+            url = BASE_URL + '/v1/pubticker/%s' % exch_pair
+            rawtick = rest_client.hedged('pubticker', lambda timeout: http.get(url, timeout=timeout)).json()
+        except (ConnectionError, Timeout, CircuitOpen, ValueError) as e:
             self.logger.exception(e)
             return
 
@@ -144,9 +330,27 @@ class Bitfinex(ExchangePluginBase):
         jtick = jsonify2(tick, 'Ticker')
         self.logger.debug("bitfinex %s json ticker %s" % (market, jtick))
         self.red.set('bitfinex_%s_ticker' % market, jtick)
+        if self.binary_market_data:
+            try:
+                self.red.set(binary_key('bitfinex_%s_ticker' % market),
+                             encode_ticker(market, rawtick['bid'], rawtick['ask'], rawtick['last_price'],
+                                           rawtick['high'], rawtick['low'], rawtick['volume']))
+            except CodecError as e:
+                self.logger.warning('not publishing the binary %s ticker: %s' % (market, e))
         return tick
 
-    def sync_balances(self):
+    @unit_of_work
+    def sync_balances(self, force=False):
+        """
+        Poll balances over REST. While the listener keeps the websocket balance cache live,
+        this only runs every balance_check_interval seconds as a consistency check, unless forced.
+        """
+        if not self.owns('balances'):
+            return
+        interval = self.cfg.getint('bitfinex', 'balance_check_interval') \
+            if self.cfg.has_option('bitfinex', 'balance_check_interval') else 300
+        if not force and not rest_check_due(self.red, interval):
+            return
         try:
             data = self.bitfinex_request('balances').json()
         except ValueError as e:
@@ -163,9 +367,15 @@ class Bitfinex(ExchangePluginBase):
             available = available + Amount("%s %s" % (bal['available'], comm))
         self.logger.debug("total balance: %s" % total)
         self.logger.debug("available balance: %s" % available)
+        cached = read_balances(self.red)
+        polled = {}
         bals = {}
         for amount in total:
             comm = str(amount.commodity)
+            polled[comm] = (amount.to_double(), available.commodity_amount(amount.commodity).to_double())
+            if comm in cached and abs(cached[comm][0] - polled[comm][0]) > 1e-8:
+                self.logger.warning("cached %s balance %s differs from REST balance %s" %
+                                    (comm, cached[comm][0], polled[comm][0]))
             bals[comm] = self.session.query(wm.Balance).filter(wm.Balance.user_id == self.manager_user.id) \
                 .filter(wm.Balance.currency == comm).one_or_none()
             if not bals[comm]:
@@ -182,15 +392,26 @@ class Bitfinex(ExchangePluginBase):
             self.logger.exception(e)
             self.session.rollback()
             self.session.flush()
+            return
+        publish_balances(self.red, polled)
+        mark_rest_checked(self.red)
+        return polled != cached
 
+    @unit_of_work
     def sync_orders(self):
+        if not self.owns('orders'):
+            return
         oorders = self.get_open_orders()
         dboorders = get_orders(exchange='bitfinex', state='open', session=self.session)
+        closed = 0
         for dbo in dboorders:
             if dbo not in oorders:
                 dbo.state = 'closed'
+                closed += 1
         self.session.commit()
+        return closed
 
+    @unit_of_work
     def cancel_order(self, oid=None, order_id=None, order=None):
         if order is None and oid is not None:
             order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
@@ -210,6 +431,7 @@ class Bitfinex(ExchangePluginBase):
                 self.session.rollback()
                 self.session.flush()
 
+    @unit_of_work
     def cancel_orders(self, oid=None, order_id=None, market=None, side=None, price=None):
         if market is None and side is None and oid is None and order_id is None:
             resp = self.bitfinex_request('order/cancel/all')
@@ -238,12 +460,24 @@ class Bitfinex(ExchangePluginBase):
                         continue
                 self.cancel_order(order=o)
 
+    @unit_of_work
     def create_order(self, oid, expire=None):
+        created = time.time()
         order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
         if not order:
-            self.logger.warning("unable to find order %s" % oid)
-            if expire is not None and expire < time.time():
-                submit_order('bitfinex', oid, expire=expire)  # back of the line!
+            if not (self.session.new or self.session.dirty or self.session.deleted):
+                # end the lookup's transaction, under repeatable read or snapshot isolation the next attempt
+                # would not see the row committed meanwhile
+                self.session.rollback()
+            if self.retries.retry(oid, expire):
+                self.logger.debug("order %s not visible yet, retrying" % oid)
+            else:
+                self.logger.warning("unable to find order %s before its deadline" % oid)
+            return
+        if self._retries is not None:
+            self._retries.found(oid)
+        if self.coordinated and not self.leases.claim_order(oid):
+            self.logger.info("order %s is being submitted by another instance" % oid)
             return
         market = self.unformat_market(order.market)
         amount = "{:0.5f}".format(order.amount.to_double()) if isinstance(order.amount, Amount) else float(order.amount)
@@ -268,6 +502,7 @@ class Bitfinex(ExchangePluginBase):
         else:
             order.order_id = 'bitfinex|%s' % resp['order_id']
             order.state = 'open'
+            self.tracer.stamp(resp['order_id'], 'ack', order.market, created=created)
             self.logger.debug("submitted order %s" % order)
             try:
                 self.session.commit()
@@ -277,6 +512,7 @@ class Bitfinex(ExchangePluginBase):
                 self.session.flush()
             return order
 
+    @unit_of_work
     def get_open_orders(self, market=None):
         try:
             rawos = self.bitfinex_request('orders').json()
@@ -337,9 +573,82 @@ class Bitfinex(ExchangePluginBase):
         except ValueError as e:
             self.logger.exception(e)
 
+    @property
+    def positions(self):
+        """
+        The position tracker, restored from its last checkpoint and caught up from the database.
+        """
+        if self._positions is None:
+            self._positions = PositionTracker.restore(self.red)
+            self._positions.catch_up(self.session, em.Trade)
+        return self._positions
+
+    def track_trades(self, trades):
+        """
+        Queue newly inserted trades for the positions. checkpoint_positions applies them once they are committed.
+        """
+        if self._pending_trades is None:
+            self._pending_trades = []
+        self._pending_trades.extend(record(t) for t in trades)
+
+    def rebuild_positions(self):
+        """
+        Recompute the positions from the full trade history and checkpoint them.
+        """
+        self._pending_trades = None
+        self._positions = update_checkpoint(self.red, self.session, em.Trade, rebuild=True)
+
+    def checkpoint_positions(self):
+        """
+        Apply the trades queued by track_trades to the shared checkpoint. Call after they are committed.
+        The listener, the manager and the scheduler each start from the latest checkpoint under a lock,
+        so none of them overwrites the trades another applied.
+        """
+        trades, self._pending_trades = self._pending_trades, None
+        if not trades:
+            return
+        try:
+            self._positions = update_checkpoint(self.red, self.session, em.Trade, trades)
+        except LockTimeout as e:
+            self.logger.warning("%s, applying %d trades at the next checkpoint" % (e, len(trades)))
+            self._pending_trades = trades + (self._pending_trades or [])
+
+    def reset_positions(self):
+        """
+        Drop the in-memory tracker and the queued trades, i.e. after a rollback,
+        so the positions are restored from the last checkpoint.
+        """
+        self._positions = None
+        self._pending_trades = None
+
+    def add_trade(self, *args, **kwargs):
+        trade = super(Bitfinex, self).add_trade(*args, **kwargs)
+        if trade is not None:
+            self.track_trades([trade])
+        return trade
+
+    def trade_markets(self):
+        return [m.replace('DRK', 'DASH') for m in json.loads(self.cfg.get('bitfinex', 'live_pairs')) +
+                ["DRK_BTC", "DRK_USD"]]
+
+    def trade_from_row(self, row, market):
+        """
+        :return: an em.Trade for a mytrades row.
+        """
+        dtime = datetime.datetime.fromtimestamp(float(row['timestamp']))
+        price = float(row['price'])
+        amount = abs(float(row['amount']))
+        fee = abs(float(row['fee_amount']))
+        fee_side = 'base' if row['fee_currency'].replace('DRK', 'DASH') == market.split("_")[0] else 'quote'
+        side = row['type'].lower()
+        return em.Trade(row['tid'], 'bitfinex', market, side, amount, price, fee, fee_side, dtime)
+
+    @unit_of_work
     def sync_trades(self, market=None, rescan=False):
-        for market in json.loads(self.cfg.get('bitfinex', 'live_pairs')) + ["DRK_BTC", "DRK_USD"]:
-            market = market.replace('DRK', 'DASH')
+        new_trades = []
+        for market in self.trade_markets():
+            if not self.owns('trades|%s' % market):
+                continue
             allknown = False
             end = time.time()
             while not allknown:
@@ -357,70 +666,190 @@ class Bitfinex(ExchangePluginBase):
                     allknown = False
                     if float(row['timestamp']) < end:
                         end = float(row['timestamp'])
-                    dtime = datetime.datetime.fromtimestamp(float(row['timestamp']))
-                    price = float(row['price'])
-                    amount = abs(float(row['amount']))
-                    fee = abs(float(row['fee_amount']))
-                    fee_side = 'base' if row['fee_currency'].replace('DRK', 'DASH') == market.split("_")[0] else 'quote'
-                    side = row['type'].lower()
-                    self.session.add(em.Trade(row['tid'], 'bitfinex', market, side,
-                                              amount, price, fee, fee_side, dtime))
+                    trade = self.trade_from_row(row, market)
+                    self.session.add(trade)
+                    new_trades.append(trade)
         self.session.commit()
+        self.track_trades(new_trades)
+        self.checkpoint_positions()
+        return len(new_trades)
 
+    def movement_currencies(self):
+        return set(self.active_currencies)
+
+    def movement_from_row(self, row):
+        """
+        :return: a wm.Debit or wm.Credit for a history/movements row, or None if it is neither.
+        """
+        rtype = row['type'].lower()
+        dtime = datetime.datetime.fromtimestamp(float(row['timestamp']))
+        asset = self.format_commodity(row['currency'])
+        amount = Amount("%s %s" % (row['amount'], asset))
+        if row['status'] == 'COMPLETED':
+            status = 'complete'
+        elif row['status'] == 'CANCELED':
+            status = 'canceled'
+        else:
+            status = 'unconfirmed'
+        if rtype == "withdrawal":
+            return wm.Debit(amount, 0, row['address'], asset, "bitfinex", status, "bitfinex",
+                            "bitfinex|%s" % row['id'],
+                            self.manager_user.id, dtime)
+        elif rtype == "deposit":
+            return wm.Credit(amount, row['address'], asset, "bitfinex", status, "bitfinex",
+                             "bitfinex|%s" % row['id'],
+                             self.manager_user.id, dtime)
+
+    def known_movements(self, ref_ids):
+        """
+        :return: the subset of ref_ids already recorded as a credit or debit
+        """
+        if len(ref_ids) == 0:
+            return set()
+        known = set(d[0] for d in self.session.query(wm.Debit.ref_id).filter(wm.Debit.ref_id.in_(ref_ids)))
+        known.update(c[0] for c in self.session.query(wm.Credit.ref_id).filter(wm.Credit.ref_id.in_(ref_ids)))
+        return known
+
+    def sync_currency_movements(self, cur):
+        """
+        Page back through one currency's deposits and withdrawals until reaching known history.
+
+        :return: ('seen' if the currency has movements, 'empty' if the exchange listed none, or None if a
+                 request failed, number of movements added)
+        """
+        seen = False
+        added = 0
+        end = time.time()
+        while True:
+            history = self.get_dw_history(cur, end=end)
+            if not isinstance(history, list):
+                # i.e. a rate limit or error message, which says nothing about whether there are movements
+                self.logger.warning("bitfinex %s movements not synced: %s" % (cur, history))
+                return ('seen' if seen else None), added
+            if len(history) == 0:
+                break
+            seen = True
+            rows = [row for row in history if row['status'] == 'COMPLETED']
+            known = self.known_movements(['bitfinex|%s' % row['id'] for row in rows])
+            new = [row for row in rows if 'bitfinex|%s' % row['id'] not in known]
+            if len(new) == 0:
+                break
+            for row in new:
+                movement = self.movement_from_row(row)
+                if movement is not None:
+                    self.session.add(movement)
+                    added += 1
+            end = min(float(row['timestamp']) for row in new)
+            self.session.commit()
+        return ('seen' if seen else 'empty'), added
+
+    def skip_movements(self, cur, flag, balances, now):
+        """
+        A currency which had no movements when last checked is skipped until EMPTY_MOVEMENTS_RECHECK passes,
+        unless the account now holds some of it.
+        """
+        if flag is None or not flag.startswith('empty|'):
+            return False
+        held = balances.get(self.format_commodity(cur), (0, None))[0]
+        return held == 0 and now - float(flag.split('|')[1]) < EMPTY_MOVEMENTS_RECHECK
+
+    def sync_movements(self, rescan=False):
+        """
+        Sync deposits and withdrawals of every currency in one pass. A repeated call within
+        MOVEMENTS_COALESCE seconds returns the previous result without touching the exchange.
+
+        :return: the number of credits and debits added
+        """
+        now = time.time()
+        if not rescan and self._movements_synced is not None and now - self._movements_synced[0] < MOVEMENTS_COALESCE:
+            return self._movements_synced[1]
+        flags = self.red.hgetall(MOVEMENT_FLAGS_KEY)
+        balances = read_balances(self.red)
+        added = 0
+        for cur in self.movement_currencies():
+            if not self.owns('movements|%s' % cur):
+                continue
+            if not rescan and self.skip_movements(cur, flags.get(cur), balances, now):
+                continue
+            found, count = self.sync_currency_movements(cur)
+            added += count
+            if found == 'seen' and flags.get(cur) != 'seen':
+                self.red.hset(MOVEMENT_FLAGS_KEY, cur, 'seen')
+            elif found == 'empty' and flags.get(cur) != 'seen':  # a currency once seen is always checked
+                self.red.hset(MOVEMENT_FLAGS_KEY, cur, 'empty|%d' % now)
+        self._movements_synced = (time.time(), added)
+        return added
+
+    @unit_of_work
     def sync_credits(self, rescan=False):
-        for cur in self.active_currencies.union(set(["DRK"])):
-            allknown = False
-            end = time.time()
-            while not allknown:
-                history = self.get_dw_history(cur, end=end)
-                if len(history) == 0:
-                    break
-                allknown = True
-                for row in history:
-                    if row['status'] != 'COMPLETED':
-                        continue
-                    rtype = row['type'].lower()
-                    found = 0
-                    if rtype == "withdrawal":
-                        found = self.session.query(wm.Debit) \
-                            .filter(wm.Debit.ref_id == 'bitfinex|%s' % row['id']) \
-                            .count()
-                    elif rtype == "deposit":
-                        found = self.session.query(wm.Credit) \
-                            .filter(wm.Credit.ref_id == 'bitfinex|%s' % row['id']) \
-                            .count()
-                    if found != 0:
-                        print "; %s already known" % row['id']
-                        continue
-                    allknown = False
-                    if float(row['timestamp']) < end:
-                        end = float(row['timestamp'])
-                    dtime = datetime.datetime.fromtimestamp(float(row['timestamp']))
-                    asset = self.format_commodity(row['currency'])
-                    amount = Amount("%s %s" % (row['amount'], asset))
-                    if row['status'] == 'COMPLETED':
-                        status = 'complete'
-                    elif row['status'] == 'CANCELED':
-                        status = 'canceled'
-                    else:
-                        status = 'unconfirmed'
-                    if rtype == "withdrawal":
-                        self.session.add(
-                            wm.Debit(amount, 0, row['address'], asset, "bitfinex", status, "bitfinex",
-                                     "bitfinex|%s" % row['id'],
-                                     self.manager_user.id, dtime))
-                    elif rtype == "deposit":
-                        self.session.add(wm.Credit(amount, row['address'], asset, "bitfinex", status, "bitfinex",
-                                                   "bitfinex|%s" % row['id'],
-                                                   self.manager_user.id, dtime))
-                self.session.commit()
+        return self.sync_movements(rescan)
 
     sync_debits = sync_credits
 
+    def sync_ticker_changed(self, market):
+        """
+        Sync a ticker for the scheduler.
+
+        :return: True if the last price moved since the previous sync
+        """
+        if self._last_ticks is None:
+            self._last_ticks = {}
+        tick = self.sync_ticker(market)
+        last = getattr(tick, 'last', None)
+        changed = last != self._last_ticks.get(market)
+        self._last_ticks[market] = last
+        return changed
+
+    def build_scheduler(self, scheduler=None, public=True, orders=True):
+        """
+        :param scheduler: a Scheduler to add this account's syncs to, i.e. one shared by several accounts
+        :param public: also poll the tickers, which are the same for every account
+        :param orders: also sync open orders
+        :return: a Scheduler polling every sync at an interval adapted to account activity
+        """
+        if scheduler is None:
+            scheduler = Scheduler(self.red, self.logger)
+        name = self.account_task
+        scheduler.add(name('balances'), self.sync_balances, 30, 600, activity=name('wallet'))
+        if orders:
+            scheduler.add(name('orders'), self.sync_orders, 5, 300, activity=name('orders'))
+        scheduler.add(name('trades'), self.sync_trades, 10, 900, activity=name('trades'))
+        scheduler.add(name('movements'), self.sync_credits, 60, 3600, activity=name('wallet'))
+        if not public:
+            return scheduler
+        for market in self.trade_markets():
+            scheduler.add('ticker|%s' % market, functools.partial(self.sync_ticker_changed, market), 5, 300)
+            if self.binary_market_data:
+                scheduler.add('book|%s' % market, functools.partial(self.publish_book, market), 5, 5)
+        return scheduler
+
+
+def start_scheduler():
+    """
+    Run the adaptive sync scheduler in a background thread, with its own plugin instance and session.
+    """
+    poller = Bitfinex()
+    poller.setup_connections()
+    stop = threading.Event()
+    thread = threading.Thread(target=poller.build_scheduler().run_forever, args=(stop,))
+    thread.daemon = True
+    thread.start()
+    return poller, stop
+
 
 def main():
     bitfinex = Bitfinex()
-    bitfinex.run()
+    poller = stop = None
+    if bitfinex.cfg.has_option('bitfinex', 'schedule') and bitfinex.cfg.getboolean('bitfinex', 'schedule'):
+        poller, stop = start_scheduler()
+    try:
+        bitfinex.run()
+    finally:
+        if stop is not None:
+            stop.set()
+        for plugin in (bitfinex, poller):
+            if plugin is not None and plugin._leases is not None:
+                plugin.leases.release_all()  # let other instances take over at once
 
 
 if __name__ == "__main__":
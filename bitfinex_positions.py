@@ -0,0 +1,326 @@
+"""
+Incremental position and PnL tracking for a Bitfinex account.
+
+Each market keeps its net position, average cost, realized PnL and fees, and is updated in O(1)
+as new trades are inserted. The tracker is checkpointed to redis so a restart only has to
+replay trades newer than the checkpoint.
+
+The listener, the manager and its scheduler all insert trades, and share the one checkpoint. Each
+applies the trades it inserted to the latest checkpoint under a redis lock, so none overwrites the
+trades another applied. Trades are recognised by id, so none is counted twice. Average cost and
+realized PnL depend on the order of the trades, so a late trade, i.e. one found by paging back
+through the history, has its market replayed from the database in time order.
+"""
+import argparse
+import calendar
+import datetime
+import json
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+CHECKPOINT_KEY = 'bitfinex_positions'
+LOCK_KEY = CHECKPOINT_KEY + '_lock'
+LOCK_TTL = 10000  # ms
+LOCK_WAIT = 5  # seconds to wait for another process's update
+CATCH_UP_WINDOW = 300  # seconds of trades before the newest which are re-read from the database
+EPSILON = 1e-9
+
+# the columns of an em.Trade the tracker needs, copied when it is inserted so applying it later needs no query
+TradeRecord = namedtuple('TradeRecord', ('trade_id', 'market', 'side', 'amount', 'price', 'fee', 'fee_side', 'time'))
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def to_float(value):
+    """
+    Trade columns may hold ledger Amounts or plain numbers.
+    """
+    if hasattr(value, 'to_double'):
+        return float(value.to_double())
+    return float(value)
+
+
+class Position(object):
+    """
+    Net position in the base commodity of a market, valued at average cost in the quote commodity.
+    Fees are tracked per side and not folded into the position or the PnL.
+    """
+    __slots__ = ('market', 'net', 'avg_cost', 'realized', 'fee_base', 'fee_quote', 'trades')
+
+    def __init__(self, market, net=0.0, avg_cost=0.0, realized=0.0, fee_base=0.0, fee_quote=0.0, trades=0):
+        self.market = market
+        self.net = net
+        self.avg_cost = avg_cost
+        self.realized = realized
+        self.fee_base = fee_base
+        self.fee_quote = fee_quote
+        self.trades = trades
+
+    def apply(self, side, amount, price, fee=0.0, fee_side='quote'):
+        signed = amount if side in ('buy', 'bid') else -amount
+        if self.net == 0 or (self.net > 0) == (signed > 0):
+            # opening or adding to a position
+            total = abs(self.net) + amount
+            self.avg_cost = (self.avg_cost * abs(self.net) + price * amount) / total
+            self.net += signed
+        else:
+            closed = min(amount, abs(self.net))
+            direction = 1 if self.net > 0 else -1
+            self.realized += (price - self.avg_cost) * closed * direction
+            self.net += signed
+            if abs(self.net) < EPSILON:
+                self.net = 0.0
+                self.avg_cost = 0.0
+            elif (self.net > 0) != (direction > 0):
+                # flipped through zero, the remainder opens at this price
+                self.avg_cost = price
+        if fee_side == 'base':
+            self.fee_base += fee
+        else:
+            self.fee_quote += fee
+        self.trades += 1
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def close_to(self, other, tolerance=1e-6):
+        for k in ('net', 'avg_cost', 'realized', 'fee_base', 'fee_quote'):
+            if abs(getattr(self, k) - getattr(other, k)) > tolerance:
+                return False
+        return self.trades == other.trades
+
+    def __repr__(self):
+        return "<Position %s net=%s avg_cost=%s realized=%s fee_base=%s fee_quote=%s trades=%s>" % (
+            self.market, self.net, self.avg_cost, self.realized, self.fee_base, self.fee_quote, self.trades)
+
+
+class PositionTracker(object):
+    """
+    Positions for every market of one account.
+
+    applied holds the ids and times of every trade applied from the since time on, so no trade is counted
+    twice whatever order trades arrive in. since trails the newest trade by window seconds, and catch_up
+    only re-reads the database from there. stale holds the markets which got a trade older than the newest
+    applied, catch_up replays them.
+    """
+
+    def __init__(self, window=CATCH_UP_WINDOW):
+        self.positions = {}
+        self.last_time = 0.0
+        self.since = 0.0
+        self.applied = {}
+        self.stale = set()
+        self.window = window
+
+    def __getitem__(self, market):
+        return self.positions[market]
+
+    def __iter__(self):
+        return iter(self.positions.values())
+
+    def get(self, market):
+        if market not in self.positions:
+            self.positions[market] = Position(market)
+        return self.positions[market]
+
+    def apply(self, market, tid, side, amount, price, fee=0.0, fee_side='quote', timestamp=None):
+        tid = str(tid)
+        if tid in self.applied:
+            return False
+        if timestamp is not None:
+            if timestamp < self.last_time:
+                self.stale.add(market)
+            self.last_time = max(self.last_time, timestamp)
+        self.applied[tid] = timestamp if timestamp is not None else self.last_time
+        self.get(market).apply(side, to_float(amount), to_float(price), abs(to_float(fee)), fee_side)
+        return True
+
+    def apply_trade(self, trade):
+        """
+        Apply an em.Trade row or a TradeRecord.
+        """
+        return self.apply(trade.market, trade.trade_id.split("|")[-1], trade.side, trade.amount, trade.price,
+                          trade.fee, trade.fee_side, timestamp=_epoch(trade.time))
+
+    def extend(self, trades):
+        """
+        Apply newly inserted trades in time order. Trades older than the newest applied are applied too, and
+        their markets left stale until catch_up replays them.
+
+        :return: the number of trades applied, leaving out those already applied
+        """
+        return len([t for t in sorted(trades, key=lambda t: t.time) if self.apply_trade(t)])
+
+    def prune(self):
+        """
+        Forget the ids of trades older than the window, which catch_up does not read again.
+        """
+        self.since = max(self.since, self.last_time - self.window)
+        self.applied = dict((tid, when) for tid, when in self.applied.items() if when >= self.since)
+
+    def dumps(self):
+        self.prune()
+        return json.dumps({'last_time': self.last_time,
+                           'since': self.since,
+                           'applied': self.applied,
+                           'stale': sorted(self.stale),
+                           'positions': [p.to_dict() for p in self.positions.values()]})
+
+    @classmethod
+    def loads(cls, data):
+        tracker = cls()
+        data = json.loads(data)
+        tracker.last_time = data['last_time']
+        if 'applied' in data:
+            tracker.since = data['since']
+            tracker.applied = data['applied']
+        else:  # a checkpoint from before trades were recognised by id, complete up to last_time
+            tracker.since = tracker.last_time
+            tracker.applied = dict((tid, tracker.last_time) for tid in data['last_tids'])
+        tracker.stale = set(data.get('stale', ()))
+        for p in data['positions']:
+            tracker.positions[p['market']] = Position(**p)
+        return tracker
+
+    def checkpoint(self, red):
+        red.set(CHECKPOINT_KEY, self.dumps())
+
+    @classmethod
+    def restore(cls, red):
+        """
+        Load the last checkpoint, or an empty tracker if there is none.
+        """
+        data = red.get(CHECKPOINT_KEY)
+        if data is None:
+            return cls()
+        return cls.loads(data)
+
+    def catch_up(self, session, trade_model, exchange='bitfinex'):
+        """
+        Apply the trades in the database from the since time on, leaving out those already applied, then
+        replay the stale markets.
+
+        :return: the number of trades applied.
+        """
+        query = session.query(trade_model).filter(trade_model.exchange == exchange)
+        if self.since > 0:
+            query = query.filter(trade_model.time >= _datetime(self.since))
+        applied = 0
+        for trade in query.order_by(trade_model.time):
+            if self.apply_trade(trade):
+                applied += 1
+        for market in sorted(self.stale):
+            self.replay(session, trade_model, market, exchange)
+        return applied
+
+    def replay(self, session, trade_model, market, exchange='bitfinex'):
+        """
+        Recompute the position of one market from its full trade history.
+        """
+        position = self.positions[market] = Position(market)
+        query = session.query(trade_model).filter(trade_model.exchange == exchange, trade_model.market == market)
+        for trade in query.order_by(trade_model.time):
+            when = _epoch(trade.time)
+            position.apply(trade.side, to_float(trade.amount), to_float(trade.price), abs(to_float(trade.fee)),
+                           trade.fee_side)
+            self.last_time = max(self.last_time, when)
+            if when >= self.since:
+                self.applied[trade.trade_id.split("|")[-1]] = when
+        self.stale.discard(market)
+
+
+def record(trade):
+    """
+    :return: a TradeRecord copy of an em.Trade
+    """
+    return TradeRecord(trade.trade_id, trade.market, trade.side, to_float(trade.amount), to_float(trade.price),
+                       to_float(trade.fee), trade.fee_side, trade.time)
+
+
+@contextmanager
+def checkpoint_lock(red, wait=LOCK_WAIT, ttl=LOCK_TTL):
+    """
+    Hold the lock on the checkpoint, so a read, update and write of it is not interleaved with another's.
+
+    :raises LockTimeout: if another process holds it for longer than wait seconds
+    """
+    token = uuid.uuid4().hex
+    deadline = time.time() + wait
+    while not red.set(LOCK_KEY, token, nx=True, px=ttl):
+        if time.time() > deadline:
+            raise LockTimeout("bitfinex positions checkpoint locked for more than %ss" % wait)
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        # not atomic, but the lock's ttl is far longer than an update
+        if red.get(LOCK_KEY) == token:
+            red.delete(LOCK_KEY)
+
+
+def update_checkpoint(red, session, trade_model, trades=(), rebuild=False, exchange='bitfinex'):
+    """
+    Apply committed trades to the latest checkpoint, catch up on the window from the database and write it back.
+
+    :param trades: the trades this process inserted, em.Trade rows or TradeRecords
+    :param rebuild: recompute the positions from the full trade history instead of the checkpoint
+    :return: the updated tracker
+    """
+    with checkpoint_lock(red):
+        tracker = PositionTracker() if rebuild else PositionTracker.restore(red)
+        tracker.extend(trades)
+        tracker.catch_up(session, trade_model, exchange)
+        tracker.checkpoint(red)
+    return tracker
+
+
+def _epoch(dtime):
+    if dtime.tzinfo is None:
+        # sync_trades and the listener store local naive times from datetime.fromtimestamp
+        return time.mktime(dtime.timetuple()) + dtime.microsecond / 1e6
+    return calendar.timegm(dtime.utctimetuple()) + dtime.microsecond / 1e6
+
+
+def _datetime(epoch):
+    return datetime.datetime.fromtimestamp(epoch)
+
+
+def verify(tracker, session, trade_model, exchange='bitfinex'):
+    """
+    Recompute every position from the full trade history and compare it with the tracker.
+
+    :return: a list of (market, tracked, recomputed) tuples for the markets which disagree.
+    """
+    full = PositionTracker()
+    full.catch_up(session, trade_model, exchange)
+    mismatched = []
+    for market in set(full.positions.keys()) | set(tracker.positions.keys()):
+        tracked = tracker.get(market)
+        recomputed = full.get(market)
+        if not tracked.close_to(recomputed):
+            mismatched.append((market, tracked, recomputed))
+    return mismatched
+
+
+def main():
+    from bitfinex_manager import Bitfinex
+    from trade_manager import em
+    parser = argparse.ArgumentParser(description='Show Bitfinex positions and PnL.')
+    parser.add_argument('--verify', action='store_true', help='cross-check against a full recomputation')
+    args = parser.parse_args()
+    bitfinex = Bitfinex()
+    bitfinex.setup_connections()
+    tracker = bitfinex.positions
+    for position in sorted(tracker, key=lambda p: p.market):
+        print position
+    if args.verify:
+        mismatched = verify(tracker, bitfinex.session, em.Trade)
+        for market, tracked, recomputed in mismatched:
+            print "MISMATCH %s tracked %s recomputed %s" % (market, tracked, recomputed)
+        if mismatched:
+            raise SystemExit(1)
+        print "positions verified"
@@ -0,0 +1,157 @@
+"""
+Delayed retries of orders which create_order cannot see in the database yet.
+
+An order command can arrive before the transaction which inserted the order row is committed.
+Instead of resubmitting the command at once, which spins until the row appears, the order waits
+in a heap ordered by due time, with a per-order exponential backoff and a deadline. A single
+thread sleeps until the earliest retry is due and resubmits it then.
+
+How often and how long orders wait for visibility is published to redis as json.
+"""
+import heapq
+import json
+import threading
+import time
+
+from bitfinex_http import LatencyWindow
+
+METRICS_KEY = 'bitfinex_order_retries'
+BASE_DELAY = 0.05  # seconds before the first retry
+MAX_DELAY = 2.0
+DEADLINE = 60  # seconds to wait for an order without an expire time
+
+
+class Pending(object):
+    __slots__ = ('oid', 'expire', 'first_seen', 'deadline', 'attempts')
+
+    def __init__(self, oid, expire, first_seen, deadline):
+        self.oid = oid
+        self.expire = expire
+        self.first_seen = first_seen
+        self.deadline = deadline
+        self.attempts = 0
+
+
+class RetryQueue(object):
+    """
+    :param submit: submit(oid, expire) puts an order command back on the plugin's queue
+    """
+
+    def __init__(self, submit, red=None, base_delay=BASE_DELAY, max_delay=MAX_DELAY, deadline=DEADLINE,
+                 logger=None, clock=time.time):
+        self.submit = submit
+        self.red = red
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.logger = logger
+        self.clock = clock
+        self.heap = []  # (due, seq, oid)
+        self.pending = {}  # oid to Pending
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.waits = LatencyWindow()
+        self.retries = 0
+        self.found_count = 0
+        self.gave_up = 0
+
+    def retry(self, oid, expire=None):
+        """
+        Schedule another attempt at an order which is not visible yet.
+
+        :param expire: the epoch time after which the order should not be submitted anymore
+        :return: False if the order's deadline has passed and it was dropped
+        """
+        now = self.clock()
+        with self.cond:
+            entry = self.pending.get(oid)
+            if entry is None:
+                entry = Pending(oid, expire, now,
+                                min(expire, now + self.deadline) if expire is not None else now + self.deadline)
+                self.pending[oid] = entry
+            delay = min(self.max_delay, self.base_delay * 2 ** entry.attempts)
+            expired = now + delay > entry.deadline
+            if expired:
+                del self.pending[oid]
+                self.gave_up += 1
+            else:
+                entry.attempts += 1
+                self.retries += 1
+                self.seq += 1
+                heapq.heappush(self.heap, (now + delay, self.seq, oid))
+                self.cond.notify()
+        if expired:
+            self.publish_metrics()
+        return not expired
+
+    def found(self, oid):
+        """
+        Record that an order became visible, if it had to wait.
+        """
+        with self.cond:
+            entry = self.pending.pop(oid, None)
+        if entry is not None:
+            self.found_count += 1
+            self.waits.add(self.clock() - entry.first_seen)
+            self.publish_metrics()
+
+    def pop_due(self):
+        """
+        :return: the (oid, expire) of every retry which is due now
+        """
+        now = self.clock()
+        due = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now:
+                oid = heapq.heappop(self.heap)[2]
+                if oid in self.pending:
+                    due.append((oid, self.pending[oid].expire))
+        return due
+
+    def next_due(self):
+        with self.cond:
+            return self.heap[0][0] if self.heap else None
+
+    def run_due(self):
+        """
+        Resubmit every retry which is due.
+
+        :return: the number of orders resubmitted
+        """
+        due = self.pop_due()
+        for oid, expire in due:
+            try:
+                self.submit(oid, expire)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.exception(e)
+        if len(due) > 0:
+            self.publish_metrics()
+        return len(due)
+
+    def run_forever(self, stop=None):
+        """
+        Sleep until the earliest retry is due, or a new one is scheduled, and resubmit it.
+        """
+        while stop is None or not stop.is_set():
+            with self.cond:
+                due = self.heap[0][0] if self.heap else None
+                wait = None if due is None else due - self.clock()
+                if wait is None or wait > 0:
+                    self.cond.wait(1.0 if wait is None else min(wait, 1.0))
+            self.run_due()
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def metrics(self):
+        return {'waiting': len(self.pending), 'retries': self.retries, 'found': self.found_count,
+                'gave_up': self.gave_up, 'wait_p50': self.waits.percentile(50),
+                'wait_p99': self.waits.percentile(99)}
+
+    def publish_metrics(self):
+        if self.red is not None:
+            self.red.set(METRICS_KEY, json.dumps(self.metrics()))
@@ -0,0 +1,138 @@
+"""
+Adaptive polling of the Bitfinex sync operations.
+
+Each sync runs on its own interval. The interval drops to its minimum whenever a run finds changes
+or the listener reports activity of the kind the sync covers, and doubles after every run which
+found nothing, up to its maximum. API usage therefore follows actual account activity.
+"""
+import json
+import time
+
+ACTIVITY_PREFIX = 'bitfinex_activity|'
+METRICS_KEY = 'bitfinex_scheduler'
+
+
+def mark_activity(red, kind, now=None):
+    """
+    Report activity seen by the listener, i.e. 'trades', 'orders' or 'wallet'.
+    """
+    red.set(ACTIVITY_PREFIX + kind, now if now is not None else time.time())
+
+
+class Schedule(object):
+    def __init__(self, name, func, min_interval, max_interval, activity=None):
+        self.name = name
+        self.func = func
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.activity = activity
+        self.interval = min_interval
+        self.next_run = 0
+        self.last_run = None
+        self.last_duration = None
+        self.runs = 0
+        self.changes = 0
+        self.errors = 0
+
+    @property
+    def activity_kinds(self):
+        if self.activity is None:
+            return ()
+        return self.activity if isinstance(self.activity, tuple) else (self.activity,)
+
+    def poke(self, now):
+        """
+        Run as soon as possible and poll quickly again afterwards.
+        """
+        self.interval = self.min_interval
+        self.next_run = min(self.next_run, now)
+
+    def finished(self, changed, now):
+        if changed:
+            self.changes += 1
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+        self.next_run = now + self.interval
+
+    def metrics(self, now):
+        return {'interval': self.interval, 'due_in': max(0, self.next_run - now), 'runs': self.runs,
+                'changes': self.changes, 'errors': self.errors, 'last_run': self.last_run,
+                'last_duration': self.last_duration}
+
+
+class Scheduler(object):
+    def __init__(self, red, logger=None, clock=time.time):
+        self.red = red
+        self.logger = logger
+        self.clock = clock
+        self.schedules = []
+
+    def add(self, name, func, min_interval, max_interval, activity=None):
+        """
+        :param func: the sync to run, returning a truthy value if it found changes
+        :param activity: the kind of listener activity which should trigger this sync early, or a tuple of kinds
+        """
+        schedule = Schedule(name, func, min_interval, max_interval, activity)
+        self.schedules.append(schedule)
+        return schedule
+
+    def check_activity(self, now):
+        kinds = sorted(set(kind for s in self.schedules for kind in s.activity_kinds))
+        if len(kinds) == 0:
+            return
+        seen = dict(zip(kinds, self.red.mget([ACTIVITY_PREFIX + kind for kind in kinds])))
+        for schedule in self.schedules:
+            for kind in schedule.activity_kinds:
+                when = seen.get(kind)
+                if when is not None and (schedule.last_run is None or float(when) > schedule.last_run):
+                    schedule.poke(now)
+
+    def run_due(self):
+        """
+        Run every sync which is due.
+
+        :return: the number of syncs run
+        """
+        now = self.clock()
+        self.check_activity(now)
+        ran = 0
+        for schedule in self.schedules:
+            if schedule.next_run > now:
+                continue
+            started = self.clock()
+            changed = False
+            try:
+                changed = schedule.func()
+            except Exception as e:
+                schedule.errors += 1
+                if self.logger is not None:
+                    self.logger.exception(e)
+            schedule.runs += 1
+            schedule.last_run = started
+            schedule.last_duration = self.clock() - started
+            schedule.finished(changed, self.clock())
+            ran += 1
+        if ran > 0:
+            self.publish_metrics()
+        return ran
+
+    def next_wakeup(self):
+        return min(s.next_run for s in self.schedules) if self.schedules else self.clock() + 1
+
+    def metrics(self):
+        now = self.clock()
+        return dict((s.name, s.metrics(now)) for s in self.schedules)
+
+    def publish_metrics(self):
+        self.red.set(METRICS_KEY, json.dumps(self.metrics()))
+
+    def run_forever(self, stop=None, poll=1.0):
+        """
+        Run syncs as they come due, checking for listener activity at least every poll seconds.
+
+        :param stop: a threading.Event which ends the loop when set
+        """
+        while stop is None or not stop.is_set():
+            self.run_due()
+            time.sleep(max(0.0, min(poll, self.next_wakeup() - self.clock())))
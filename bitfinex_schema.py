@@ -0,0 +1,207 @@
+"""
+Audit of the database indexes behind the plugin's lookups.
+
+The plugin's syncs look rows up by a handful of columns. Without an index for one of them every
+sync scans the whole table, which only shows once the table is large. At startup the live schema
+of the configured database is inspected for an index supporting each lookup, and the query plan of
+each lookup is logged, so a slow deployment can be diagnosed from its log. Disable with
+"schema_audit: false" in the bitfinex config section.
+
+The missing and partial indexes are only created on request:
+
+    bitfinexschema              # audit and print the query plans
+    bitfinexschema --create     # also create the missing indexes
+
+Creating an index locks writes to its table while it is built, so run --create while the manager
+and listener are stopped or quiet.
+"""
+import argparse
+
+OK = 'ok'
+PARTIAL = 'partial'  # an index leads with one of the columns, but does not cover the lookup
+MISSING = 'missing'
+NO_TABLE = 'no table'
+
+
+class Lookup(object):
+    """
+    :param model: the mapped class queried
+    :param columns: the columns the lookup filters on by equality, most selective first
+    :param query: query(session) builds the plugin's query, with sample values
+    """
+
+    def __init__(self, name, model, columns, query):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.query = query
+
+    @property
+    def table(self):
+        return self.model.__table__.name
+
+
+def lookups():
+    """
+    :return: the Lookups of the plugin's syncs, see sync_trades, known_movements, get_order_by_order_id,
+             get_orders and sync_balances
+    """
+    from trade_manager import em, wm
+    return [
+        Lookup('trade by trade_id', em.Trade, ('trade_id',),
+               lambda s: s.query(em.Trade).filter(em.Trade.trade_id == 'bitfinex|1')),
+        Lookup('credit by ref_id', wm.Credit, ('ref_id',),
+               lambda s: s.query(wm.Credit.ref_id).filter(wm.Credit.ref_id.in_(['bitfinex|1', 'bitfinex|2']))),
+        Lookup('debit by ref_id', wm.Debit, ('ref_id',),
+               lambda s: s.query(wm.Debit.ref_id).filter(wm.Debit.ref_id.in_(['bitfinex|1', 'bitfinex|2']))),
+        Lookup('order by order_id', em.LimitOrder, ('order_id', 'exchange'),
+               lambda s: s.query(em.LimitOrder).filter(em.LimitOrder.order_id == '1')
+               .filter(em.LimitOrder.exchange == 'bitfinex')),
+        Lookup('open orders', em.LimitOrder, ('exchange', 'state'),
+               lambda s: s.query(em.LimitOrder).filter(em.LimitOrder.exchange == 'bitfinex')
+               .filter(em.LimitOrder.state == 'open')),
+        Lookup('balance by user and currency', wm.Balance, ('user_id', 'currency'),
+               lambda s: s.query(wm.Balance).filter(wm.Balance.user_id == 1).filter(wm.Balance.currency == 'BTC')),
+    ]
+
+
+def coverage(index_columns, columns):
+    """
+    :return: OK if the index leads with exactly the lookup's columns, in any order, PARTIAL if it leads
+             with one of them, else None
+    """
+    if set(index_columns[:len(columns)]) == set(columns):
+        return OK
+    if len(index_columns) > 0 and index_columns[0] in columns:
+        return PARTIAL
+    return None
+
+
+def best_coverage(indexes, columns):
+    """
+    :param indexes: the column lists of a table's indexes
+    :return: the best coverage of the columns by any of the indexes, MISSING if none helps
+    """
+    found = [coverage(list(index), columns) for index in indexes]
+    if OK in found:
+        return OK
+    return PARTIAL if PARTIAL in found else MISSING
+
+
+def index_name(table, columns):
+    return 'ix_%s_%s' % (table, '_'.join(columns))
+
+
+def table_indexes(inspector, table):
+    """
+    :return: the column lists of a table's indexes, unique constraints and primary key,
+             or None if the table does not exist
+    """
+    if table not in inspector.get_table_names():
+        return None
+    indexes = [i['column_names'] for i in inspector.get_indexes(table)]
+    indexes.extend(u['column_names'] for u in inspector.get_unique_constraints(table))
+    primary = inspector.get_pk_constraint(table).get('constrained_columns')
+    if primary:
+        indexes.append(primary)
+    return indexes
+
+
+def audit(engine, checked=None):
+    """
+    :param checked: the Lookups to audit, by default every lookup of the plugin
+    :return: a list of (Lookup, status)
+    """
+    from sqlalchemy import inspect
+    inspector = inspect(engine)
+    findings = []
+    for lookup in (checked if checked is not None else lookups()):
+        indexes = table_indexes(inspector, lookup.table)
+        findings.append((lookup, NO_TABLE if indexes is None else best_coverage(indexes, lookup.columns)))
+    return findings
+
+
+def create_missing(engine, findings):
+    """
+    Create an index on the columns of every lookup which has none or only a partial one; without statistics,
+    sqlite can plan a partially covered lookup with a less selective index. Lookups of the same table on the same
+    columns get one index.
+
+    :return: the names of the indexes created
+    """
+    from sqlalchemy import Index
+    created = []
+    for lookup, status in findings:
+        name = index_name(lookup.table, lookup.columns)
+        if status not in (MISSING, PARTIAL) or name in created:
+            continue
+        table = lookup.model.__table__
+        Index(name, *[table.c[column] for column in lookup.columns]).create(engine)
+        created.append(name)
+    return created
+
+
+def explain_prefix(dialect):
+    return 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+
+
+def explain(session, lookup):
+    """
+    :return: the database's query plan of a lookup, as a list of lines
+    """
+    engine = session.get_bind()
+    statement = lookup.query(session).statement.compile(dialect=engine.dialect,
+                                                          compile_kwargs={'literal_binds': True})
+    rows = session.execute(explain_prefix(engine.dialect.name) + str(statement)).fetchall()
+    return [' '.join(str(value) for value in row) for row in rows]
+
+
+def audit_schema(session, logger, plans=True, checked=None):
+    """
+    Log the index audit and, if plans, the query plan of every lookup. Never raises, so a failing audit
+    cannot stop the plugin from starting.
+
+    :return: the findings, or None if the audit failed
+    """
+    try:
+        findings = audit(session.get_bind(), checked)
+        for lookup, status in findings:
+            if status == OK:
+                logger.info("schema audit: %s is indexed" % lookup.name)
+            elif status == NO_TABLE:
+                logger.warning("schema audit: table %s of %s does not exist" % (lookup.table, lookup.name))
+            else:
+                logger.warning("schema audit: %s has %s index on %s(%s), create it with bitfinexschema --create" %
+                               (lookup.name, 'only a partial' if status == PARTIAL else 'no', lookup.table,
+                                ', '.join(lookup.columns)))
+            if plans and status != NO_TABLE:
+                for line in explain(session, lookup):
+                    logger.info("schema audit: %s plan: %s" % (lookup.name, line))
+        session.rollback()  # end the transaction the inspection and plans started
+        return findings
+    except Exception as e:
+        logger.exception(e)
+        session.rollback()
+
+
+def main():
+    from bitfinex_manager import Bitfinex
+    parser = argparse.ArgumentParser(description='Audit the database indexes the Bitfinex plugin relies on.')
+    parser.add_argument('--create', action='store_true', help='create the missing and partial indexes')
+    parser.add_argument('--no-plans', action='store_true', help='do not print the query plans')
+    args = parser.parse_args()
+    bitfinex = Bitfinex()
+    bitfinex.setup_connections()
+    session = bitfinex.session
+    findings = audit(session.get_bind())
+    for lookup, status in findings:
+        print "%-30s %-8s %s(%s)" % (lookup.name, status, lookup.table, ', '.join(lookup.columns))
+        if not args.no_plans and status != NO_TABLE:
+            for line in explain(session, lookup):
+                print "    %s" % line
+    session.rollback()
+    if args.create:
+        for name in create_missing(session.get_bind(), findings):
+            print "created index %s" % name
+    elif len([f for f in findings if f[1] in (MISSING, PARTIAL)]) > 0:
+        raise SystemExit(1)
@@ -0,0 +1,148 @@
+"""
+Bounded lifetime for the long-lived database sessions of the manager and the listener.
+
+Work is split into units: a command, a scheduled sync or a listener message. When a unit starts,
+the objects loaded by the previous one are expunged, so the identity map only ever holds one
+unit's objects. Every so many units, or once resident memory passes a threshold, the session is
+closed outright, which also ends its transaction and returns its connection to the pool. ORM
+objects cached outside the session (i.e. the manager user) are dropped then and reloaded.
+
+The soak benchmark runs the same insert and query workload on sqlite against a long-lived session
+and a managed one, and samples resident memory:
+
+    bitfinexsoak --units 100000
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+RECYCLE_UNITS = 1000
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_memory():
+    """
+    :return: the resident set size of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        # the peak rather than the current size where there is no /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SessionLifecycle(object):
+    """
+    :param every: close the session every this many units
+    :param max_rss: also close it when resident memory exceeds this many bytes
+    """
+
+    def __init__(self, every=RECYCLE_UNITS, max_rss=None, rss=resident_memory):
+        self.every = every
+        self.max_rss = max_rss
+        self.rss = rss
+        self.units = 0
+        self.recycles = 0
+        self.skipped = 0
+
+    def start_unit(self, session):
+        """
+        Drop what the previous unit of work loaded, and close the session when it is due.
+
+        :return: True if the session was cleared, so ORM objects cached outside it are stale
+        """
+        self.units += 1
+        if session.new or session.dirty or session.deleted:
+            self.skipped += 1  # never discard uncommitted work
+            return False
+        if self.units >= self.every or (self.max_rss is not None and self.rss() > self.max_rss):
+            session.close()
+            self.units = 0
+            self.recycles += 1
+        else:
+            session.expunge_all()
+        return True
+
+
+def unit_of_work(method):
+    """
+    Run a plugin method as a unit of work, see Bitfinex.begin_unit. Nested calls belong to the outer unit.
+    The previous unit is cleaned up when the next starts, so callers can still use what a method returned.
+    """
+    def run(self, *args, **kwargs):
+        self.begin_unit()
+        self._unit_depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._unit_depth -= 1
+    run.__name__ = method.__name__
+    run.__doc__ = method.__doc__
+    return run
+
+
+def soak(units=100000, rows=5, every=RECYCLE_UNITS, managed=True, samples=10, path=None):
+    """
+    Insert and query trade-like rows on sqlite, one commit per unit, as the listener does.
+
+    :return: a list of (units done, resident bytes, objects in the identity map) samples
+    """
+    from sqlalchemy import Column, Float, Integer, String, create_engine, event
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    base = declarative_base()
+
+    class SoakTrade(base):
+        __tablename__ = 'soak_trade'
+        id = Column(Integer, primary_key=True)
+        trade_id = Column(String(64), index=True)
+        price = Column(Float)
+        amount = Column(Float)
+
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    engine = create_engine('sqlite:///%s' % path)
+
+    @event.listens_for(engine, 'connect')
+    def no_sync(connection, record):
+        connection.execute('PRAGMA synchronous=OFF')  # measure memory, not the disk
+    base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    lifecycle = SessionLifecycle(every) if managed else None
+    taken = []
+    tid = 0
+    try:
+        for unit in xrange(units):
+            if lifecycle is not None:
+                lifecycle.start_unit(session)
+            for i in xrange(rows):
+                tid += 1
+                session.add(SoakTrade(trade_id='bitfinex|%d' % tid, price=400 + i, amount=0.01))
+            session.query(SoakTrade).filter(SoakTrade.trade_id == 'bitfinex|%d' % (tid - rows)).first()
+            session.commit()
+            if (unit + 1) % max(1, units // samples) == 0:
+                taken.append((unit + 1, resident_memory(), len(session.identity_map)))
+    finally:
+        session.close()
+        engine.dispose()
+        os.remove(path)
+    return taken
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test session memory with and without the lifecycle.')
+    parser.add_argument('--units', type=int, default=20000)
+    parser.add_argument('--rows', type=int, default=5, help='rows inserted per unit of work')
+    parser.add_argument('--every', type=int, default=RECYCLE_UNITS, help='units between session recycles')
+    args = parser.parse_args()
+    for managed in (True, False):
+        started = time.time()
+        samples = soak(args.units, args.rows, args.every, managed)
+        print "%s session, %.1fs" % ('managed' if managed else 'long-lived', time.time() - started)
+        for units, rss, mapped in samples:
+            print "  %8d units %8.1f MB %8d mapped" % (units, rss / 1048576.0, mapped)
@@ -0,0 +1,818 @@
+"""
+Local Bitfinex exchange simulator for offline testing and load testing.
+
+The simulator implements the v1 REST endpoints used by the plugin, with a simple price-time priority
+matching engine and the same HMAC-SHA384 signature and nonce checks as the exchange.
+SimWebSocketApp stands in for websocket.WebSocketApp and produces the v1 ticker, trades and account
+frames, so the listener's callbacks can be driven without a network.
+
+Run it as a benchmark to measure end-to-end order throughput and latency through the plugin, from the
+order's insert to the listener handling it:
+
+    bitfinexsim --orders 5000 --threads 4
+    bitfinexsim --startup
+    bitfinexsim --tail --slow-rate 0.05 --slow-delay 2
+"""
+import argparse
+import bisect
+import hmac
+import json
+import random
+import threading
+import time
+from base64 import b64decode
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from hashlib import sha384
+from Queue import Queue, Empty
+from SocketServer import ThreadingMixIn
+
+SYMBOLS = ['btcusd', 'ethusd', 'ethbtc', 'ltcusd', 'ltcbtc', 'drkusd', 'drkbtc']
+MAKER_FEE = 0.001
+TAKER_FEE = 0.002
+
+
+class SimError(Exception):
+    """
+    An error the exchange would report as {"message": ...}.
+    """
+
+
+def fmt(value):
+    return "%.8f" % value
+
+
+class SimOrder(object):
+    __slots__ = ('id', 'account', 'symbol', 'side', 'price', 'original', 'remaining', 'notional', 'timestamp',
+                 'cancelled', 'type', 'ack')
+
+    def __init__(self, oid, account, symbol, side, price, amount, otype):
+        self.id = oid
+        self.account = account
+        self.symbol = symbol
+        self.side = side
+        self.price = price
+        self.original = amount
+        self.remaining = amount
+        self.notional = 0.0
+        self.timestamp = time.time()
+        self.cancelled = False
+        self.type = otype
+        self.ack = None  # status at acceptance, before matching
+
+    @property
+    def executed(self):
+        return self.original - self.remaining
+
+    @property
+    def live(self):
+        return not self.cancelled and self.remaining > 0
+
+    def status(self):
+        executed = self.executed
+        return {'id': self.id, 'order_id': self.id, 'symbol': self.symbol, 'exchange': 'bitfinex',
+                'price': fmt(self.price), 'side': self.side, 'type': self.type,
+                'avg_execution_price': fmt(self.notional / executed if executed > 0 else 0),
+                'timestamp': "%.4f" % self.timestamp, 'is_live': self.live, 'is_cancelled': self.cancelled,
+                'is_hidden': False, 'was_forced': False, 'original_amount': fmt(self.original),
+                'remaining_amount': fmt(self.remaining), 'executed_amount': fmt(executed)}
+
+    def ws_array(self):
+        """
+        [ORD_ID, ORD_PAIR, ORD_AMOUNT, ORD_AMOUNT_ORIG, ORD_TYPE, ORD_STATUS, ORD_PRICE, ORD_PRICE_AVG,
+         ORD_CREATED_AT, ORD_NOTIFY, ORD_HIDDEN, ORD_OCO]
+        """
+        sign = 1 if self.side == 'buy' else -1
+        executed = self.executed
+        if self.cancelled:
+            status = 'CANCELED'
+        elif self.remaining <= 0:
+            status = 'EXECUTED @ %s(%s)' % (fmt(self.price), fmt(executed))
+        elif executed > 0:
+            status = 'PARTIALLY FILLED @ %s(%s)' % (fmt(self.price), fmt(executed))
+        else:
+            status = 'ACTIVE'
+        created = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.timestamp))
+        return [self.id, self.symbol.upper(), sign * self.remaining, sign * self.original, self.type.upper(),
+                status, self.price, self.notional / executed if executed > 0 else 0, created, 0, 0, 0]
+
+
+class SimAccount(object):
+    def __init__(self, user_id, key, secret, balances=None):
+        self.user_id = user_id
+        self.key = key
+        self.secret = secret
+        self.nonce = 0
+        self.balances = dict(balances or {})
+        self.reserved = {}
+        self.orders = {}
+        self.trades = []
+        self.movements = []
+        self.sockets = []
+
+    def available(self, currency):
+        return self.balances.get(currency, 0.0) - self.reserved.get(currency, 0.0)
+
+    def reserve(self, currency, amount):
+        self.reserved[currency] = self.reserved.get(currency, 0.0) + amount
+
+    def credit(self, currency, amount):
+        self.balances[currency] = self.balances.get(currency, 0.0) + amount
+
+
+class SimMarket(object):
+    """
+    The book and ticker state for one symbol. Book sides are sorted lists of (key, seq, order)
+    where key is -price for bids and price for asks, so the best order is always first.
+    """
+
+    def __init__(self, symbol, last=0.0):
+        self.symbol = symbol
+        self.base = symbol[:3]
+        self.quote = symbol[3:]
+        self.bids = []
+        self.asks = []
+        self.last = last
+        self.high = last
+        self.low = last
+        self.volume = 0.0
+        self.prints = []
+        self.sockets = []
+
+    def best(self, side):
+        book = self.bids if side == 'buy' else self.asks
+        return book[0][2] if book else None
+
+    def ticker(self):
+        bid = self.best('buy')
+        ask = self.best('sell')
+        bid = bid.price if bid else self.last
+        ask = ask.price if ask else self.last
+        return {'mid': fmt((bid + ask) / 2), 'bid': fmt(bid), 'ask': fmt(ask), 'last_price': fmt(self.last),
+                'low': fmt(self.low), 'high': fmt(self.high), 'volume': fmt(self.volume),
+                'timestamp': "%.4f" % time.time()}
+
+    def ticker_array(self, chan_id):
+        bid = self.best('buy')
+        ask = self.best('sell')
+        return [chan_id, bid.price if bid else self.last, bid.remaining if bid else 0,
+                ask.price if ask else self.last, ask.remaining if ask else 0, 0, 0,
+                self.last, self.volume, self.high, self.low]
+
+
+class MatchingEngine(object):
+    """
+    Accounts, books and fills for the whole simulated exchange. All mutation happens under one lock.
+    """
+
+    def __init__(self, symbols=None, prices=None):
+        self.lock = threading.RLock()
+        self.accounts = {}
+        self.markets = {}
+        prices = prices or {}
+        for symbol in symbols or SYMBOLS:
+            self.markets[symbol] = SimMarket(symbol, prices.get(symbol, 0.0))
+        self._seq = 0
+
+    def next_id(self):
+        self._seq += 1
+        return self._seq
+
+    def add_account(self, key, secret, balances=None):
+        with self.lock:
+            account = SimAccount(self.next_id(), key, secret, balances)
+            self.accounts[key] = account
+            return account
+
+    def market(self, symbol):
+        if symbol not in self.markets:
+            raise SimError("Unknown symbol")
+        return self.markets[symbol]
+
+    # authentication
+
+    def authenticate(self, key, payload, signature):
+        """
+        Check a v1 request signature and nonce.
+
+        :return: (account, decoded payload)
+        """
+        account = self.accounts.get(key)
+        if account is None:
+            raise SimError("Could not find a key matching the given X-BFX-APIKEY.")
+        expected = hmac.new(account.secret, payload, sha384).hexdigest()
+        if not hmac.compare_digest(expected, str(signature)):
+            raise SimError("Invalid X-BFX-SIGNATURE.")
+        try:
+            params = json.loads(b64decode(payload))
+            nonce = int(params['nonce'])
+        except (TypeError, ValueError, KeyError):
+            raise SimError("Invalid X-BFX-PAYLOAD.")
+        with self.lock:
+            if nonce <= account.nonce:
+                raise SimError("Nonce is too small.")
+            account.nonce = nonce
+        return account, params
+
+    # orders
+
+    def new_order(self, account, symbol, side, amount, price, otype='exchange limit'):
+        amount = float(amount)
+        price = float(price)
+        if side not in ('buy', 'sell'):
+            raise SimError("Invalid side.")
+        if amount <= 0 or price <= 0:
+            raise SimError("Invalid order: amount and price must be positive.")
+        with self.lock:
+            market = self.market(symbol)
+            if side == 'buy':
+                currency, needed = market.quote, amount * price
+            else:
+                currency, needed = market.base, amount
+            if account.available(currency) < needed:
+                raise SimError("Invalid order: not enough exchange balance for %s %s" % (fmt(amount), symbol))
+            order = SimOrder(self.next_id(), account, symbol, side, price, amount, otype)
+            account.reserve(currency, needed)
+            account.orders[order.id] = order
+            order.ack = order.status()
+            self._publish_order(order, 'on')
+            self._match(market, order)
+            if order.live:
+                book = market.bids if side == 'buy' else market.asks
+                bisect.insort(book, (-price if side == 'buy' else price, order.id, order))
+            self._publish_ticker(market)
+            return order
+
+    def _match(self, market, taker):
+        book = market.asks if taker.side == 'buy' else market.bids
+        while taker.remaining > 0 and book:
+            maker = book[0][2]
+            if (taker.side == 'buy' and maker.price > taker.price) or \
+                    (taker.side == 'sell' and maker.price < taker.price):
+                break
+            amount = min(taker.remaining, maker.remaining)
+            self._fill(market, maker, amount, maker.price, MAKER_FEE)
+            self._fill(market, taker, amount, maker.price, TAKER_FEE)
+            market.last = maker.price
+            market.high = max(market.high, maker.price) if market.high else maker.price
+            market.low = min(market.low, maker.price) if market.low else maker.price
+            market.volume += amount
+            self._publish_print(market, amount if taker.side == 'buy' else -amount, maker.price)
+            if not maker.live:
+                book.pop(0)
+
+    def _fill(self, market, order, amount, price, fee_rate):
+        account = order.account
+        order.remaining -= amount
+        order.notional += amount * price
+        fee = amount * price * fee_rate
+        if order.side == 'buy':
+            account.reserve(market.quote, -amount * order.price)
+            account.credit(market.base, amount)
+            account.credit(market.quote, -amount * price - fee)
+        else:
+            account.reserve(market.base, -amount)
+            account.credit(market.base, -amount)
+            account.credit(market.quote, amount * price - fee)
+        trade = {'tid': self.next_id(), 'order_id': order.id, 'symbol': market.symbol, 'price': fmt(price),
+                 'amount': fmt(amount), 'timestamp': "%.4f" % time.time(), 'exchange': 'bitfinex',
+                 'type': 'Buy' if order.side == 'buy' else 'Sell', 'fee_currency': market.quote.upper(),
+                 'fee_amount': fmt(-fee)}
+        account.trades.append(trade)
+        self._publish_order(order, 'ou' if order.live else 'oc')
+        self._publish_trade(account, trade, order)
+        self._publish_wallet(account, market.base)
+        self._publish_wallet(account, market.quote)
+
+    def cancel_order(self, account, oid):
+        with self.lock:
+            order = account.orders.get(oid)
+            if order is None:
+                raise SimError("Order could not be cancelled.")
+            if order.live:
+                self._cancel(order)
+            return order
+
+    def cancel_all(self, account):
+        with self.lock:
+            live = [o for o in account.orders.values() if o.live]
+            for order in live:
+                self._cancel(order)
+            return len(live)
+
+    def _cancel(self, order):
+        market = self.markets[order.symbol]
+        book = market.bids if order.side == 'buy' else market.asks
+        i = bisect.bisect_left(book, (-order.price if order.side == 'buy' else order.price, order.id))
+        if i < len(book) and book[i][2] is order:
+            book.pop(i)
+        if order.side == 'buy':
+            order.account.reserve(market.quote, -order.remaining * order.price)
+        else:
+            order.account.reserve(market.base, -order.remaining)
+        order.cancelled = True
+        self._publish_order(order, 'oc')
+        self._publish_ticker(market)
+
+    def open_orders(self, account):
+        with self.lock:
+            return [o.status() for o in sorted(account.orders.values(), key=lambda o: o.id) if o.live]
+
+    # history
+
+    def deposit(self, account, currency, amount, address='sim', status='COMPLETED', mtype='DEPOSIT'):
+        with self.lock:
+            if status == 'COMPLETED':
+                account.credit(currency.lower(), amount if mtype == 'DEPOSIT' else -amount)
+            account.movements.append({'id': self.next_id(), 'currency': currency.upper(), 'method': 'SIM',
+                                      'type': mtype, 'amount': fmt(amount), 'description': 'simulated',
+                                      'address': address, 'status': status, 'timestamp': "%.4f" % time.time()})
+            self._publish_wallet(account, currency.lower())
+
+    def withdraw(self, account, currency, amount, address='sim', status='COMPLETED'):
+        self.deposit(account, currency, amount, address, status, mtype='WITHDRAWAL')
+
+    @staticmethod
+    def _window(rows, since, until, limit, key='timestamp'):
+        """
+        Newest first, limited to since <= timestamp <= until, as bitfinex pages history.
+        """
+        since = float(since) if since is not None else 0
+        until = float(until) if until is not None else float('inf')
+        out = []
+        for row in reversed(rows):
+            ts = float(row[key])
+            if ts > until:
+                continue
+            if ts < since or len(out) >= limit:
+                break
+            out.append(row)
+        return out
+
+    def my_trades(self, account, symbol, since=None, until=None, limit=50):
+        with self.lock:
+            rows = [t for t in account.trades if t['symbol'] == symbol]
+            return self._window(rows, since, until, int(limit))
+
+    def movements(self, account, currency, since=None, until=None, limit=500):
+        with self.lock:
+            rows = [m for m in account.movements if m['currency'] == currency.upper()]
+            return self._window(rows, since, until, int(limit))
+
+    def balances(self, account):
+        with self.lock:
+            return [{'type': 'exchange', 'currency': cur, 'amount': fmt(bal), 'available': fmt(account.available(cur))}
+                    for cur, bal in sorted(account.balances.items())]
+
+    def book(self, symbol, limit=50):
+        with self.lock:
+            market = self.market(symbol)
+
+            def levels(book):
+                out = []
+                for _, _, order in book:
+                    if out and float(out[-1]['price']) == order.price:
+                        out[-1]['amount'] = fmt(float(out[-1]['amount']) + order.remaining)
+                    elif len(out) < limit:
+                        out.append({'price': fmt(order.price), 'amount': fmt(order.remaining),
+                                    'timestamp': "%.4f" % order.timestamp})
+                    else:
+                        break
+                return out
+            return {'bids': levels(market.bids), 'asks': levels(market.asks)}
+
+    # websocket publishing
+
+    def _publish_order(self, order, event):
+        for ws in order.account.sockets:
+            ws.publish([0, event, order.ws_array()])
+
+    def _publish_trade(self, account, trade, order):
+        sign = 1 if order.side == 'buy' else -1
+        seq = '%s-%s' % (trade['tid'], order.symbol.upper())
+        # te [SEQ, PAIR, MTS, ORD_ID, AMOUNT, PRICE, ORD_TYPE, ORD_PRICE], then tu with the trade id and fee
+        executed = [order.symbol.upper(), float(trade['timestamp']), order.id, sign * float(trade['amount']),
+                    float(trade['price']), order.type.upper(), order.price]
+        for ws in account.sockets:
+            ws.publish([0, 'te', [seq] + executed])
+            ws.publish([0, 'tu', [seq, trade['tid']] + executed + [float(trade['fee_amount']),
+                                                                    trade['fee_currency']]])
+
+    def _publish_wallet(self, account, currency):
+        for ws in account.sockets:
+            ws.publish([0, 'wu', ['exchange', currency.upper(), account.balances.get(currency, 0.0), 0]])
+
+    def _publish_ticker(self, market):
+        for ws, chan_id, channel in market.sockets:
+            if channel == 'ticker':
+                ws.publish(market.ticker_array(chan_id))
+
+    def _publish_print(self, market, amount, price):
+        seq = self.next_id()
+        ts = time.time()
+        market.prints.append([seq, ts, price, amount])
+        del market.prints[:-30]
+        for ws, chan_id, channel in market.sockets:
+            if channel == 'trades':
+                ws.publish([chan_id, 'te', str(seq), ts, price, amount])
+
+
+class SimHandler(BaseHTTPRequestHandler):
+    """
+    Serves the v1 REST endpoints from the server's engine.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.stall()
+        engine = self.server.engine
+        parts = self.path.split('?')[0].strip('/').split('/')
+        try:
+            if len(parts) == 3 and parts[:2] == ['v1', 'pubticker']:
+                with engine.lock:
+                    return self.respond(engine.market(parts[2]).ticker())
+            elif len(parts) == 3 and parts[:2] == ['v1', 'book']:
+                return self.respond(engine.book(parts[2]))
+        except SimError as e:
+            return self.respond({'message': str(e)}, 400)
+        self.respond({'message': 'Unknown request'}, 404)
+
+    def do_POST(self):
+        engine = self.server.engine
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        try:
+            account, params = engine.authenticate(self.headers.get('X-BFX-APIKEY'),
+                                                  self.headers.get('X-BFX-PAYLOAD'),
+                                                  self.headers.get('X-BFX-SIGNATURE'))
+            if params.get('request') != self.path:
+                raise SimError("Payload request does not match the url.")
+            return self.respond(self.dispatch(engine, account, self.path[len('/v1/'):], params))
+        except SimError as e:
+            return self.respond({'message': str(e)}, 400)
+
+    @staticmethod
+    def dispatch(engine, account, endpoint, params):
+        if endpoint == 'balances':
+            return engine.balances(account)
+        elif endpoint == 'orders':
+            return engine.open_orders(account)
+        elif endpoint == 'order/new':
+            return engine.new_order(account, params['symbol'], params['side'], params['amount'], params['price'],
+                                    params.get('type', 'exchange limit')).ack
+        elif endpoint == 'order/cancel':
+            return engine.cancel_order(account, int(params['order_id'])).status()
+        elif endpoint == 'order/cancel/all':
+            return {'result': '%s orders successfully cancelled' % engine.cancel_all(account)}
+        elif endpoint == 'mytrades':
+            return engine.my_trades(account, params['symbol'], params.get('timestamp'), params.get('until'),
+                                    params.get('limit_trades', 50))
+        elif endpoint == 'history/movements':
+            return engine.movements(account, params['currency'], params.get('since'), params.get('until'),
+                                    params.get('limit', 500))
+        raise SimError("Unknown request")
+
+
+class SimServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded local HTTP server for a MatchingEngine. Point bitfinex_manager.BASE_URL at server.url.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, engine, host='127.0.0.1', port=0, slow_rate=0.0, slow_delay=0.0):
+        """
+        :param slow_rate: the fraction of public GETs which stall for slow_delay seconds before answering,
+                          like a slow exchange edge node
+        """
+        HTTPServer.__init__(self, (host, port), SimHandler)
+        self.engine = engine
+        self.url = 'http://%s:%s' % self.server_address
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+
+    def handle_error(self, request, client_address):
+        pass  # i.e. a hedged or timed out client hung up on a stalled request
+
+    def stall(self):
+        if self.slow_rate > 0 and random.random() < self.slow_rate:
+            time.sleep(self.slow_delay)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SimWebSocketApp(object):
+    """
+    Stands in for websocket.WebSocketApp, speaking the v1 websocket protocol against an engine.
+    Frames are delivered to on_message from run_forever, in the thread which calls it.
+    """
+
+    def __init__(self, engine, on_message=None, on_error=None, on_close=None, on_open=None):
+        self.engine = engine
+        self.on_message = on_message
+        self.on_error = on_error
+        self.on_close = on_close
+        self.on_open = on_open
+        self.frames = Queue()
+        self.closed = False
+        self.account = None
+        self.subscriptions = []
+        self.first_data_time = None  # when the first data frame (not an event) was handled
+
+    def publish(self, frame):
+        self.frames.put(json.dumps(frame))
+
+    def send(self, data):
+        mess = json.loads(data)
+        event = mess.get('event')
+        with self.engine.lock:
+            if event == 'subscribe':
+                symbol = mess['pair'].lower()
+                if symbol not in self.engine.markets:
+                    return self.publish({'event': 'error', 'msg': 'symbol: invalid', 'code': 10300})
+                market = self.engine.markets[symbol]
+                chan_id = self.engine.next_id()
+                self.subscriptions.append((market, chan_id, mess['channel']))
+                market.sockets.append((self, chan_id, mess['channel']))
+                self.publish({'event': 'subscribed', 'channel': mess['channel'], 'chanId': chan_id,
+                              'pair': symbol.upper()})
+                if mess['channel'] == 'ticker':
+                    self.publish(market.ticker_array(chan_id))
+                elif mess['channel'] == 'trades':
+                    self.publish([chan_id, list(reversed(market.prints))])
+            elif event == 'auth':
+                self._auth(mess)
+
+    def _auth(self, mess):
+        account = self.engine.accounts.get(mess.get('apiKey'))
+        expected = hmac.new(account.secret, str(mess['authPayload']), sha384).hexdigest() if account else None
+        if expected is None or not hmac.compare_digest(expected, str(mess.get('authSig'))):
+            return self.publish({'event': 'auth', 'status': 'FAIL', 'chanId': 0, 'code': 10100})
+        self.account = account
+        account.sockets.append(self)
+        self.publish({'event': 'auth', 'status': 'OK', 'chanId': 0, 'userId': account.user_id})
+        self.publish([0, 'ws', [['exchange', cur.upper(), bal, 0] for cur, bal in sorted(account.balances.items())]])
+        self.publish([0, 'os', [o.ws_array() for o in account.orders.values() if o.live]])
+        self.publish([0, 'ts', [[t['tid'], t['symbol'].upper(), float(t['timestamp']), t['order_id'],
+                                 float(t['amount']) * (1 if t['type'] == 'Buy' else -1), float(t['price']),
+                                 'EXCHANGE LIMIT', float(t['price']), float(t['fee_amount']), t['fee_currency']]
+                                for t in account.trades[-30:]]])
+
+    def run_forever(self, timeout=0.1):
+        if self.on_open is not None:
+            self.on_open(self)
+        while not self.closed:
+            try:
+                frame = self.frames.get(timeout=timeout)
+            except Empty:
+                continue
+            try:
+                self.on_message(self, frame)
+            except Exception as e:
+                if self.on_error is None:
+                    raise
+                self.on_error(self, e)
+            if self.first_data_time is None and frame.startswith('['):
+                self.first_data_time = time.time()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def close(self):
+        with self.engine.lock:
+            for market, chan_id, channel in self.subscriptions:
+                market.sockets.remove((self, chan_id, channel))
+            if self.account is not None:
+                self.account.sockets.remove(self)
+        self.closed = True
+
+
+def bare_plugin(key, secret):
+    """
+    A Bitfinex plugin instance with only credentials and a logger set, enough for bitfinex_request.
+    Avoids the config, database and redis setup of a full instance.
+    """
+    import logging
+    from bitfinex_manager import Bitfinex
+    plugin = Bitfinex.__new__(Bitfinex)
+    plugin.key = key
+    plugin.secret = secret
+    plugin.logger = logging.getLogger('bitfinex_sim')
+    return plugin
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def benchmark(orders=2000, threads=1, symbol='btcusd', price=400.0, timeout=60):
+    """
+    Submit orders end to end through the plugin against a local simulator. Each order is inserted in the
+    database, then create_order looks it up, claims it when coordinated, signs order/new and stamps the
+    tracer. Its latency runs until the listener has handled the simulator's 'on' frame for it.
+    Every fifth order crosses the spread so the matching engine fills, and the rest are cancelled at the end.
+
+    Each thread submits for its own account context, listened to on its own socket, since the nonces of
+    one key must arrive in order. Like startup_benchmark, uses the real config, redis and database.
+
+    :return: a dict of throughput and latency statistics in seconds.
+    """
+    import bitfinex_listener
+    import bitfinex_manager
+    from ledger import Amount
+    from trade_manager import em
+    engine = MatchingEngine(prices={symbol: price})
+    server = SimServer(engine).start()
+    base_url = bitfinex_manager.BASE_URL
+    bitfinex_manager.BASE_URL = server.url
+    root = bitfinex_listener.setup_plugin()
+    bitfinex_listener.setup_connections()
+    submitted = {}  # exchange order id: time the order was inserted
+    listed = {}  # exchange order id: time the listener handled its 'on' frame
+    errors = []
+    per_thread = orders // threads
+
+    def timed(handle):
+        def on_message(ws, message):
+            handle(ws, message)
+            frame = json.loads(message)
+            if isinstance(frame, list) and len(frame) > 2 and frame[1] == 'on':
+                listed[str(frame[2][0])] = time.time()
+        return on_message
+
+    def run(plugin, ws):
+        market = plugin.format_market(symbol)
+        base, quote = plugin.base_commodity(market), plugin.quote_commodity(market)
+        for i in xrange(per_thread):
+            side = 'bid' if i % 2 == 0 else 'ask'
+            offset = (1 + i % 7) * (1 if side == 'ask' else -1)
+            if i % 5 == 0:
+                offset = -offset  # cross the spread
+            start = time.time()
+            row = em.LimitOrder(Amount("%s %s" % (fmt(price + offset), quote)), Amount("0.01 %s" % base), market,
+                                side, plugin.NAME, 'tmp|%s-%s' % (plugin.account, i), state='pending')
+            plugin.session.add(row)
+            plugin.session.commit()
+            order = plugin.create_order(row.id)
+            if order is None:
+                errors.append(row.id)
+            else:
+                submitted[order.order_id.split('|')[1]] = start
+        plugin.bitfinex_request('order/cancel/all')
+
+    contexts = []
+    for n in range(threads):
+        key, secret = 'bench%s' % n, 'secret%s' % n
+        engine.add_account(key, secret, {symbol[:3]: 1e9, symbol[3:]: 1e12})
+        credentials = {'key': key, 'secret': secret, 'userpubkey': key}
+        plugin = root.account_context('bench%s' % n, credentials)
+        # the listener gets its own instance, a session must not be shared between threads
+        ws = bitfinex_listener.attach(SimWebSocketApp(engine), root.account_context('bench%s' % n, credentials))
+        ws.on_message = timed(ws.on_message)
+        listener = threading.Thread(target=ws.run_forever)
+        listener.daemon = True
+        listener.start()
+        contexts.append((plugin, ws))
+    deadline = time.time() + timeout
+    while any(ws.account is None for plugin, ws in contexts) and time.time() < deadline:
+        time.sleep(0.001)  # authenticated
+    workers = [threading.Thread(target=run, args=context) for context in contexts]
+    began = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    while len(set(submitted) - set(listed)) > 0 and time.time() < deadline:
+        time.sleep(0.001)
+    elapsed = time.time() - began
+    for plugin, ws in contexts:
+        ws.close()
+    bitfinex_manager.BASE_URL = base_url
+    server.stop()
+    latencies = [listed[oid] - start for oid, start in submitted.items() if oid in listed]
+    return {'orders': len(latencies), 'errors': len(errors), 'unlisted': len(submitted) - len(latencies),
+            'elapsed': elapsed, 'throughput': len(latencies) / elapsed if elapsed > 0 else 0,
+            'p50': percentile(latencies, 50), 'p99': percentile(latencies, 99), 'max': max(latencies or [0]),
+            'fills': sum(len(a.trades) for a in engine.accounts.values())}
+
+
+def startup_benchmark(timeout=60):
+    """
+    Time the listener from import to its first processed data frame, against a simulated websocket.
+    Must run in a process which has not imported bitfinex_listener yet. Uses the real config, redis and database.
+
+    :return: a dict of seconds since the import began for each startup milestone.
+    """
+    began = time.time()
+    import bitfinex_listener
+    imported = time.time()
+    plugin = bitfinex_listener.setup_plugin()
+    engine = MatchingEngine(prices={'btcusd': 400.0})
+    engine.add_account(plugin.key, plugin.secret, {'btc': 1.0, 'usd': 1000.0})
+    ws = SimWebSocketApp(engine)
+    listener = threading.Thread(target=bitfinex_listener.main, kwargs={'ws': ws})
+    listener.daemon = True
+    listener.start()
+    deadline = began + timeout
+    while ws.first_data_time is None and time.time() < deadline:
+        time.sleep(0.001)
+    connected = time.time() if bitfinex_listener.ready.is_set() else None
+    ws.close()
+    return {'import': imported - began,
+            'connections_ready': connected - began if connected else None,
+            'first_message': ws.first_data_time - began if ws.first_data_time else None}
+
+
+def tail_benchmark(count=500, slow_rate=0.05, slow_delay=2.0, symbol='btcusd'):
+    """
+    Fetch tickers from a simulator which stalls a fraction of requests, once with the fixed REQ_TIMEOUT
+    and once through the adaptive, hedged client.
+
+    :return: a dict of latency statistics in seconds for 'fixed' and 'hedged'
+    """
+    import requests
+    from bitfinex_http import AdaptiveClient
+    from bitfinex_manager import REQ_TIMEOUT
+    server = SimServer(MatchingEngine(prices={symbol: 400.0}), slow_rate=slow_rate, slow_delay=slow_delay).start()
+    url = '%s/v1/pubticker/%s' % (server.url, symbol)
+    client = AdaptiveClient(REQ_TIMEOUT)
+    results = {}
+    for mode in ('fixed', 'hedged'):
+        latencies = []
+        errors = 0
+        for i in xrange(count):
+            start = time.time()
+            try:
+                if mode == 'fixed':
+                    requests.get(url, timeout=REQ_TIMEOUT).json()
+                else:
+                    client.hedged('pubticker', lambda timeout: requests.get(url, timeout=timeout)).json()
+            except (IOError, ValueError):
+                errors += 1
+            latencies.append(time.time() - start)
+        results[mode] = {'requests': count, 'errors': errors, 'p50': percentile(latencies, 50),
+                         'p99': percentile(latencies, 99), 'max': max(latencies)}
+    results['hedged'].update(client.stats()['pubticker'])
+    server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Bitfinex plugin against a local simulator.')
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--symbol', default='btcusd')
+    parser.add_argument('--startup', action='store_true',
+                        help='time the listener from import to first processed message instead')
+    parser.add_argument('--tail', action='store_true',
+                        help='compare ticker tail latency with fixed timeouts and hedged requests instead')
+    parser.add_argument('--requests', type=int, default=500, help='tickers fetched per mode with --tail')
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-delay', type=float, default=2.0)
+    args = parser.parse_args()
+    if args.tail:
+        results = tail_benchmark(args.requests, args.slow_rate, args.slow_delay, args.symbol)
+        for mode in ('fixed', 'hedged'):
+            stats = results[mode]
+            print "%s: %d requests, %d errors, p50 %.3fms p99 %.3fms max %.3fms" % (
+                mode, stats['requests'], stats['errors'], stats['p50'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000)
+        print "hedges %(hedges)s won %(hedge_wins)s" % results['hedged']
+        return
+    if args.startup:
+        stats = startup_benchmark()
+        for milestone in ('import', 'connections_ready', 'first_message'):
+            if stats[milestone] is None:
+                print "%s not reached" % milestone
+            else:
+                print "%s %.3fms" % (milestone, stats[milestone] * 1000)
+        return
+    stats = benchmark(args.orders, args.threads, args.symbol)
+    print "orders %(orders)s errors %(errors)s unlisted %(unlisted)s fills %(fills)s in %(elapsed).3fs" % stats
+    print "throughput %(throughput).1f orders/s" % stats
+    print "latency p50 %.3fms p99 %.3fms max %.3fms" % (stats['p50'] * 1000, stats['p99'] * 1000, stats['max'] * 1000)
+
+
+if __name__ == "__main__":
+    main()
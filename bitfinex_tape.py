@@ -0,0 +1,160 @@
+"""
+Fixed capacity trade tape for the Bitfinex public trades channel.
+
+Each market gets a ring buffer which stores its prints column-wise in typed arrays,
+so recording a trade or querying a recent window never allocates per trade.
+"""
+import time
+from array import array
+
+DEFAULT_CAPACITY = 4096
+
+BUY = 1
+SELL = -1
+
+
+class TradeTape(object):
+    """
+    A ring buffer of public trades for a single market.
+
+    Columns are timestamp (seconds), price, amount (always positive) and side (BUY or SELL).
+    Once full, the oldest print is overwritten.
+    """
+
+    def __init__(self, market, capacity=DEFAULT_CAPACITY):
+        self.market = market
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.prices = array('d', [0.0]) * capacity
+        self.amounts = array('d', [0.0]) * capacity
+        self.sides = array('b', [0]) * capacity
+        self.head = 0  # index the next print is written to
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, timestamp, price, amount):
+        """
+        Record a print. A negative amount is a sell, as reported by bitfinex.
+        """
+        i = self.head
+        self.timestamps[i] = timestamp
+        self.prices[i] = price
+        if amount < 0:
+            self.amounts[i] = -amount
+            self.sides[i] = SELL
+        else:
+            self.amounts[i] = amount
+            self.sides[i] = BUY
+        self.head = (i + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def last(self):
+        """
+        :return: the most recent print as a (timestamp, price, amount, side) tuple, or None if empty.
+        """
+        if self.size == 0:
+            return None
+        i = (self.head - 1) % self.capacity
+        return self.timestamps[i], self.prices[i], self.amounts[i], self.sides[i]
+
+    def seen(self, timestamp, price, amount):
+        """
+        :return: True if the tape already has this print, or prints newer than it
+        """
+        side = SELL if amount < 0 else BUY
+        amount = abs(amount)
+        i = self.head
+        for _ in xrange(self.size):
+            i = (i - 1) % self.capacity
+            if self.timestamps[i] > timestamp:
+                return True
+            if self.timestamps[i] < timestamp:
+                return False
+            if self.prices[i] == price and self.amounts[i] == amount and self.sides[i] == side:
+                return True
+        return False
+
+    def _window(self, seconds, now, side):
+        """
+        Walk backwards from the newest print until the window start.
+
+        :return: (count, volume, notional) for prints newer than now - seconds.
+        """
+        since = (now if now is not None else time.time()) - seconds
+        count = 0
+        volume = 0.0
+        notional = 0.0
+        i = self.head
+        for _ in xrange(self.size):
+            i = (i - 1) % self.capacity
+            if self.timestamps[i] < since:
+                break
+            if side is not None and self.sides[i] != side:
+                continue
+            count += 1
+            volume += self.amounts[i]
+            notional += self.amounts[i] * self.prices[i]
+        return count, volume, notional
+
+    def volume(self, seconds, now=None, side=None):
+        """
+        :return: the base volume traded in the last N seconds, optionally for one side only.
+        """
+        return self._window(seconds, now, side)[1]
+
+    def count(self, seconds, now=None, side=None):
+        """
+        :return: the number of prints in the last N seconds, optionally for one side only.
+        """
+        return self._window(seconds, now, side)[0]
+
+    def vwap(self, seconds, now=None, side=None):
+        """
+        :return: the volume weighted average price of the last N seconds, or None if there were no prints.
+        """
+        count, volume, notional = self._window(seconds, now, side)
+        if volume == 0:
+            return None
+        return notional / volume
+
+
+class TradeTapes(object):
+    """
+    The set of trade tapes for all subscribed markets.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.tapes = {}
+
+    def __getitem__(self, market):
+        return self.tapes[market]
+
+    def __contains__(self, market):
+        return market in self.tapes
+
+    def get(self, market):
+        if market not in self.tapes:
+            self.tapes[market] = TradeTape(market, self.capacity)
+        return self.tapes[market]
+
+    def on_snapshot(self, market, rows):
+        """
+        Load a trades channel snapshot. Rows are [seq, timestamp, price, amount], newest first.
+        After a reconnect the snapshot repeats prints the tape already has, those are skipped.
+        """
+        tape = self.get(market)
+        for row in reversed(rows):
+            timestamp, price, amount = float(row[1]), float(row[2]), float(row[3])
+            if not tape.seen(timestamp, price, amount):
+                tape.add(timestamp, price, amount)
+
+    def on_execution(self, market, timestamp, price, amount):
+        """
+        Record a 'te' (trade executed) update.
+        The matching 'tu' update repeats the same print, so only 'te' should be recorded.
+        """
+        self.get(market).add(float(timestamp), float(price), float(amount))
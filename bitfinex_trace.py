@@ -0,0 +1,147 @@
+"""
+Order lifecycle latency tracing across the Bitfinex manager and listener.
+
+Each order is stamped as it passes through the lifecycle stages, correlated by exchange order id:
+
+    create  create_order was called
+    ack     the exchange accepted the order
+    listed  the listener saw the order in an order update
+    fill    the listener saw the first trade for the order
+
+Stamps live in redis so the manager and listener processes share them. The latency of each stage,
+measured from create, is counted into per-minute log-scale histograms per stage and market,
+which bitfinext summarizes as p50/p99 over a rolling window.
+"""
+import argparse
+import math
+import time
+
+STAGES = ('ack', 'listed', 'fill')
+TRACE_PREFIX = 'bitfinex_trace|'
+HIST_PREFIX = 'bitfinex_latency|'
+TRACE_TTL = 86400
+WINDOW_MINUTES = 60
+BUCKET_BASE = 1.2  # bucket i holds latencies up to 0.1ms * BUCKET_BASE ** i
+BUCKET_MIN_MS = 0.1
+
+
+def bucket(latency):
+    """
+    :param latency: seconds
+    :return: the histogram bucket index for a latency
+    """
+    ms = latency * 1000
+    if ms <= BUCKET_MIN_MS:
+        return 0
+    return int(math.ceil(math.log(ms / BUCKET_MIN_MS, BUCKET_BASE)))
+
+
+def bucket_upper(index):
+    """
+    :return: the upper bound of a bucket, in seconds
+    """
+    return BUCKET_MIN_MS * BUCKET_BASE ** index / 1000
+
+
+def percentile(counts, pct):
+    """
+    :param counts: a dict of bucket index to count
+    :return: the upper bound in seconds of the bucket holding the percentile, or None if empty
+    """
+    total = sum(counts.values())
+    if total == 0:
+        return None
+    rank = total * pct / 100.0
+    seen = 0
+    for index in sorted(counts):
+        seen += counts[index]
+        if seen >= rank:
+            return bucket_upper(index)
+    return bucket_upper(max(counts))
+
+
+class Tracer(object):
+    def __init__(self, red):
+        self.red = red
+        self.stamped = set()  # (order_id, stage) already stamped by this process
+
+    def stamp(self, order_id, stage, market, when=None, created=None):
+        """
+        Stamp a stage of an order's lifecycle, the first time it is reached.
+
+        :param order_id: the exchange order id, with or without the 'bitfinex|' prefix
+        :param created: the create time, when the caller knows it (i.e. the manager, at ack)
+        """
+        order_id = str(order_id).split("|")[-1]
+        if (order_id, stage) in self.stamped:
+            return
+        if len(self.stamped) > 100000:
+            self.stamped.clear()
+        self.stamped.add((order_id, stage))
+        when = when if when is not None else time.time()
+        key = TRACE_PREFIX + order_id
+        pipe = self.red.pipeline()
+        if created is not None:
+            pipe.hsetnx(key, 'create', created)
+        pipe.hsetnx(key, stage, when)
+        pipe.hgetall(key)
+        pipe.expire(key, TRACE_TTL)
+        results = pipe.execute()
+        trace = results[-2]
+        if 'create' not in trace:
+            return
+        create = float(trace['create'])
+        if results[-3]:
+            self.record(stage, market, when - create, when)
+        if created is not None and results[0]:
+            # stages the listener stamped before the create time arrived with the ack
+            for other in STAGES:
+                if other != stage and other in trace:
+                    self.record(other, market, float(trace[other]) - create, float(trace[other]))
+
+    def record(self, stage, market, latency, when=None):
+        minute = int((when if when is not None else time.time()) // 60)
+        key = "%s%s|%s|%s" % (HIST_PREFIX, stage, market, minute)
+        pipe = self.red.pipeline()
+        pipe.hincrby(key, bucket(latency), 1)
+        pipe.expire(key, WINDOW_MINUTES * 60 * 2)
+        pipe.execute()
+
+    def histogram(self, stage, market, minutes=WINDOW_MINUTES, now=None):
+        """
+        :return: the merged bucket counts of the last N minutes
+        """
+        last = int((now if now is not None else time.time()) // 60)
+        pipe = self.red.pipeline()
+        for minute in range(last - minutes + 1, last + 1):
+            pipe.hgetall("%s%s|%s|%s" % (HIST_PREFIX, stage, market, minute))
+        counts = {}
+        for hist in pipe.execute():
+            for index, count in hist.items():
+                counts[int(index)] = counts.get(int(index), 0) + int(count)
+        return counts
+
+    def summary(self, markets, minutes=WINDOW_MINUTES, now=None):
+        """
+        :return: a list of (stage, market, count, p50, p99) with latencies in seconds
+        """
+        rows = []
+        for stage in STAGES:
+            for market in markets:
+                counts = self.histogram(stage, market, minutes, now)
+                if counts:
+                    rows.append((stage, market, sum(counts.values()), percentile(counts, 50),
+                                 percentile(counts, 99)))
+        return rows
+
+
+def main():
+    from bitfinex_manager import Bitfinex
+    parser = argparse.ArgumentParser(description='Show Bitfinex order lifecycle latency per stage.')
+    parser.add_argument('--minutes', type=int, default=WINDOW_MINUTES)
+    args = parser.parse_args()
+    bitfinex = Bitfinex()
+    bitfinex.setup_connections()
+    print "%-7s %-9s %7s %10s %10s" % ('stage', 'market', 'count', 'p50 ms', 'p99 ms')
+    for stage, market, count, p50, p99 in Tracer(bitfinex.red).summary(bitfinex.trade_markets(), args.minutes):
+        print "%-7s %-9s %7d %10.1f %10.1f" % (stage, market, count, p50 * 1000, p99 * 1000)
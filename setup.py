@@ -9,7 +9,12 @@ classifiers = [
 setup(
     name='bitfinex-manager',
     version='0.0.9',
-    py_modules=['bitfinex_manager', 'bitfinex_listener'],
+    py_modules=['bitfinex_manager', 'bitfinex_listener', 'bitfinex_tape',
+                'bitfinex_positions', 'bitfinex_sim', 'bitfinex_backfill',
+                'bitfinex_lease', 'bitfinex_trace', 'bitfinex_balances',
+                'bitfinex_scheduler', 'bitfinex_codec', 'bitfinex_http',
+                'bitfinex_accounts', 'bitfinex_retry', 'bitfinex_session',
+                'bitfinex_bench', 'bitfinex_schema'],
     url='https://github.com/gitguild/bitfinex-manager',
     license='MIT',
     classifiers=classifiers,
@@ -28,5 +33,14 @@ setup(
 [console_scripts]
 bitfinexm = bitfinex_manager:main
 bitfinexl = bitfinex_listener:main
+bitfinexp = bitfinex_positions:main
+bitfinexsim = bitfinex_sim:main
+bitfinexb = bitfinex_backfill:main
+bitfinext = bitfinex_trace:main
+bitfinexcodec = bitfinex_codec:main
+bitfinexa = bitfinex_accounts:main
+bitfinexsoak = bitfinex_session:main
+bitfinexbench = bitfinex_bench:main
+bitfinexschema = bitfinex_schema:main
 """
 )
@@ -0,0 +1,16 @@
+"""
+Fakes shared by the tests.
+"""
+from bitfinex_bench import MemoryRedis
+
+FakeRedis = MemoryRedis  # the subset of redis the plugin uses, in memory, as for the offline benchmarks
+
+
+class Clock(object):
+    """
+    Stands in for time.time, set now to move it.
+    """
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,71 @@
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+
+from bitfinex_accounts import AccountConfig, AccountRedis, read_accounts
+from bitfinex_balances import publish_balances, read_balances
+from bitfinex_positions import CHECKPOINT_KEY, LOCK_KEY
+from bitfinex_scheduler import mark_activity
+from test.fakes import FakeRedis
+
+CFG = """
+[bitfinex]
+key: rootkey
+secret: rootsecret
+userpubkey: rootuser
+live: true
+accounts: sub1, sub2
+
+[bitfinex_sub1]
+key: key1
+secret: secret1
+userpubkey: user1
+
+[bitfinex_sub2]
+key: key2
+secret: secret2
+userpubkey: user2
+"""
+
+
+class ScriptRedis(FakeRedis):
+    def register_script(self, script):
+        return lambda keys=(), args=(): (script, list(keys), list(args))
+
+
+def config():
+    cfg = ConfigParser()
+    cfg.readfp(StringIO(CFG))
+    return cfg
+
+
+def test_read_accounts_and_overlay():
+    cfg = config()
+    accounts = read_accounts(cfg)
+    assert [name for name, credentials in accounts] == ['sub1', 'sub2']
+    overlay = AccountConfig(cfg, accounts[1][1])
+    assert overlay.get('bitfinex', 'key') == 'key2'
+    assert overlay.get('bitfinex', 'userpubkey') == 'user2'
+    assert overlay.getboolean('bitfinex', 'live')
+    assert cfg.get('bitfinex', 'key') == 'rootkey'
+    cfg.remove_option('bitfinex', 'accounts')
+    assert read_accounts(cfg) == []
+
+
+def test_account_state_is_kept_apart():
+    red = ScriptRedis()
+    sub1 = AccountRedis(red, 'sub1')
+    sub2 = AccountRedis(red, 'sub2')
+    publish_balances(sub1, {'BTC': (1.0, 0.5)}, now=100)
+    publish_balances(sub2, {'BTC': (2.0, 2.0)}, now=100)
+    assert read_balances(sub1) == {'BTC': (1.0, 0.5)}
+    assert read_balances(sub2) == {'BTC': (2.0, 2.0)}
+    assert read_balances(red) == {}
+    mark_activity(sub1, 'trades', now=5)
+    assert red.get('bitfinex_activity|trades|sub1') == '5'
+    # market data stays shared, and so do the positions, as trades are not tied to an account
+    sub1.set('bitfinex_BTC_USD_ticker', '{}')
+    assert 'bitfinex_BTC_USD_ticker' in red.data
+    assert sub1.key(CHECKPOINT_KEY) == CHECKPOINT_KEY and sub2.key(LOCK_KEY) == LOCK_KEY
+    script = sub2.register_script('return 1')
+    assert script(keys=['bitfinex_lease|orders'], args=['node']) == ('return 1', ['bitfinex_lease|orders|sub2'],
+                                                                     ['node'])
@@ -0,0 +1,72 @@
+import logging
+from StringIO import StringIO
+
+from bitfinex_backfill import Backfill, Window, split_windows, fetch_pages
+from test.fakes import FakeRedis
+
+
+def test_split_windows():
+    windows = split_windows('trades', ['BTC_USD', 'ETH_BTC'], 0, 250, 100)
+    assert [(w.key, w.begin, w.end) for w in windows] == [('BTC_USD', 200, 250), ('BTC_USD', 100, 200),
+                                                          ('BTC_USD', 0, 100), ('ETH_BTC', 200, 250),
+                                                          ('ETH_BTC', 100, 200), ('ETH_BTC', 0, 100)]
+    assert windows[0].name == 'trades|BTC_USD|200|250'
+    assert [(w.begin, w.end) for w in split_windows('trades', ['BTC_USD'], 30, 300, 100)] == \
+        [(200, 300), (100, 200), (30, 100)]
+
+
+def test_fetch_pages_until_window_start():
+    history = [{'tid': i, 'timestamp': str(i)} for i in range(100, 0, -1)]
+    calls = []
+
+    def fetch(key, begin, end):
+        calls.append(end)
+        if len(calls) == 2:
+            return {'message': 'Nonce is too small.'}
+        return [r for r in history if begin <= float(r['timestamp']) <= end][:10]
+
+    pages = []
+    fetch_pages(fetch, Window('trades', 'BTC_USD', 75, 100), pages.append, limit=10, sleep=lambda s: None)
+    seen = set(r['tid'] for page in pages for r in page)
+    assert seen == set(range(75, 101))
+    assert calls[1] == calls[2]  # retried the failed page
+
+
+class FakeSession(object):
+    def commit(self):
+        pass
+
+
+class BackfillPlugin(object):
+    def __init__(self):
+        self.red = FakeRedis()
+        self.session = FakeSession()
+        self.logger = logging.getLogger('test_backfill')
+        self.fetched = []
+
+    def trade_markets(self):
+        return ['BTC_USD']
+
+    def movement_currencies(self):
+        return set(['BTC'])
+
+    def get_trades_history(self, begin=None, end=None, market=None, limit=None):
+        self.fetched.append(('trades', begin, end))
+        return []
+
+    def get_dw_history(self, currency, begin=None, end=None):
+        self.fetched.append(('movements', begin, end))
+        return []
+
+    def begin_unit(self):
+        pass
+
+
+def test_rerun_later_skips_done_windows():
+    plugin = BackfillPlugin()
+    assert Backfill(plugin, 0, 1037, window_size=100, workers=2, out=StringIO()).run() == 0
+    assert len(plugin.fetched) == 22
+    plugin.fetched = []
+    # resumed 37 seconds later, only the window which was still open at the first run's end is fetched again
+    assert Backfill(plugin, 0, 1074, window_size=100, workers=2, out=StringIO()).run() == 0
+    assert sorted(plugin.fetched) == [('movements', 1000, 1074), ('trades', 1000, 1074)]
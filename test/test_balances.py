@@ -0,0 +1,29 @@
+from bitfinex_balances import BalanceCache, read_balances, rest_check_due, mark_rest_checked
+from test.fakes import FakeRedis
+
+
+def test_debounced_changes():
+    red = FakeRedis()
+    cache = BalanceCache(red, debounce=1.0)
+    assert cache.update('BTC', 1.5, None, now=100)
+    assert not cache.update('BTC', '1.5', now=100.2)
+    assert cache.update('USD', 200, 150, now=100.5)
+    assert cache.update('BTC', 1.25, 1.0, now=100.6)
+    assert read_balances(red) == {'BTC': (1.25, 1.0), 'USD': (200.0, 150.0)}
+    assert not cache.due(now=100.9)
+    assert cache.due(now=101.0)
+    assert cache.drain() == [('BTC', 1.25, 1.0), ('USD', 200.0, 150.0)]
+    assert not cache.due(now=200)
+    # an update without available keeps the last known
+    assert cache.update('USD', 180, now=300)
+    assert cache.drain() == [('USD', 180.0, 150.0)]
+
+
+def test_rest_check_only_periodic_while_live():
+    red = FakeRedis()
+    assert rest_check_due(red, 300, now=1000)
+    BalanceCache(red).alive()
+    assert rest_check_due(red, 300, now=1000)
+    mark_rest_checked(red, now=1000)
+    assert not rest_check_due(red, 300, now=1200)
+    assert rest_check_due(red, 300, now=1300)
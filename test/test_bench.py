@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+from base64 import b64encode
+
+from bitfinex_bench import Case, MemoryRedis, StubHTTP, cases, compare, load_baseline, mytrades, \
+    save_baseline, stub_http, time_case, trade_history
+
+
+def test_compare_thresholds():
+    baseline = {'cases': {'fast': {'seconds': 1.0}, 'slow': {'seconds': 1.0}, 'tuned': {'seconds': 1.0}},
+                'thresholds': {'tuned': 60}}
+    results = {'fast': {'seconds': 0.5}, 'slow': {'seconds': 1.3}, 'tuned': {'seconds': 1.5},
+               'new': {'seconds': 9.0}}
+    rows = compare(baseline, results, threshold=25)
+    assert [(name, regressed) for name, base, now, change, regressed in rows] == \
+        [('fast', False), ('slow', True), ('tuned', False)]
+    assert abs(rows[1][3] - 30.0) < 1e-9
+
+
+def test_baseline_roundtrip():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        save_baseline(path, {'case': {'seconds': 0.25, 'median': 0.3, 'number': 1, 'repeat': 3}}, {'case': 10})
+        baseline = load_baseline(path)
+        assert baseline['cases']['case']['seconds'] == 0.25
+        assert baseline['thresholds'] == {'case': 10}
+    finally:
+        os.remove(path)
+
+
+def test_time_case_keeps_best_run():
+    ticks = iter([0, 4, 10, 12, 20, 26])
+    calls = []
+
+    def setup(number):
+        calls.append(number)
+        return lambda: None
+    result = time_case(Case('case', setup, 2), repeat=3, timer=lambda: next(ticks))
+    assert calls == [2, 2, 2]
+    assert result['seconds'] == 1 and result['median'] == 2
+
+
+def test_memory_redis_pipeline():
+    red = MemoryRedis()
+    pipe = red.pipeline()
+    pipe.hsetnx('trace', 'create', 1)
+    pipe.hsetnx('trace', 'create', 2)
+    pipe.hincrby('hist', 3, 1)
+    pipe.hgetall('trace')
+    assert pipe.execute() == [1, 0, 1, {'create': '1'}]
+    red.set('key', 1.5)
+    assert red.mget(['key', 'missing']) == ['1.5', None]
+
+
+def test_stub_pages_trade_history():
+    stub = StubHTTP({'mytrades': mytrades(trade_history(5))})
+
+    def post(params):
+        headers = {'X-BFX-PAYLOAD': b64encode(json.dumps(params))}
+        return stub.post('http://stub/v1/mytrades', headers=headers).json()
+    first = post({'symbol': 'btcusd', 'limit_trades': 3})
+    assert [r['tid'] for r in first] == [5000004, 5000003, 5000002]
+    rest = post({'symbol': 'btcusd', 'limit_trades': 3, 'until': first[-1]['timestamp']})
+    assert [r['tid'] for r in rest] == [5000001, 5000000]
+    assert post({'symbol': 'ethusd'}) == [] and stub.requests == 3
+
+
+def test_stub_http_is_restored():
+    import bitfinex_manager
+    http = bitfinex_manager.http
+    try:
+        with stub_http({}) as stub:
+            assert bitfinex_manager.http is stub
+            raise ValueError()
+    except ValueError:
+        pass
+    assert bitfinex_manager.http is http
+
+
+def test_every_case_runs():
+    for case in cases():
+        case.setup(1)()
@@ -0,0 +1,68 @@
+import json
+import struct
+
+from bitfinex_codec import CodecError, HEADER, decode, decode_book, decode_ticker, encode_rest_book, encode_ticker
+
+
+def test_ticker_round_trip():
+    data = encode_ticker('BTC_USD', '430.12', 430.25, 430.2, 441, 422.31, '12345.67891234', when=1462104000.5)
+    tick = decode_ticker(data)
+    assert tick['market'] == 'BTC_USD'
+    assert tick['time'] == 1462104000.5
+    assert tick['bid'] == 430.12 and tick['ask'] == 430.25 and tick['last'] == 430.2
+    assert tick['high'] == 441.0 and tick['low'] == 422.31 and tick['volume'] == 12345.67891234
+    assert decode(data) == tick
+    assert len(data) < len(json.dumps(tick))
+
+
+def test_book_round_trip():
+    book = {'bids': [{'price': '430.1', 'amount': '1.5', 'timestamp': '1462104000.0'},
+                     {'price': '430.0', 'amount': '0.25', 'timestamp': '1462104000.0'}],
+            'asks': [{'price': '430.2', 'amount': '3', 'timestamp': '1462104000.0'}]}
+    data = encode_rest_book('ETH_BTC', book, when=1462104000)
+    decoded = decode_book(data)
+    assert decoded['market'] == 'ETH_BTC'
+    assert decoded['bids'] == [(430.1, 1.5), (430.0, 0.25)]
+    assert decoded['asks'] == [(430.2, 3.0)]
+    assert decode(data) == decoded
+    try:
+        decode_book(data[:-1])
+        assert False
+    except CodecError:
+        pass
+
+
+def test_rejects_unknown_version_and_magic():
+    data = encode_ticker('BTC_USD', 1, 2, 3, 4, 5, 6)
+    for bad in (struct.pack('<2sB', 'BF', 2) + data[3:], 'XX' + data[2:]):
+        try:
+            decode(bad)
+            assert False
+        except CodecError:
+            pass
+    try:
+        decode_book(data)
+        assert False
+    except CodecError:
+        pass
+    assert HEADER.size == 20
+
+
+def test_rejects_long_market():
+    assert decode_ticker(encode_ticker('DASH_USD', 1, 2, 3, 4, 5, 6))['market'] == 'DASH_USD'
+    try:
+        encode_ticker('DASH_USDT', 1, 2, 3, 4, 5, 6)
+        assert False
+    except CodecError:
+        pass
+
+
+def test_unicode_market_and_truncated_ticker():
+    data = encode_ticker(u'BTC_USD', 1, 2, 3, 4, 5, 6)
+    assert decode_ticker(data)['market'] == 'BTC_USD'
+    for bad in (lambda: decode_ticker(data[:-1]), lambda: encode_ticker(u'BTC_\xfcSD', 1, 2, 3, 4, 5, 6)):
+        try:
+            bad()
+            assert False
+        except CodecError:
+            pass
@@ -16,9 +16,9 @@ from trade_manager.plugin import get_orders, get_trades, sync_ticker, get_debits
     make_ledger, get_ticker, get_balances, create_order, sync_orders, cancel_orders, sync_credits, sync_debits, \
     sync_trades, get_order_by_order_id
 
-bitfinex = Bitfinex()  # session=ses)
-bitfinex.setup_connections()
-SCHEMAS = get_schemas()
+# connected in TestPluginRunning.setUpClass, so collecting these tests needs no config, database or redis
+bitfinex = None
+SCHEMAS = None
 
 
 def test_commodities():
@@ -28,8 +28,8 @@ def test_commodities():
            'LTC': 'ltc',
            'USD': 'usd'}
     for good in map:
-        assert bitfinex.unformat_commodity(good) == map[good]
-        assert bitfinex.format_commodity(map[good]) == good
+        assert Bitfinex.unformat_commodity(good) == map[good]
+        assert Bitfinex.format_commodity(map[good]) == good
 
 
 def test_markets():
@@ -37,11 +37,19 @@ def test_markets():
            'ETH_BTC': 'ethbtc',
            'LTC_BTC': 'ltcbtc'}
     for good in map:
-        assert bitfinex.unformat_market(good) == map[good]
-        assert bitfinex.format_market(map[good]) == good
+        assert Bitfinex.unformat_market(good) == map[good]
+        assert Bitfinex.format_market(map[good]) == good
 
 
 class TestPluginRunning(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        global bitfinex, SCHEMAS
+        if bitfinex is None:
+            bitfinex = Bitfinex()  # session=ses)
+            bitfinex.setup_connections()
+            SCHEMAS = get_schemas()
+
     def setUp(self):
         start_test_man('bitfinex')
 
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from bitfinex_http import MIN_SAMPLES, AdaptiveClient, CircuitBreaker, CircuitOpen
+from test.fakes import Clock
+
+
+def warm(client, name, latency=0.0):
+    for i in range(MIN_SAMPLES):
+        client.endpoint(name).latency.add(latency)
+
+
+def test_timeout_follows_latency():
+    client = AdaptiveClient(10, min_timeout=0.5)
+    assert client.timeout('book') == 10
+    assert client.hedge_delay('book') is None
+    warm(client, 'book', 0.5)
+    assert client.timeout('book') == 1.5
+    assert client.hedge_delay('book') == 0.5
+    warm(client, 'pubticker', 0.01)
+    assert client.timeout('pubticker') == 0.5
+
+
+def test_breaker_opens_and_probes():
+    clock = Clock()
+    client = AdaptiveClient(clock=clock)
+
+    def fail(timeout):
+        raise IOError("timeout")
+    for i in range(5):
+        try:
+            client.request('/v1/balances', fail)
+            assert False
+        except CircuitOpen:
+            assert False
+        except IOError:
+            pass
+    calls = []
+    try:
+        client.request('/v1/balances', lambda timeout: calls.append(timeout))
+        assert False
+    except CircuitOpen:
+        pass
+    assert calls == []
+    clock.now += 30
+    client.request('/v1/balances', lambda timeout: calls.append(timeout))
+    assert len(calls) == 1
+    assert client.endpoint('/v1/balances').breaker.state == 'closed'
+    stats = client.stats()['/v1/balances']
+    assert stats['failures'] == 5 and stats['rejected'] == 1
+
+
+def test_breaker_trial_failure_reopens():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, reset_after=10, clock=clock)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+
+
+def test_hedge_takes_the_faster_copy():
+    client = AdaptiveClient()
+    warm(client, 'pubticker', 0.01)
+    release = threading.Event()
+    calls = []
+
+    def send(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            release.wait(5)
+            return 'slow'
+        return 'fast'
+    started = time.time()
+    assert client.hedged('pubticker', send) == 'fast'
+    assert time.time() - started < 1
+    release.set()
+    stats = client.stats()['pubticker']
+    assert stats['hedges'] == 1 and stats['hedge_wins'] == 1
+
+
+def test_order_placing_keeps_fixed_timeout():
+    client = AdaptiveClient(10, min_timeout=0.5)
+    warm(client, '/v1/order/new', 0.01)
+    assert client.timeout('/v1/order/new') == 10
+    assert client.hedge_delay('/v1/order/new') is None
+    calls = []
+    client.hedged('/v1/order/new', lambda timeout: calls.append(timeout))
+    assert calls == [10]
@@ -0,0 +1,69 @@
+import time
+
+from bitfinex_lease import LeaseManager, RENEW_SCRIPT, RELEASE_SCRIPT, LEASE_PREFIX
+from test.fakes import FakeRedis
+
+
+class LeaseRedis(FakeRedis):
+    """
+    Runs the lease scripts, without expiry.
+    """
+
+    def register_script(self, script):
+        def run(keys, args):
+            if self.data.get(keys[0]) != args[0]:
+                return 0
+            if script == RELEASE_SCRIPT:
+                del self.data[keys[0]]
+            return 1
+        assert script in (RENEW_SCRIPT, RELEASE_SCRIPT)
+        return run
+
+
+def test_tasks_spread_and_fail_over():
+    red = LeaseRedis()
+    tasks = ['trades|BTC_USD', 'trades|ETH_BTC', 'balances', 'orders']
+    one = LeaseManager(red, node='one', tasks=len(tasks))
+    assert all(one.claim(t) for t in tasks)
+    two = LeaseManager(red, node='two', tasks=len(tasks))
+    assert not any(two.claim(t) for t in tasks)
+    # one sees a second live node and hands over tasks beyond its share as it renews them
+    owned_by_one = [t for t in tasks if one.claim(t)]
+    assert len(owned_by_one) == 2
+    owned_by_two = [t for t in tasks if two.claim(t)]
+    assert sorted(owned_by_one + owned_by_two) == sorted(tasks)
+    # one dies, its leases expire and two takes over
+    for task in owned_by_one:
+        del red.data[LEASE_PREFIX + task]
+    del red.data['bitfinex_nodes']['one']
+    assert all(two.claim(t) for t in tasks)
+
+
+def test_order_claimed_once():
+    red = LeaseRedis()
+    one = LeaseManager(red, node='one')
+    two = LeaseManager(red, node='two')
+    assert one.claim_order(7)
+    assert not two.claim_order(7)
+    assert one.claim_order(7)
+
+
+def test_expired_lease_is_claimed_again():
+    red = LeaseRedis()
+    one = LeaseManager(red, node='one', tasks=2)
+    assert one.claim('orders')
+    del red.data[LEASE_PREFIX + 'orders']  # the task ran less often than the ttl
+    assert one.claim('orders') and one.held == set(['orders'])
+    red.data[LEASE_PREFIX + 'orders'] = 'two'  # expired and taken over meanwhile
+    assert not one.claim('orders') and one.held == set()
+
+
+def test_heartbeat_runs_on_its_own():
+    red = LeaseRedis()
+    one = LeaseManager(red, node='one').start_heartbeat(0.01)
+    deadline = time.time() + 2
+    while 'one' not in red.data.get('bitfinex_nodes', {}) and time.time() < deadline:
+        time.sleep(0.01)
+    assert 'one' in red.data['bitfinex_nodes']
+    one.release_all()
+    assert one.stopped.is_set()
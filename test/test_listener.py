@@ -0,0 +1,127 @@
+import hmac
+import json
+from hashlib import sha384
+
+import bitfinex_listener
+from bitfinex_balances import BalanceCache, LIVE_KEY
+from bitfinex_codec import binary_key, decode_ticker
+from bitfinex_sim import MatchingEngine, SimWebSocketApp
+from test.fakes import FakeRedis
+
+
+class FakeTracer(object):
+    def __init__(self):
+        self.stamps = []
+
+    def stamp(self, order_id, stage, market):
+        self.stamps.append((order_id, stage))
+
+
+class FakeSession(object):
+    def commit(self):
+        pass
+
+
+class FakePlugin(object):
+    binary_market_data = False
+
+    def __init__(self):
+        self.trades = []
+        self.orders = []
+        self.tracer = FakeTracer()
+        self.session = FakeSession()
+
+    def begin_unit(self):
+        pass
+
+    def format_commodity(self, c):
+        return c.upper()
+
+    def update_balance(self, currency, total, available, reference):
+        pass
+
+    def add_trade(self, **kwargs):
+        self.trades.append(kwargs)
+        return kwargs
+
+    def add_order(self, *args, **kwargs):
+        self.orders.append(kwargs['order_id'])
+        return kwargs
+
+    def checkpoint_positions(self):
+        pass
+
+
+def setup_root():
+    plugin = FakePlugin()
+    red = FakeRedis()
+    bitfinex_listener.root.plugin, bitfinex_listener.root.red = plugin, red
+    bitfinex_listener.root.balance_cache = BalanceCache(red)
+    bitfinex_listener.root.channels = {}
+    bitfinex_listener.ready.set()
+    bitfinex_listener.failed.clear()
+    return plugin, red
+
+
+def deliver(ws):
+    while not ws.frames.empty():
+        bitfinex_listener.on_message(ws, ws.frames.get())
+
+
+def test_account_trade_frames():
+    engine = MatchingEngine(prices={'btcusd': 400.0})
+    maker = engine.add_account('maker', 'makersecret', {'btc': 10.0, 'usd': 10000.0})
+    taker = engine.add_account('taker', 'takersecret', {'btc': 10.0, 'usd': 10000.0})
+    engine.new_order(maker, 'btcusd', 'sell', 1, 405)
+    engine.new_order(taker, 'btcusd', 'buy', 1, 405)  # history, sent in the ts snapshot
+    plugin, red = setup_root()
+    ws = SimWebSocketApp(engine)
+    ws.send(json.dumps({'event': 'auth', 'apiKey': 'taker', 'authPayload': 'AUTH1',
+                        'authSig': hmac.new('takersecret', 'AUTH1', sha384).hexdigest()}))
+    deliver(ws)
+    assert [t['tid'] for t in plugin.trades] == [str(taker.trades[0]['tid'])]
+    assert plugin.tracer.stamps == []  # snapshot rows are not stamped
+    engine.new_order(maker, 'btcusd', 'sell', 0.5, 410)
+    order = engine.new_order(taker, 'btcusd', 'buy', 0.5, 410)
+    deliver(ws)
+    fill = plugin.trades[-1]
+    assert fill['tid'] == str(taker.trades[-1]['tid'])
+    assert fill['market'] == 'BTC_USD' and fill['trade_side'] == 'buy' and fill['amount'] == 0.5
+    assert (str(order.id), 'fill') in plugin.tracer.stamps
+    assert (str(order.id), 'listed') in plugin.tracer.stamps
+
+
+def test_only_account_heartbeats_keep_balances_live():
+    plugin, red = setup_root()
+    on_message = bitfinex_listener.on_message
+    on_message(None, json.dumps({'event': 'subscribed', 'channel': 'ticker', 'chanId': 5, 'pair': 'BTCUSD'}))
+    on_message(None, json.dumps([5, 'hb']))
+    on_message(None, json.dumps([0, 'hb']))  # before auth
+    on_message(None, json.dumps({'event': 'auth', 'status': 'FAIL', 'chanId': 0, 'code': 10100}))
+    on_message(None, json.dumps([0, 'hb']))
+    assert LIVE_KEY not in red.data
+    on_message(None, json.dumps({'event': 'auth', 'status': 'OK', 'chanId': 0, 'userId': 1}))
+    on_message(None, json.dumps([0, 'hb']))
+    assert LIVE_KEY in red.data
+
+
+def test_binary_ticker_from_subscribed_pair():
+    plugin, red = setup_root()
+    plugin.binary_market_data = True
+    bitfinex_listener.on_message(None, json.dumps({'event': 'subscribed', 'channel': 'ticker', 'chanId': 5,
+                                                   'pair': 'BTCUSD'}))
+    bitfinex_listener.on_message(None, json.dumps([5, 430.1, 1, 430.2, 1, 0, 0, 430.15, 100, 440, 420]))
+    assert json.loads(red.get('bitfinex_BTC_USD_ticker'))['last'] == 430.15
+    assert decode_ticker(red.get(binary_key('bitfinex_BTC_USD_ticker')))['bid'] == 430.1
+
+
+def test_failed_setup_closes_the_socket():
+    setup_root()
+    bitfinex_listener.failed.set()
+    try:
+        ws = SimWebSocketApp(MatchingEngine(prices={'btcusd': 400.0}), on_message=bitfinex_listener.on_message)
+        ws.send(json.dumps({'event': 'subscribe', 'channel': 'ticker', 'pair': 'BTCUSD'}))
+        ws.run_forever()  # returns once the listener closes the socket
+        assert ws.closed and ws.frames.qsize() == 1
+    finally:
+        bitfinex_listener.failed.clear()
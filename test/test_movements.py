@@ -0,0 +1,52 @@
+import logging
+from ConfigParser import RawConfigParser
+
+from bitfinex_manager import Bitfinex, MOVEMENT_FLAGS_KEY
+from test.fakes import FakeRedis
+
+
+class FakeSession(object):
+    def get_bind(self):
+        return None
+
+
+class MovementsPlugin(Bitfinex):
+    """
+    Answers history/movements from a dict of currency to response.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.cfg = RawConfigParser()
+        self.cfg.add_section('bitfinex')
+        self.logger = logging.getLogger('test_movements')
+        self.red = FakeRedis()
+        self.active_currencies = sorted(responses)
+
+    def get_dw_history(self, currency, begin=None, end=None):
+        return self.responses[currency]
+
+
+def test_failed_request_keeps_flags():
+    plugin = MovementsPlugin({'BTC': {'message': 'ERR_RATE_LIMIT'}, 'ETH': {'error': 'ERR'}, 'LTC': []})
+    plugin.red.hset(MOVEMENT_FLAGS_KEY, 'ETH', 'seen')
+    assert plugin.sync_movements(rescan=True) == 0
+    flags = plugin.red.hgetall(MOVEMENT_FLAGS_KEY)
+    assert 'BTC' not in flags and flags['ETH'] == 'seen'
+    assert flags['LTC'].startswith('empty|')
+    # an empty listing does not downgrade a currency which had movements
+    plugin.responses['ETH'] = []
+    plugin.sync_movements(rescan=True)
+    assert plugin.red.hgetall(MOVEMENT_FLAGS_KEY)['ETH'] == 'seen'
+
+
+def test_sync_on_account_context():
+    plugin = MovementsPlugin({'BTC': [], 'ETH': []})
+    plugin.session = FakeSession()
+    plugin.cfg.set('bitfinex', 'session_recycle_units', '0')
+    context = plugin.account_context('sub1', {'key': 'key1', 'secret': 'secret1', 'userpubkey': 'user1'})
+    assert context.active_currencies == ['BTC', 'ETH'] and context.active_currencies is not plugin.active_currencies
+    assert context.key == 'key1' and context.cfg.get('bitfinex', 'userpubkey') == 'user1'
+    assert context.sync_credits(rescan=True) == 0
+    assert set(plugin.red.hgetall(MOVEMENT_FLAGS_KEY + '|sub1')) == set(['BTC', 'ETH'])
+    assert plugin.red.hgetall(MOVEMENT_FLAGS_KEY) == {}
@@ -0,0 +1,151 @@
+import datetime
+
+from bitfinex_positions import CHECKPOINT_KEY, LOCK_KEY, LockTimeout, Position, PositionTracker, \
+    checkpoint_lock, record, update_checkpoint, verify
+from test.fakes import FakeRedis
+
+
+class FakeTrade(object):
+    def __init__(self, tid, market, side, amount, price, fee, fee_side, dtime):
+        self.trade_id = 'bitfinex|%s' % tid
+        self.exchange = 'bitfinex'
+        self.market = market
+        self.side = side
+        self.amount = amount
+        self.price = price
+        self.fee = fee
+        self.fee_side = fee_side
+        self.time = dtime
+
+
+class FakeQuery(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, *conditions):
+        return FakeQuery([r for r in self.rows if all(condition(r) for condition in conditions)])
+
+    def order_by(self, *args):
+        return iter(sorted(self.rows, key=lambda t: t.time))
+
+
+class FakeSession(object):
+    """
+    The trades committed to the database.
+    """
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def query(self, model):
+        return FakeQuery(self.rows)
+
+
+class FakeColumn(object):
+    """
+    Compares to a condition on a FakeTrade, which FakeQuery.filter applies.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return lambda row: getattr(row, self.name) == value
+
+    def __ge__(self, value):
+        return lambda row: getattr(row, self.name) >= value
+
+
+class FakeTradeModel(object):
+    exchange = FakeColumn('exchange')
+    market = FakeColumn('market')
+    time = FakeColumn('time')
+
+
+def test_average_cost_and_realized():
+    pos = Position('BTC_USD')
+    pos.apply('buy', 1.0, 100.0, 0.1, 'quote')
+    pos.apply('buy', 1.0, 200.0, 0.001, 'base')
+    assert pos.net == 2.0
+    assert pos.avg_cost == 150.0
+    pos.apply('sell', 1.5, 250.0)
+    assert pos.net == 0.5
+    assert pos.realized == 150.0
+    assert pos.avg_cost == 150.0
+    pos.apply('sell', 1.5, 100.0)
+    assert pos.net == -1.0
+    assert pos.realized == 150.0 - 25.0
+    assert pos.avg_cost == 100.0
+    assert pos.fee_quote == 0.1
+    assert pos.fee_base == 0.001
+    assert pos.trades == 4
+
+
+def test_checkpoint_skips_known_trades():
+    now = datetime.datetime(2016, 5, 1, 12)
+    trades = [FakeTrade(1, 'BTC_USD', 'buy', 1.0, 400.0, 0.8, 'quote', now),
+              FakeTrade(2, 'BTC_USD', 'sell', 0.5, 420.0, 0.4, 'quote', now)]
+    tracker = PositionTracker()
+    assert tracker.extend(reversed(trades))
+    red = FakeRedis()
+    tracker.checkpoint(red)
+    restored = PositionTracker.restore(red)
+    assert restored['BTC_USD'].close_to(tracker['BTC_USD'])
+    assert not restored.apply_trade(trades[1])
+    later = FakeTrade(3, 'BTC_USD', 'sell', 0.5, 440.0, 0.4, 'quote', now + datetime.timedelta(seconds=1))
+    assert restored.extend([later])
+    assert restored['BTC_USD'].net == 0
+    assert restored['BTC_USD'].realized == 10.0 + 20.0
+    older = FakeTrade(4, 'BTC_USD', 'buy', 0.5, 440.0, 0.4, 'quote', now - datetime.timedelta(seconds=1))
+    assert restored.extend([older, later]) == 1
+    assert restored['BTC_USD'].net == 0.5 and restored['BTC_USD'].trades == 4
+
+
+def test_window_is_pruned():
+    now = datetime.datetime(2016, 5, 1, 12)
+    tracker = PositionTracker(window=60)
+    tracker.extend([FakeTrade(1, 'BTC_USD', 'buy', 1.0, 400.0, 0.8, 'quote', now),
+                    FakeTrade(2, 'BTC_USD', 'buy', 1.0, 400.0, 0.8, 'quote', now + datetime.timedelta(seconds=61))])
+    red = FakeRedis()
+    tracker.checkpoint(red)
+    restored = PositionTracker.restore(red)
+    assert sorted(restored.applied) == ['2'] and restored.since == tracker.last_time - 60
+
+
+def test_writers_do_not_overwrite_each_other():
+    now = datetime.datetime(2016, 5, 1, 12)
+    red = FakeRedis()
+    listener_fill = FakeTrade(1, 'BTC_USD', 'buy', 1.0, 400.0, 0.8, 'quote', now)
+    # the listener inserts and checkpoints a fill, then the manager inserts an old trade found by paging back
+    update_checkpoint(red, FakeSession([listener_fill]), FakeTradeModel, [record(listener_fill)])
+    paged = FakeTrade(2, 'BTC_USD', 'buy', 1.0, 500.0, 0.8, 'quote', now - datetime.timedelta(days=3))
+    tracker = update_checkpoint(red, FakeSession([listener_fill, paged]), FakeTradeModel, [record(paged)])
+    assert tracker['BTC_USD'].net == 2.0 and tracker['BTC_USD'].trades == 2
+    assert PositionTracker.restore(red)['BTC_USD'].avg_cost == 450.0
+    assert LOCK_KEY not in red.data and CHECKPOINT_KEY in red.data
+
+
+def test_lock_times_out():
+    red = FakeRedis()
+    red.set(LOCK_KEY, 'other')
+    try:
+        with checkpoint_lock(red, wait=0.05):
+            assert False
+    except LockTimeout:
+        pass
+    assert red.get(LOCK_KEY) == 'other'
+
+
+def test_late_trade_replays_its_market():
+    now = datetime.datetime(2016, 5, 1, 12)
+    red = FakeRedis()
+    buy = FakeTrade(1, 'BTC_USD', 'buy', 1.0, 400.0, 0, 'quote', now)
+    sell = FakeTrade(2, 'BTC_USD', 'sell', 1.0, 500.0, 0, 'quote', now + datetime.timedelta(seconds=2))
+    other = FakeTrade(3, 'ETH_BTC', 'buy', 1.0, 0.02, 0, 'quote', now + datetime.timedelta(seconds=3))
+    update_checkpoint(red, FakeSession([buy, sell, other]), FakeTradeModel, [record(buy), record(sell), record(other)])
+    late = FakeTrade(4, 'BTC_USD', 'buy', 1.0, 300.0, 0, 'quote', now + datetime.timedelta(seconds=1))
+    session = FakeSession([buy, sell, other, late])
+    tracker = update_checkpoint(red, session, FakeTradeModel, [record(late)])
+    assert tracker['BTC_USD'].realized == 150.0 and tracker['BTC_USD'].avg_cost == 350.0
+    assert tracker['BTC_USD'].trades == 3 and tracker['ETH_BTC'].trades == 1 and not tracker.stale
+    assert verify(PositionTracker.restore(red), session, FakeTradeModel) == []
@@ -0,0 +1,85 @@
+import logging
+from ConfigParser import RawConfigParser
+
+from bitfinex_manager import Bitfinex
+from bitfinex_retry import RetryQueue
+from test.fakes import Clock, FakeRedis
+
+
+def test_backoff_until_visible():
+    clock = Clock()
+    submitted = []
+    red = FakeRedis()
+    queue = RetryQueue(lambda oid, expire: submitted.append((oid, expire)), red=red, base_delay=0.1, max_delay=0.4,
+                       clock=clock)
+    assert queue.retry(1)
+    assert queue.retry(2, expire=1000.5)
+    assert abs(queue.next_due() - 1000.1) < 1e-9
+    assert queue.run_due() == 0
+    clock.now = 1000.1
+    assert queue.run_due() == 2
+    assert submitted == [(1, None), (2, 1000.5)]
+    # the next attempts back off
+    assert queue.retry(1)
+    assert queue.retry(2)
+    assert abs(queue.next_due() - 1000.3) < 1e-9
+    clock.now = 1000.3
+    queue.run_due()
+    assert queue.retry(1)
+    assert not queue.retry(2)  # 1000.3 + 0.4 is past its expire time
+    clock.now = 1000.5
+    queue.found(1)
+    metrics = queue.metrics()
+    assert metrics['waiting'] == 0 and metrics['found'] == 1 and metrics['gave_up'] == 1
+    assert metrics['retries'] == 5
+    assert abs(metrics['wait_p50'] - 0.5) < 1e-9
+    assert 'bitfinex_order_retries' in red.data
+
+
+def test_found_without_waiting_is_not_counted():
+    queue = RetryQueue(lambda oid, expire: None, clock=Clock())
+    queue.found(7)
+    assert queue.metrics()['found'] == 0
+
+
+class FakeQuery(object):
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        return None
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+        self.calls = []
+
+    def query(self, *args):
+        self.calls.append('query')
+        return FakeQuery()
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+
+class RetryPlugin(Bitfinex):
+    def __init__(self, queue):
+        self.cfg = RawConfigParser()
+        self.cfg.add_section('bitfinex')
+        self.cfg.set('bitfinex', 'session_recycle_units', '0')
+        self.session = FakeSession()
+        self.logger = logging.getLogger('test_retry')
+        self._retries = queue
+
+
+def test_retry_starts_a_new_transaction():
+    queue = RetryQueue(lambda oid, expire: None, clock=Clock())
+    plugin = RetryPlugin(queue)
+    assert plugin.create_order(3) is None
+    assert plugin.session.calls == ['query', 'rollback'] and 3 in queue.pending
+    plugin.session.new.append(object())  # never discard another unit's work
+    plugin.create_order(3)
+    assert plugin.session.calls[-1] == 'query'
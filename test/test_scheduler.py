@@ -0,0 +1,52 @@
+from bitfinex_scheduler import Scheduler, mark_activity
+from test.fakes import Clock, FakeRedis
+
+
+def test_backoff_and_activity():
+    red = FakeRedis()
+    clock = Clock()
+    results = []
+    scheduler = Scheduler(red, clock=clock)
+    trades = scheduler.add('trades', lambda: results.pop(0), 10, 60, activity='trades')
+    results.extend([5, 0, 0, 0, 0])
+    assert scheduler.run_due() == 1
+    assert trades.interval == 10 and trades.next_run == 1010
+    for expected in (20, 40, 60, 60):
+        clock.now = trades.next_run
+        assert scheduler.run_due() == 1
+        assert trades.interval == expected
+    assert scheduler.run_due() == 0
+    # listener activity pulls the next run forward and resets the interval
+    clock.now += 1
+    mark_activity(red, 'trades', now=clock.now)
+    results.append(0)
+    assert scheduler.run_due() == 1
+    assert trades.interval == 20
+    metrics = scheduler.metrics()['trades']
+    assert metrics['runs'] == 6 and metrics['changes'] == 1 and metrics['errors'] == 0
+    assert 'bitfinex_scheduler' in red.data
+
+
+def test_errors_back_off():
+    clock = Clock()
+    scheduler = Scheduler(FakeRedis(), clock=clock)
+
+    def fail():
+        raise IOError("down")
+    schedule = scheduler.add('orders', fail, 5, 300)
+    scheduler.run_due()
+    assert schedule.errors == 1
+    assert schedule.interval == 10
+
+
+def test_activity_of_several_kinds():
+    red = FakeRedis()
+    clock = Clock()
+    scheduler = Scheduler(red, clock=clock)
+    orders = scheduler.add('orders', lambda: 0, 5, 300, activity=('orders', 'orders|sub1'))
+    scheduler.run_due()
+    assert orders.interval == 10
+    clock.now += 1
+    mark_activity(red, 'orders|sub1', now=clock.now)
+    assert scheduler.run_due() == 1
+    assert orders.interval == 10 and orders.runs == 2
@@ -0,0 +1,22 @@
+from bitfinex_schema import MISSING, OK, PARTIAL, best_coverage, coverage, explain_prefix, index_name
+
+
+def test_coverage_of_lookup_columns():
+    assert coverage(['order_id', 'exchange'], ('order_id', 'exchange')) == OK
+    assert coverage(['state', 'exchange', 'id'], ('exchange', 'state')) == OK
+    assert coverage(['order_id'], ('order_id', 'exchange')) == PARTIAL
+    assert coverage(['id', 'order_id'], ('order_id',)) is None
+    assert coverage([], ('order_id',)) is None
+
+
+def test_best_coverage_over_indexes():
+    assert best_coverage([['id'], ['trade_id']], ('trade_id',)) == OK
+    assert best_coverage([['user_id'], ['id']], ('user_id', 'currency')) == PARTIAL
+    assert best_coverage([['id']], ('ref_id',)) == MISSING
+    assert best_coverage([], ('ref_id',)) == MISSING
+
+
+def test_names_and_dialects():
+    assert index_name('limit_order', ('exchange', 'state')) == 'ix_limit_order_exchange_state'
+    assert explain_prefix('sqlite') == 'EXPLAIN QUERY PLAN '
+    assert explain_prefix('postgresql') == 'EXPLAIN '
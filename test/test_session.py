@@ -0,0 +1,60 @@
+from bitfinex_session import SessionLifecycle, unit_of_work
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+        self.calls = []
+
+    def expunge_all(self):
+        self.calls.append('expunge_all')
+
+    def close(self):
+        self.calls.append('close')
+
+
+def test_expunge_and_recycle():
+    session = FakeSession()
+    rss = [0]
+    lifecycle = SessionLifecycle(every=3, max_rss=100, rss=lambda: rss[0])
+    assert lifecycle.start_unit(session)
+    assert lifecycle.start_unit(session)
+    assert lifecycle.start_unit(session)
+    assert session.calls == ['expunge_all', 'expunge_all', 'close']
+    rss[0] = 101
+    lifecycle.start_unit(session)
+    assert session.calls[-1] == 'close' and lifecycle.recycles == 2
+    session.dirty.append(object())
+    assert not lifecycle.start_unit(session)
+    assert len(session.calls) == 4 and lifecycle.skipped == 1
+
+
+class Plugin(object):
+    _unit_depth = 0
+
+    def __init__(self):
+        self.units = 0
+
+    def begin_unit(self):
+        if self._unit_depth == 0:
+            self.units += 1
+
+    @unit_of_work
+    def outer(self):
+        return self.inner()
+
+    @unit_of_work
+    def inner(self):
+        """inner doc"""
+        return self._unit_depth
+
+
+def test_nested_calls_are_one_unit():
+    plugin = Plugin()
+    assert plugin.outer() == 2
+    assert plugin.units == 1
+    assert plugin.inner() == 1
+    assert plugin.units == 2 and plugin._unit_depth == 0
+    assert Plugin.inner.__doc__ == 'inner doc'
@@ -0,0 +1,84 @@
+import hmac
+import json
+from base64 import b64encode
+from hashlib import sha384
+
+from bitfinex_sim import MatchingEngine, SimError, SimWebSocketApp
+
+
+def make_engine():
+    engine = MatchingEngine(prices={'btcusd': 400.0})
+    maker = engine.add_account('maker', 'makersecret', {'btc': 10.0, 'usd': 10000.0})
+    taker = engine.add_account('taker', 'takersecret', {'btc': 10.0, 'usd': 10000.0})
+    return engine, maker, taker
+
+
+def test_price_time_matching():
+    engine, maker, taker = make_engine()
+    first = engine.new_order(maker, 'btcusd', 'sell', 1, 410)
+    second = engine.new_order(maker, 'btcusd', 'sell', 1, 410)
+    engine.new_order(maker, 'btcusd', 'sell', 1, 405)
+    assert maker.available('btc') == 7.0
+    bid = engine.new_order(taker, 'btcusd', 'buy', 1.5, 410)
+    assert bid.ack['is_live']
+    assert not bid.live
+    assert first.remaining == 0.5
+    assert second.remaining == 1
+    assert abs(float(bid.status()['avg_execution_price']) - (405 + 410 * 0.5) / 1.5) < 1e-6
+    assert taker.balances['btc'] == 11.5
+    assert len(taker.trades) == 2
+    assert engine.book('btcusd')['asks'] == [{'price': '410.00000000', 'amount': '1.50000000',
+                                              'timestamp': engine.book('btcusd')['asks'][0]['timestamp']}]
+    assert engine.cancel_all(maker) == 2
+    assert maker.available('btc') == maker.balances['btc']
+    assert engine.book('btcusd')['asks'] == []
+
+
+def test_balance_check():
+    engine, maker, taker = make_engine()
+    try:
+        engine.new_order(taker, 'btcusd', 'buy', 100, 400)
+    except SimError as e:
+        assert 'not enough exchange balance' in str(e)
+    else:
+        assert False
+
+
+def test_signature_and_nonce():
+    engine, maker, taker = make_engine()
+    payload = b64encode(json.dumps({'request': '/v1/balances', 'nonce': '5'}))
+    signature = hmac.new('takersecret', payload, sha384).hexdigest()
+    account, params = engine.authenticate('taker', payload, signature)
+    assert account is taker
+    for key, sig in (('taker', signature), ('taker', 'bad'), ('nobody', signature)):
+        try:
+            engine.authenticate(key, payload, sig)
+        except SimError:
+            pass
+        else:
+            assert False
+
+
+def test_websocket_frames():
+    engine, maker, taker = make_engine()
+    ws = SimWebSocketApp(engine)
+    ws.send(json.dumps({'event': 'subscribe', 'channel': 'trades', 'pair': 'BTCUSD'}))
+    ws.send(json.dumps({'event': 'auth', 'apiKey': 'taker', 'authPayload': 'AUTH1',
+                        'authSig': hmac.new('takersecret', 'AUTH1', sha384).hexdigest()}))
+    engine.new_order(maker, 'btcusd', 'sell', 1, 410)
+    engine.new_order(taker, 'btcusd', 'buy', 1, 410)
+    frames = []
+    while not ws.frames.empty():
+        frames.append(json.loads(ws.frames.get()))
+    assert frames[0]['event'] == 'subscribed'
+    assert {'event': 'auth', 'status': 'OK', 'chanId': 0, 'userId': taker.user_id} in frames
+    events = [f[1] for f in frames if isinstance(f, list) and f[0] == 0]
+    assert events[:3] == ['ws', 'os', 'ts']
+    assert 'on' in events and 'oc' in events and 'te' in events and 'wu' in events
+    prints = [f for f in frames if isinstance(f, list) and f[0] == frames[0]['chanId'] and f[1] == 'te']
+    assert len(prints) == 1 and prints[0][4:] == [410.0, 1.0]
+    # account te is [SEQ, PAIR, MTS, ORD_ID, AMOUNT, PRICE, ...], tu has the trade id after SEQ and a ts row's layout
+    te = [f[2] for f in frames if isinstance(f, list) and f[0] == 0 and f[1] == 'te'][0]
+    tu = [f[2] for f in frames if isinstance(f, list) and f[0] == 0 and f[1] == 'tu'][0]
+    assert te[0] == tu[0] and te[1] == 'BTCUSD' and te[4:6] == [1.0, 410.0]
+    assert tu[1] == taker.trades[-1]['tid'] and tu[2] == 'BTCUSD' and len(tu[1:]) == 10
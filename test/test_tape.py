@@ -0,0 +1,45 @@
+from bitfinex_tape import TradeTape, TradeTapes, BUY, SELL
+
+
+def test_window_queries():
+    tape = TradeTape('BTC_USD', capacity=8)
+    tape.add(100, 400.0, 1.0)
+    tape.add(110, 410.0, -3.0)
+    tape.add(120, 420.0, 2.0)
+    assert len(tape) == 3
+    assert tape.last() == (120, 420.0, 2.0, BUY)
+    assert tape.volume(15, now=120) == 5.0
+    assert tape.count(60, now=120) == 3
+    assert tape.vwap(15, now=120) == (410.0 * 3 + 420.0 * 2) / 5
+    assert tape.volume(60, now=120, side=SELL) == 3.0
+    assert tape.vwap(5, now=200) is None
+
+
+def test_ring_overwrites_oldest():
+    tape = TradeTape('BTC_USD', capacity=4)
+    for i in range(10):
+        tape.add(i, 100.0 + i, 1.0)
+    assert len(tape) == 4
+    assert tape.count(100, now=10) == 4
+    assert tape.vwap(100, now=10) == (106.0 + 107.0 + 108.0 + 109.0) / 4
+
+
+def test_snapshot_is_newest_first():
+    tapes = TradeTapes(capacity=16)
+    tapes.on_snapshot('ETH_BTC', [[3, 30, 0.03, -1], [2, 20, 0.02, 1], [1, 10, 0.01, 1]])
+    tapes.on_execution('ETH_BTC', 40, 0.04, 2)
+    assert 'ETH_BTC' in tapes
+    assert tapes['ETH_BTC'].last() == (40, 0.04, 2.0, BUY)
+    assert tapes['ETH_BTC'].count(15, now=40) == 2
+
+
+def test_snapshot_after_reconnect_is_not_counted_twice():
+    tapes = TradeTapes(capacity=16)
+    rows = [[3, 20, 0.03, -1], [2, 20, 0.02, 1], [1, 10, 0.01, 1]]
+    tapes.on_snapshot('ETH_BTC', rows)
+    tapes.on_execution('ETH_BTC', 30, 0.04, 2)
+    tapes.on_snapshot('ETH_BTC', [[5, 40, 0.05, 1], [4, 35, 0.02, 1], [0, 30, 0.04, 2]] + rows)
+    tape = tapes['ETH_BTC']
+    assert tape.count(100, now=40) == 6
+    assert tape.volume(100, now=40) == 7.0
+    assert tape.last() == (40, 0.05, 1.0, BUY)
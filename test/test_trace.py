@@ -0,0 +1,29 @@
+from bitfinex_trace import Tracer, bucket, bucket_upper, percentile
+from test.fakes import FakeRedis
+
+
+def test_buckets():
+    assert bucket(0) == 0
+    for latency in (0.0005, 0.01, 0.25, 3.0):
+        assert bucket_upper(bucket(latency) - 1) < latency <= bucket_upper(bucket(latency)) * 1.0000001
+    counts = {bucket(0.01): 98, bucket(1.0): 2}
+    assert percentile(counts, 50) == bucket_upper(bucket(0.01))
+    assert percentile(counts, 99) == bucket_upper(bucket(1.0))
+    assert percentile({}, 50) is None
+
+
+def test_stages_correlate_across_processes():
+    red = FakeRedis()
+    manager = Tracer(red)
+    listener = Tracer(red)
+    # the listener can see the order before the manager has its ack back
+    listener.stamp('123', 'listed', 'BTC_USD', when=1000.030)
+    manager.stamp('bitfinex|123', 'ack', 'BTC_USD', when=1000.050, created=1000.0)
+    listener.stamp('123', 'fill', 'BTC_USD', when=1000.500)
+    listener.stamp('123', 'fill', 'BTC_USD', when=1000.900)
+    rows = dict(((stage, market), (count, p50)) for stage, market, count, p50, p99
+                in manager.summary(['BTC_USD'], now=1000.5))
+    assert rows[('ack', 'BTC_USD')][0] == 1
+    assert rows[('listed', 'BTC_USD')][0] == 1
+    assert rows[('fill', 'BTC_USD')][0] == 1
+    assert 0.5 <= rows[('fill', 'BTC_USD')][1] < 0.5 * 1.2